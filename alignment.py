@@ -0,0 +1,201 @@
+"""
+Module Name: alignment.py
+Description: Time-aligned merging and resampling of the streams of many devices onto one time grid.
+
+Every stream is pushed with host times (the sensor times corrected by the clock fit of its client, see
+:func:`movesense_class.BLEClient.read_stream`). The engine emits the grid points up to a watermark: the
+oldest newest time of the streams, so no stream is still missing data there. A stream more than max_delay
+behind the newest one no longer holds the watermark back, which bounds the buffering, and its grid points
+are flagged missing. Each stream is resampled with one vectorized search over the grid points, by linear
+interpolation or by holding the last sample (zero-order hold).
+"""
+
+from math import ceil, floor
+import numpy as np
+
+RESAMPLE_METHODS = ["linear", "zoh"]
+
+
+def resample(times, samples, grid, method : str = "linear", max_gap = None):
+    '''
+    Resample one stream at the grid times.
+
+    Args:
+        times: The sorted sample times.
+        samples: The samples, shape (n,) or (n, width).
+        grid: The times to resample at.
+        method: 'linear' interpolation or 'zoh' (the last sample at or before each grid time).
+        max_gap: The longest spacing of samples that is bridged. Grid points in a longer gap, before the first
+                 or after the last sample are flagged missing and set to NaN.
+
+    Returns:
+        tuple: The float64 values at the grid times and the boolean missing flags.
+    '''
+    if method not in RESAMPLE_METHODS:
+        raise ValueError(f"Unknown resample method: {method}")
+    times = np.asarray(times, dtype = np.float64)
+    samples = np.asarray(samples, dtype = np.float64)
+    grid = np.asarray(grid, dtype = np.float64)
+    shape = (len(grid),) + samples.shape[1:]
+    if len(times) == 0:
+        return np.full(shape, np.nan), np.ones(len(grid), dtype = bool)
+    max_gap = np.inf if max_gap is None else max_gap
+    last = len(times) - 1
+    left = np.searchsorted(times, grid, side = "right") - 1
+    before = left < 0
+    left = np.maximum(left, 0)
+    if method == "zoh":
+        values = samples[left]
+        missing = before | (grid - times[left] > max_gap)
+    else:
+        right = np.minimum(left + 1, last)
+        exact = times[left] == grid
+        span = times[right] - times[left]
+        weight = np.divide(grid - times[left], span, out = np.zeros(len(grid)), where = span > 0)
+        if samples.ndim > 1:
+            weight = weight[:, None]
+        values = samples[left] + weight * (samples[right] - samples[left])
+        missing = before | ((grid > times[last]) & ~exact) | (~exact & (span > max_gap))
+    values = np.array(values)
+    values[missing] = np.nan
+    return values, missing
+
+
+class AlignmentEngine:
+    '''
+    Streaming alignment of many streams onto a common time grid.
+
+    Args:
+        rate:
+            The rate of the grid in Hz. Grid times are multiples of 1 / rate, so engines with the same rate share a grid.
+        method:
+            'linear' or 'zoh', see :func:`resample`.
+        max_delay:
+            The seconds a stream may lag behind the newest one before it stops holding the output back.
+        streams:
+            Dictionary with the buffered times and samples, hz and max_gap of each stream key.
+        emitted:
+            Number of grid points emitted.
+
+    Example:
+        >>> engine = AlignmentEngine(100, method = "linear", max_delay = 0.5)
+        >>> engine.add_stream(("chest", "ecg"), hz = 512)
+        >>> engine.add_stream(("wrist", "imu9"), hz = 208)
+        >>> engine.push_client(("chest", "ecg"), chest_client, "ecg")
+        >>> engine.push_client(("wrist", "imu9"), wrist_client, "imu9")
+        >>> times, values, missing = engine.pull()
+    '''
+    def __init__(self, rate : float, method : str = "linear", max_delay : float = 1.0):
+        if rate <= 0:
+            raise ValueError("Rate must be positive.")
+        if method not in RESAMPLE_METHODS:
+            raise ValueError(f"Unknown resample method: {method}")
+        self.rate = rate
+        self.period = 1.0 / rate
+        self.method = method
+        self.max_delay = max_delay
+        self.streams = {}
+        self.emitted = 0
+        self._next_index = None
+
+    def add_stream(self, key, hz = None, max_gap = None):
+        '''
+        Register a stream, so the output holds it (flagged missing) before its first samples arrive.
+
+        Args:
+            key: Any hashable name of the stream, e.g. (address, request).
+            hz: The sample rate of the stream.
+            max_gap: The longest sample spacing bridged in seconds. 3 sample periods (3 s without a rate) if None.
+        '''
+        if max_gap is None:
+            max_gap = 3.0 / hz if hz else 3.0
+        self.streams[key] = {'times' : np.empty(0), 'samples' : None, 'hz' : hz, 'max_gap' : max_gap}
+
+    def push(self, key, times, samples):
+        '''
+        Add a block of samples of a stream with their host times in seconds. Samples not after the last
+        buffered one, or older than the grid already emitted, are dropped.
+        '''
+        if key not in self.streams:
+            self.add_stream(key)
+        stream = self.streams[key]
+        times = np.asarray(times, dtype = np.float64)
+        samples = np.asarray(samples, dtype = np.float64)
+        if len(times) == 0:
+            return
+        if stream['samples'] is None:
+            stream['samples'] = np.empty((0,) + samples.shape[1:])
+        if len(stream['times']):
+            keep = times > stream['times'][-1]
+            times, samples = times[keep], samples[keep]
+        stream['times'] = np.concatenate((stream['times'], times))
+        stream['samples'] = np.concatenate((stream['samples'], samples))
+        if self._next_index is not None:
+            self._trim(stream, self._next_index / self.rate)
+
+    def push_client(self, key, client, request = None):
+        '''
+        Read all the new samples of a client's ring buffer stream (host times, see
+        :func:`movesense_class.BLEClient.read_stream`) and push them.
+        '''
+        times, samples = client.read_stream(request)
+        self.push(key, times, samples)
+
+    @staticmethod
+    def _trim(stream, time : float):
+        '''
+        Drop the samples before time, except the last one before it that the next grid point interpolates from.
+        '''
+        first = max(0, int(np.searchsorted(stream['times'], time, side = "left")) - 1)
+        if first:
+            stream['times'] = stream['times'][first:]
+            stream['samples'] = stream['samples'][first:]
+
+    def watermark(self):
+        '''
+        Returns:
+            float: The time up to which the grid can be emitted, None before any samples.
+        '''
+        lasts = [stream['times'][-1] for stream in self.streams.values() if len(stream['times'])]
+        if not lasts:
+            return None
+        newest = max(lasts)
+        # Streams lagging more than max_delay (or without data yet) do not hold the output back
+        return min(last for last in lasts if last >= newest - self.max_delay)
+
+    def pull(self, until = None):
+        '''
+        Emit the grid points up to the watermark (or until, if earlier) with the resampled value of every stream.
+
+        Returns:
+            tuple: The grid times, a dictionary with the float64 values of each stream (NaN where missing)
+            and a dictionary with the boolean missing flags of each stream.
+        '''
+        watermark = self.watermark()
+        if watermark is None:
+            return np.empty(0), {}, {}
+        if until is not None:
+            watermark = min(watermark, until)
+        if self._next_index is None:
+            first = min(stream['times'][0] for stream in self.streams.values() if len(stream['times']))
+            self._next_index = ceil(first * self.rate)
+        last_index = floor(watermark * self.rate)
+        count = max(0, last_index - self._next_index + 1)
+        grid = (self._next_index + np.arange(count)) / self.rate
+        values, missing = {}, {}
+        for key, stream in self.streams.items():
+            samples = stream['samples'] if stream['samples'] is not None else np.empty(0)
+            values[key], missing[key] = resample(stream['times'], samples, grid, self.method, stream['max_gap'])
+        self._next_index += count
+        self.emitted += count
+        next_time = self._next_index / self.rate
+        for stream in self.streams.values():
+            self._trim(stream, next_time)
+        return grid, values, missing
+
+    def buffered(self):
+        '''
+        Returns:
+            dict: The number of samples buffered for each stream.
+        '''
+        return {key : len(stream['times']) for key, stream in self.streams.items()}
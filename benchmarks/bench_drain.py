@@ -0,0 +1,62 @@
+"""
+Module Name: bench_drain.py
+Description: Measures how the time to drain an ECG queue grows with the queue length.
+
+Run from the repository root with:
+    python benchmarks/bench_drain.py
+"""
+
+import asyncio
+import sys
+from os.path import dirname, abspath
+from time import perf_counter
+
+import numpy as np
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from util_fun import ecg_from_queue, ecg_data_format  # noqa: E402
+
+QUEUE_LENGTHS = [1000, 2000, 4000, 8000, 16000, 32000]
+
+
+def fill_queue(length : int):
+    '''
+    Build a queue with the given number of ECG packets in the [timestamp, s1, ..., s16] format.
+    '''
+    queue = asyncio.Queue()
+    samples = list(np.random.default_rng(0).normal(size = 16))
+    for index in range(length):
+        queue.put_nowait([index * 31] + samples)
+    return queue
+
+
+async def legacy_ecg_from_queue(queue : asyncio.Queue):
+    '''
+    The np.append implementation that ecg_from_queue used before, kept for comparison.
+    '''
+    ecg_data = np.array([], dtype = np.float32)
+    timestamps = np.array([], dtype = np.uint32)
+    while queue.qsize() > 0:
+        temp_timestamp, temp_ecg_data = await ecg_data_format(queue)
+        ecg_data = np.append(ecg_data, np.array(temp_ecg_data, dtype = np.float32))
+        timestamps = np.append(timestamps, np.uint32(temp_timestamp))
+    return ecg_data
+
+
+async def time_drain(drain, length : int):
+    queue = fill_queue(length)
+    start = perf_counter()
+    await drain(queue)
+    return perf_counter() - start
+
+
+async def main():
+    print(f"{'packets':>8} {'buffer [s]':>11} {'us/packet':>10} {'np.append [s]':>14} {'us/packet':>10}")
+    for length in QUEUE_LENGTHS:
+        buffered = await time_drain(ecg_from_queue, length)
+        legacy = await time_drain(legacy_ecg_from_queue, length)
+        print(f"{length:>8} {buffered:>11.4f} {1e6 * buffered / length:>10.2f} {legacy:>14.4f} {1e6 * legacy / length:>10.2f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,66 @@
+"""
+Module Name: bench_import.py
+Description: Checks the import time of the light modules against a budget with python -X importtime.
+
+Each module is imported in a fresh interpreter several times and the fastest cumulative import time is kept.
+A module over its budget in milliseconds, or one loading a module it must not (numpy or bleak for the address
+and request checks), fails the check with exit status 1, so the script can gate a CI job.
+
+Run from the repository root with:
+    python benchmarks/bench_import.py [--repeat 5]
+"""
+
+import argparse
+import subprocess
+import sys
+from os.path import dirname, abspath
+
+ROOT = dirname(dirname(abspath(__file__)))
+# Budget in milliseconds and the modules that must not be imported along
+BUDGETS = {
+    "constants" : (5, ["numpy", "bleak", "asyncio"]),
+    "health" : (10, ["numpy", "bleak", "asyncio"]),
+    "util_fun" : (25, ["numpy", "bleak", "asyncio"]),
+    "movesense_class" : (100, ["numpy"]),
+}
+
+
+def import_time(module : str):
+    '''
+    Import a module in a fresh interpreter.
+
+    Returns:
+        tuple: The cumulative import time of the module in milliseconds and the set of the top level modules imported.
+    '''
+    code = f"import sys, {module}; print(' '.join(sys.modules))"
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd = ROOT, capture_output = True, text = True, check = True)
+    for line in reversed(result.stderr.splitlines()):
+        # import time: self [us] | cumulative | imported package
+        fields = [field.strip() for field in line.split("|")]
+        if len(fields) == 3 and fields[2] == module:
+            return int(fields[1]) / 1000, {name.split(".")[0] for name in result.stdout.split()}
+    raise RuntimeError(f"No import time reported for {module}.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Check the import time of the light modules against a budget.")
+    parser.add_argument("--repeat", type = int, default = 5, help = "imports per module, the fastest one is kept")
+    args = parser.parse_args()
+    failed = False
+    print(f"{'module':>16} {'import [ms]':>12} {'budget [ms]':>12}  result")
+    for module, (budget, forbidden) in BUDGETS.items():
+        runs = [import_time(module) for _ in range(args.repeat)]
+        milliseconds = min(run[0] for run in runs)
+        loaded = sorted(set(forbidden) & runs[0][1])
+        result = "ok"
+        if milliseconds > budget:
+            result = "over budget"
+        if loaded:
+            result = "imports " + ", ".join(loaded)
+        failed |= result != "ok"
+        print(f"{module:>16} {milliseconds:>12.1f} {budget:>12}  {result}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+"""
+Module Name: bench_suite.py
+Description: Benchmarks of the notification -> decode -> queue -> drain path, run without hardware.
+
+Covers the packets per second of each decoder, the per-packet latency from handler entry until the data
+can be read, the peak memory of capturing and draining one hour of ECG, the scaling from 1 to 32
+simulated devices, the throughput and compression of the sample codec and the cost of the profiling hooks. The results are saved as JSON to compare runs over time.
+
+Run from the repository root with:
+    python benchmarks/bench_suite.py [--quick] [--output bench_results.json]
+"""
+
+import argparse
+import asyncio
+import json
+import platform
+import sys
+import tracemalloc
+from datetime import datetime, timezone
+from functools import partial
+from os.path import dirname, abspath
+from time import perf_counter, perf_counter_ns
+
+import numpy as np
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from codec import encode_ints, decode_ints, encode_floats, decode_floats  # noqa: E402
+from decoder import decode_ecg_packets, decode_magi_packets, decode_hr_packets, decode_temp_packets  # noqa: E402
+from fleet import MovesenseFleet  # noqa: E402
+from movesense_class import BLEClient  # noqa: E402
+from profiling import Profiler  # noqa: E402
+from simulator import PacketGenerator, simulated_ble_client  # noqa: E402
+from util_fun import ecg_from_queue  # noqa: E402
+from bench_drain import time_drain  # noqa: E402
+
+DEVICE_COUNTS = [1, 2, 4, 8, 16, 32]
+STREAMS = [("ecg", 512), ("acc", 1666), ("imu9", 1666), ("hr", None), ("temp", None)]
+
+
+def _rate(count : int, seconds : float):
+    return count / seconds if seconds > 0 else float("inf")
+
+
+def _percentiles(values_ns):
+    values = np.asarray(values_ns, dtype = np.float64) / 1000
+    return {'p50_us' : float(np.percentile(values, 50)), 'p99_us' : float(np.percentile(values, 99)),
+            'max_us' : float(values.max()), 'mean_us' : float(values.mean())}
+
+
+def bench_decoders(packets_per_stream : int):
+    '''
+    Packets per second of the per-packet handlers of BLEClient and of the batch decoders.
+    '''
+    handlers = {"ecg" : BLEClient._ecg_data_handler, "hr" : BLEClient._hr_data_handler, "temp" : BLEClient._temp_data_handler}
+    batch = {"ecg" : decode_ecg_packets, "hr" : decode_hr_packets, "temp" : decode_temp_packets,
+             "acc" : partial(decode_magi_packets, sensors = 1), "imu9" : partial(decode_magi_packets, sensors = 3)}
+    results = {}
+    for request, hz in STREAMS:
+        packets = PacketGenerator(request, hz, seed = 0).packets(packets_per_stream)
+        handler = handlers.get(request, BLEClient._magi_data_handler)
+        start = perf_counter()
+        for packet in packets:
+            handler(packet)
+        per_packet = perf_counter() - start
+        start = perf_counter()
+        batch[request](packets)
+        batched = perf_counter() - start
+        results[request] = {'packets' : len(packets), 'handler_packets_per_s' : _rate(len(packets), per_packet),
+                            'batch_packets_per_s' : _rate(len(packets), batched)}
+    return results
+
+
+async def bench_latency(packets_per_stream : int):
+    '''
+    Latency from the entry of the notification handler until the packet can be read from the queue or the ring buffer.
+    '''
+    results = {}
+    for mode, ring_seconds in (("queue", None), ("ring", 60)):
+        for request, hz in STREAMS[:3]:
+            client = simulated_ble_client("00:00:00:00:00:01", speed = 0, ring_seconds = ring_seconds)
+            await client.connect()
+            await client.write_characteristic(request, hz)
+            reference = client.get_reference(request)
+            packets = PacketGenerator(request, hz, reference, seed = 0).packets(packets_per_stream)
+            latencies = np.empty(len(packets), dtype = np.int64)
+            for index, packet in enumerate(packets):
+                start = perf_counter_ns()
+                await client._notification_handler(None, packet)
+                latencies[index] = perf_counter_ns() - start
+            await client.disconnect()
+            results[f"{mode}/{request}"] = _percentiles(latencies)
+    return results
+
+
+async def bench_memory(seconds : int):
+    '''
+    Peak traced memory of capturing the given seconds of 512 Hz ECG into the queue and draining it.
+    '''
+    client = simulated_ble_client("00:00:00:00:00:01", speed = 0)
+    await client.connect()
+    await client.write_characteristic("ecg", 512)
+    packets = PacketGenerator("ecg", 512, client.get_reference("ecg"), seed = 0).packets(seconds * 512 // 16)
+    tracemalloc.start()
+    start = perf_counter()
+    for packet in packets:
+        await client._notification_handler(None, packet)
+    captured, _ = tracemalloc.get_traced_memory()
+    data = await ecg_from_queue(client.queue, save_timestamps = True)
+    elapsed = perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    await client.disconnect()
+    return {'seconds_of_data' : seconds, 'packets' : len(packets), 'samples' : int(len(data['ecg_data'])),
+            'queue_bytes' : captured, 'peak_bytes' : peak, 'capture_and_drain_s' : elapsed}
+
+
+async def bench_drain_scaling(lengths):
+    '''
+    Drain time of ECG queues of growing length, which should grow linearly.
+    '''
+    return {str(length) : await time_drain(ecg_from_queue, length) for length in lengths}
+
+
+async def bench_devices(seconds : float, request : str = "imu9", hz : int = 1666):
+    '''
+    Run fleets of simulated devices in real time and report the delivered rate and the most lateness of a packet.
+    '''
+    results = {}
+    for count in DEVICE_COUNTS:
+        addresses = ["00:00:00:00:%02X:%02X" % divmod(index, 256) for index in range(count)]
+        fleet = MovesenseFleet(addresses, max_connects = 8, ring_seconds = 5, client_factory = partial(simulated_ble_client, speed = 1.0, seed = 0))
+        await fleet.start(request, hz)
+        await asyncio.sleep(seconds)
+        report = fleet.throughput()
+        lag = max(client.client.lag for client in fleet.clients.values())
+        await fleet.stop()
+        results[str(count)] = {'packets_per_s' : sum(device['packets_per_s'] for device in report.values()),
+                               'samples_per_s' : sum(device['samples_per_s'] for device in report.values()),
+                               'max_lag_s' : lag, 'errors' : len(fleet.errors)}
+    return results
+
+def bench_codec(packets_per_stream : int):
+    '''
+    Samples per second and compression ratio of the codec on raw ECG counts and on imu9 floats (error 0.001).
+    The station rate is the samples per second of 20 devices streaming ECG at 512 Hz and imu9 at 208 Hz.
+    '''
+    ecg = decode_ecg_packets(PacketGenerator("ecg", 512, seed = 0).packets(packets_per_stream), scaled = False)[1].ravel()
+    imu = decode_magi_packets(PacketGenerator("imu9", 208, seed = 0).packets(packets_per_stream), sensors = 3)[1].reshape(-1, 9)
+    cases = {}
+    for method in ("varint", "bitpack"):
+        cases[f"ecg/{method}"] = (ecg, partial(encode_ints, method = method), decode_ints)
+        cases[f"imu9/{method}"] = (imu, partial(encode_floats, max_error = 0.001, method = method), decode_floats)
+    results = {'station_samples_per_s' : 20 * (512 + 208 * 9)}
+    for name, (samples, encode, decode) in cases.items():
+        start = perf_counter()
+        data = encode(samples)
+        encoded = perf_counter() - start
+        start = perf_counter()
+        decode(data)
+        decoded = perf_counter() - start
+        results[name] = {'encode_samples_per_s' : _rate(samples.size, encoded), 'decode_samples_per_s' : _rate(samples.size, decoded),
+                         'bytes_per_sample' : len(data) / samples.size, 'ratio' : samples.nbytes / len(data)}
+    return results
+
+
+async def bench_profiling(packets_per_stream : int):
+    '''
+    Mean handler time per ECG packet into the ring buffer without a profiler, with a disabled and with an enabled one.
+    '''
+    results = {}
+    for mode in ("none", "disabled", "enabled"):
+        client = simulated_ble_client("00:00:00:00:00:01", speed = 0, ring_seconds = 60)
+        await client.connect()
+        await client.write_characteristic("ecg", 512)
+        packets = PacketGenerator("ecg", 512, client.get_reference("ecg"), seed = 0).packets(packets_per_stream)
+        if mode != "none":
+            client.set_profiler(Profiler(enabled = mode == "enabled"))
+        start = perf_counter_ns()
+        for packet in packets:
+            await client._notification_handler(None, packet)
+        results[mode] = {'handler_ns' : (perf_counter_ns() - start) / len(packets)}
+        await client.disconnect()
+    return results
+
+
+async def run(quick : bool):
+    packets = 2000 if quick else 20000
+    return {
+        'meta' : {'date' : datetime.now(timezone.utc).isoformat(), 'python' : platform.python_version(),
+                  'numpy' : np.__version__, 'platform' : platform.platform(), 'quick' : quick},
+        'decoders' : bench_decoders(packets),
+        'latency' : await bench_latency(packets),
+        'memory' : await bench_memory(60 if quick else 3600),
+        'drain' : await bench_drain_scaling([1000, 4000] if quick else [1000, 4000, 16000, 64000]),
+        'devices' : await bench_devices(0.5 if quick else 3.0),
+        'codec' : bench_codec(packets),
+        'profiling' : await bench_profiling(packets),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark the movesense data path without hardware.")
+    parser.add_argument("--quick", action = "store_true", help = "smaller workloads for a fast check")
+    parser.add_argument("--output", default = "bench_results.json", help = "the JSON file to write the results to")
+    args = parser.parse_args()
+    results = asyncio.run(run(args.quick))
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent = 2)
+    print(json.dumps(results, indent = 2))
+
+
+if __name__ == "__main__":
+    main()
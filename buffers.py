@@ -0,0 +1,375 @@
+"""
+Module Name: buffers.py
+Description: Sample buffers used to collect decoded data without copying the whole history on every packet,
+             and fixed size ring buffers used as bounded stream stores.
+"""
+
+from asyncio import Event, wait_for, get_running_loop, TimeoutError as AsyncTimeoutError
+from collections import deque
+from math import ceil
+import numpy as np
+from constants import (ECG_REQUEST_TYPE, HR_REQUEST_TYPE, TEMP_REQUEST_TYPE, MAGI_REQUEST_TYPES, MAGI_SENSOR_COUNT,
+                       HR_NOTIFY_RATE, TEMP_NOTIFY_RATE, OVERFLOW_POLICIES, MAX_STREAM_GAPS)
+
+
+class SampleBuffer:
+    '''
+    A growable NumPy buffer with amortized doubling, used instead of np.append when samples arrive packet by packet.
+
+    Args:
+        dtype:
+            The NumPy dtype of the samples (can be a structured dtype).
+        width:
+            None for a one dimensional buffer, else the number of columns of each row.
+        capacity:
+            The number of rows preallocated. The buffer doubles its capacity when full.
+    '''
+    def __init__(self, dtype = np.float32, width = None, capacity : int = 1024):
+        if capacity <= 0:
+            raise ValueError("Capacity must be positive.")
+        self.dtype = np.dtype(dtype)
+        self.width = width
+        self._size = 0
+        self._data = np.empty(self._shape(capacity), dtype = self.dtype)
+
+    def _shape(self, rows : int):
+        return (rows,) if self.width is None else (rows, self.width)
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def capacity(self):
+        return len(self._data)
+
+    def _reserve(self, rows : int):
+        '''
+        Make sure that the given number of rows can be written after the current size.
+        '''
+        needed = self._size + rows
+        if needed <= len(self._data):
+            return
+        capacity = len(self._data)
+        while capacity < needed:
+            capacity *= 2
+        data = np.empty(self._shape(capacity), dtype = self.dtype)
+        data[:self._size] = self._data[:self._size]
+        self._data = data
+
+    def append(self, row):
+        '''
+        Add one sample (or one row if the buffer has a width).
+        '''
+        self._reserve(1)
+        self._data[self._size] = row
+        self._size += 1
+
+    def extend(self, rows):
+        '''
+        Add many samples (or rows) at once.
+
+        Args:
+            rows: A sequence or array with the samples to add.
+        '''
+        rows = np.asarray(rows, dtype = self.dtype)
+        if self.width is not None:
+            rows = rows.reshape(-1, self.width)
+        count = len(rows)
+        self._reserve(count)
+        self._data[self._size:self._size + count] = rows
+        self._size += count
+
+    def view(self):
+        '''
+        Returns:
+            A zero-copy view of the stored samples. It is valid until the next append/extend.
+        '''
+        return self._data[:self._size]
+
+    def to_array(self):
+        '''
+        Returns:
+            A compact copy of the stored samples.
+        '''
+        return self._data[:self._size].copy()
+
+    def clear(self):
+        '''
+        Drop the stored samples but keep the allocated memory.
+        '''
+        self._size = 0
+
+
+class RingBuffer:
+    '''
+    A preallocated fixed size FIFO of samples with the timestamp of each sample, used as a bounded stream store.
+    Positions are counted from the start of the stream, so the buffer index is position % capacity.
+
+    Args:
+        capacity:
+            The maximum number of samples stored.
+        dtype:
+            The NumPy dtype of the samples.
+        width:
+            None for one value per sample, else the number of columns of each sample.
+        timestamp_dtype:
+            The NumPy dtype of the timestamps.
+        policy:
+            What to do when a write does not fit (see OVERFLOW_POLICIES):
+            'block' waits for a reader in :func:`put` (and writes what fits in :func:`write`),
+            'drop_oldest' overwrites the oldest unread samples and 'drop_newest' discards the new ones.
+            'block' must not be used by a writer that cannot wait, such as the notification handler of a BLEClient.
+        dropped_oldest:
+            Number of unread samples overwritten.
+        dropped_newest:
+            Number of new samples discarded.
+        blocked:
+            Number of writes that had to wait (or were cut short) because the buffer was full.
+        max_gaps:
+            The number of most recent gaps kept.
+        gaps:
+            Deque of (stream position, gap) pairs marking where the stream broke off, e.g. a
+            :class:`health.StreamGap` while the device was disconnected. The samples from that position on came after the gap.
+    '''
+    def __init__(self, capacity : int, dtype = np.float32, width = None, policy : str = "drop_oldest", timestamp_dtype = np.uint32,
+                 max_gaps : int = MAX_STREAM_GAPS):
+        if capacity <= 0:
+            raise ValueError("Capacity must be positive.")
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {policy}")
+        self.capacity = int(capacity)
+        self.width = width
+        self.policy = policy
+        shape = (self.capacity,) if width is None else (self.capacity, width)
+        self.samples = np.zeros(shape, dtype = dtype)
+        self.timestamps = np.zeros(self.capacity, dtype = timestamp_dtype)
+        self.write_position = 0
+        self.read_position = 0
+        self.dropped_oldest = 0
+        self.dropped_newest = 0
+        self.blocked = 0
+        self.gaps = deque(maxlen = max_gaps)
+        self._space = None
+        # (unread count, future) of each waiting reader
+        self._waiters = []
+
+    def __len__(self):
+        return self.write_position - self.read_position
+
+    @property
+    def free(self):
+        return self.capacity - len(self)
+
+    @property
+    def overflow_counts(self):
+        '''
+        Returns:
+            dict: The dropped_oldest, dropped_newest and blocked counters.
+        '''
+        return {'dropped_oldest' : self.dropped_oldest, 'dropped_newest' : self.dropped_newest, 'blocked' : self.blocked}
+
+    def _store(self, timestamps, samples):
+        count = len(samples)
+        start = self.write_position % self.capacity
+        first = min(count, self.capacity - start)
+        self.samples[start:start + first] = samples[:first]
+        self.timestamps[start:start + first] = timestamps[:first]
+        if first < count:
+            self.samples[:count - first] = samples[first:]
+            self.timestamps[:count - first] = timestamps[first:]
+        self.write_position += count
+        if self._waiters:
+            unread = len(self)
+            for wanted, future in self._waiters:
+                if unread >= wanted and not future.done():
+                    future.set_result(True)
+
+    def write(self, timestamps, samples):
+        '''
+        Write samples without waiting, following the overflow policy.
+
+        Args:
+            timestamps: The timestamp of each sample (shape (n,)).
+            samples: The samples (shape (n,) or (n, width)).
+
+        Returns:
+            int: The number of the given samples stored.
+        '''
+        samples = np.asarray(samples)
+        timestamps = np.broadcast_to(np.asarray(timestamps, dtype = self.timestamps.dtype), (len(samples),))
+        count = len(samples)
+        if count > self.free:
+            if self.policy == "drop_oldest":
+                if count > self.capacity:
+                    self.dropped_oldest += count - self.capacity
+                    timestamps, samples = timestamps[-self.capacity:], samples[-self.capacity:]
+                    count = self.capacity
+                overwritten = count - self.free
+                self.dropped_oldest += overwritten
+                self.read_position += overwritten
+            else:
+                fits = self.free
+                if self.policy == "drop_newest":
+                    self.dropped_newest += count - fits
+                else:
+                    self.blocked += 1
+                timestamps, samples = timestamps[:fits], samples[:fits]
+                count = fits
+        if count:
+            self._store(timestamps, samples)
+        return count
+
+    async def put(self, timestamps, samples):
+        '''
+        Write samples following the overflow policy. With the 'block' policy waits until readers free enough space.
+        '''
+        samples = np.asarray(samples)
+        timestamps = np.broadcast_to(np.asarray(timestamps, dtype = self.timestamps.dtype), (len(samples),))
+        written = self.write(timestamps, samples)
+        while self.policy == "block" and written < len(samples):
+            if self._space is None:
+                self._space = Event()
+            self._space.clear()
+            await self._space.wait()
+            written += self.write(timestamps[written:], samples[written:])
+
+    async def wait(self, count : int = 1, timeout = None):
+        '''
+        Wait until at least count samples are unread. Any number of readers can wait at once, each with its own
+        count, and writers wake a reader only once its count is reached.
+
+        Args:
+            count: The number of unread samples to wait for (up to the capacity).
+            timeout: Maximum seconds to wait, None for no limit.
+
+        Returns:
+            bool: True if the count was reached, False at timeout.
+        '''
+        count = min(count, self.capacity)
+        loop = get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        # Another reader may consume the samples before this one runs, so check again after each wake
+        while len(self) < count:
+            waiter = (count, loop.create_future())
+            self._waiters.append(waiter)
+            try:
+                if deadline is None:
+                    await waiter[1]
+                    continue
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    return False
+                try:
+                    await wait_for(waiter[1], remaining)
+                except AsyncTimeoutError:
+                    return False
+            finally:
+                self._waiters.remove(waiter)
+        return True
+
+    def _window(self, position : int, count : int):
+        '''
+        Returns the samples from the given stream position. A view if they do not wrap around the end, else a copy.
+        '''
+        start = position % self.capacity
+        end = start + count
+        if end <= self.capacity:
+            return self.timestamps[start:end], self.samples[start:end]
+        wrapped = end - self.capacity
+        return (np.concatenate((self.timestamps[start:], self.timestamps[:wrapped])),
+                np.concatenate((self.samples[start:], self.samples[:wrapped])))
+
+    def read(self, count = None):
+        '''
+        Pop the oldest unread samples.
+        The returned arrays are views of the buffer when possible, so they must be used (or copied)
+        before the writer overwrites that space.
+
+        Args:
+            count: Maximum number of samples to read, None for all.
+
+        Returns:
+            tuple: timestamps and samples arrays.
+        '''
+        available = len(self)
+        count = available if count is None else min(count, available)
+        window = self._window(self.read_position, count)
+        self.read_position += count
+        if count and self._space is not None:
+            self._space.set()
+        return window
+
+    def latest(self, count : int):
+        '''
+        Get the newest samples without consuming them.
+
+        Args:
+            count: Maximum number of samples to return.
+
+        Returns:
+            tuple: timestamps and samples arrays (views when they do not wrap).
+        '''
+        count = min(count, len(self))
+        return self._window(self.write_position - count, count)
+
+    def mark_gap(self, gap):
+        '''
+        Mark a break of the stream at the current write position.
+        '''
+        self.gaps.append((self.write_position, gap))
+
+    def gaps_between(self, start : int, end : int):
+        '''
+        Returns:
+            list: The gaps marked between two stream positions (e.g. the read position before and after a read).
+        '''
+        return [gap for position, gap in self.gaps if start <= position < end]
+
+    def clear(self):
+        '''
+        Drop all the unread samples.
+        '''
+        self.read_position = self.write_position
+        if self._space is not None:
+            self._space.set()
+
+
+def stream_layout(case : str, hz = None):
+    '''
+    Returns:
+        tuple: The samples per second and the width (None for one value) of the decoded samples of a request.
+    '''
+    case = case.lower()
+    if case == ECG_REQUEST_TYPE or case in MAGI_REQUEST_TYPES:
+        if not hz:
+            raise ValueError("A sample rate is needed for this request.")
+        return hz, (None if case == ECG_REQUEST_TYPE else 3 * MAGI_SENSOR_COUNT[case])
+    elif case == HR_REQUEST_TYPE:
+        return HR_NOTIFY_RATE, 2
+    elif case == TEMP_REQUEST_TYPE:
+        return TEMP_NOTIFY_RATE, None
+    raise NameError("Wrong request.")
+
+
+def stream_store(case : str, hz = None, seconds : float = 60.0, policy : str = "drop_oldest"):
+    '''
+    Create a ring buffer sized to hold the given seconds of data of a request.
+
+    Args:
+        case: The request type (ecg, hr, temp or one of the MAGI types).
+        hz: The sample rate of the request (ignored for hr and temp).
+        seconds: How many seconds of data the buffer will hold.
+        policy: The overflow policy of the buffer.
+
+    Returns:
+        RingBuffer: ECG holds one float32 per sample, MAGI 3 float32 per sensor, HR the [beat_rate, RR_int] pair
+        and temp one float32 per notification. The float64 timestamps are the sensor time of each sample in
+        milliseconds, or the host receive time in seconds for HR which carries no sensor timestamp.
+
+    Example:
+        >>> store = stream_store("imu9", 208, seconds = 10)
+        >>> store.capacity, store.width
+        (2080, 9)
+    '''
+    rate, width = stream_layout(case, hz)
+    return RingBuffer(max(1, ceil(seconds * rate)), np.float32, width, policy, np.float64)
@@ -0,0 +1,239 @@
+"""
+Module Name: codec.py
+Description: Vectorized delta, zigzag and varint / bit-packing codec for the ECG and IMU samples.
+
+Neighbouring samples of a stream differ very little, so the samples are replaced by their differences
+(of first or second order, per column), mapped to unsigned integers with zigzag (0, -1, 1, -2 -> 0, 1, 2, 3)
+and written either as LEB128 varints or bit-packed in blocks of 128 values with the bit width of the largest
+value of the block. Integers (the raw int32 ECG counts) are coded losslessly. Floats (the MAGI axes) are first
+quantized to a step of twice the allowed error, so every decoded value is within that error of the original.
+
+An encoded block is a CODEC_HEADER (method, delta order, width, count, step) followed by the coded values,
+column after column.
+"""
+
+import struct
+import numpy as np
+
+VARINT = 0
+BITPACK = 1
+CODEC_METHODS = {"varint" : VARINT, "bitpack" : BITPACK}
+CODEC_HEADER = struct.Struct('<BBHId')
+BLOCK_SIZE = 128
+
+_POWERS_OF_TWO = np.left_shift(np.uint64(1), np.arange(64, dtype = np.uint64))
+
+
+def zigzag_encode(values):
+    '''
+    Map signed integers to unsigned ones, small magnitudes to small numbers.
+    '''
+    values = np.asarray(values, dtype = np.int64)
+    return ((values << 1) ^ (values >> 63)).astype(np.uint64)
+
+
+def zigzag_decode(values):
+    values = np.asarray(values, dtype = np.uint64)
+    return ((values >> np.uint64(1)).astype(np.int64) ^ -(values & np.uint64(1)).astype(np.int64))
+
+
+def bit_lengths(values):
+    '''
+    Returns:
+        np.ndarray: The number of bits of each unsigned value (0 for 0).
+    '''
+    return np.searchsorted(_POWERS_OF_TWO, np.asarray(values, dtype = np.uint64), side = "right").astype(np.uint8)
+
+
+def varint_encode(values):
+    '''
+    LEB128 encode unsigned integers: 7 bits per byte, low bits first, the high bit set on all but the last byte.
+
+    Returns:
+        bytes: The encoded values back to back.
+    '''
+    values = np.asarray(values, dtype = np.uint64)
+    if len(values) == 0:
+        return b''
+    lengths = np.maximum(1, (bit_lengths(values).astype(np.int64) + 6) // 7)
+    groups = int(lengths.max())
+    shifts = np.arange(groups, dtype = np.uint64) * np.uint64(7)
+    septets = ((values[:, None] >> shifts) & np.uint64(0x7F)).astype(np.uint8)
+    columns = np.arange(groups)
+    septets[columns < lengths[:, None] - 1] |= 0x80
+    return septets[columns < lengths[:, None]].tobytes()
+
+
+def varint_decode(data, count = None):
+    '''
+    Decode LEB128 unsigned integers.
+
+    Args:
+        data: The encoded bytes.
+        count: The number of values expected, checked if given.
+
+    Returns:
+        np.ndarray: The uint64 values.
+
+    Raises:
+        ValueError: The data end inside a value or hold another number of values.
+    '''
+    data = np.frombuffer(data, dtype = np.uint8)
+    if len(data) == 0:
+        values = np.empty(0, dtype = np.uint64)
+    else:
+        last = (data & 0x80) == 0
+        if not last[-1]:
+            raise ValueError("Truncated varint data.")
+        ends = np.flatnonzero(last)
+        starts = np.concatenate(([0], ends[:-1] + 1))
+        positions = np.arange(len(data)) - np.repeat(starts, ends - starts + 1)
+        shifted = (data & 0x7F).astype(np.uint64) << (positions.astype(np.uint64) * np.uint64(7))
+        values = np.bitwise_or.reduceat(shifted, starts)
+    if count is not None and len(values) != count:
+        raise ValueError(f"Expected {count} values, found {len(values)}.")
+    return values
+
+
+def bitpack_encode(values):
+    '''
+    Pack unsigned integers in blocks of BLOCK_SIZE values, each with the bit width of its largest value.
+    The data are the width of every block (one byte each) followed by the blocks, BLOCK_SIZE * width / 8 bytes each.
+
+    Returns:
+        bytes: The packed values.
+    '''
+    values = np.asarray(values, dtype = np.uint64)
+    blocks = -(-len(values) // BLOCK_SIZE)
+    padded = np.zeros(blocks * BLOCK_SIZE, dtype = np.uint64)
+    padded[:len(values)] = values
+    padded = padded.reshape(blocks, BLOCK_SIZE)
+    widths = bit_lengths(padded.max(axis = 1)) if blocks else np.empty(0, dtype = np.uint8)
+    sizes = widths.astype(np.int64) * (BLOCK_SIZE // 8)
+    offsets = np.concatenate(([0], np.cumsum(sizes)[:-1])) if blocks else sizes
+    body = np.zeros(int(sizes.sum()), dtype = np.uint8)
+    # All the blocks of one width are packed at once
+    for width in np.unique(widths[widths > 0]).tolist():
+        selected = np.flatnonzero(widths == width)
+        bits = ((padded[selected, :, None] >> np.arange(width, dtype = np.uint64)) & np.uint64(1)).astype(np.uint8)
+        packed = np.packbits(bits.reshape(len(selected), -1), axis = 1, bitorder = "little")
+        body[(offsets[selected, None] + np.arange(packed.shape[1])).ravel()] = packed.ravel()
+    return widths.tobytes() + body.tobytes()
+
+
+def bitpack_decode(data, count : int):
+    '''
+    Unpack the count values of :func:`bitpack_encode`.
+
+    Returns:
+        np.ndarray: The uint64 values.
+    '''
+    data = np.frombuffer(data, dtype = np.uint8)
+    blocks = -(-count // BLOCK_SIZE)
+    widths = data[:blocks]
+    sizes = widths.astype(np.int64) * (BLOCK_SIZE // 8)
+    if len(data) != blocks + int(sizes.sum()):
+        raise ValueError("Bit-packed data do not match their block widths.")
+    offsets = blocks + np.concatenate(([0], np.cumsum(sizes)[:-1])) if blocks else sizes
+    values = np.zeros((blocks, BLOCK_SIZE), dtype = np.uint64)
+    for width in np.unique(widths[widths > 0]).tolist():
+        selected = np.flatnonzero(widths == width)
+        packed = data[offsets[selected, None] + np.arange(BLOCK_SIZE * width // 8)]
+        bits = np.unpackbits(packed, axis = 1, bitorder = "little").reshape(len(selected), BLOCK_SIZE, width)
+        values[selected] = (bits.astype(np.uint64) << np.arange(width, dtype = np.uint64)).sum(axis = 2, dtype = np.uint64)
+    return values.ravel()[:count]
+
+
+def encode_ints(values, order : int = 1, method : str = "bitpack", step : float = 0.0):
+    '''
+    Losslessly encode integer samples.
+
+    Args:
+        values: The integer samples, shape (n,) or (n, width). Each column is coded on its own.
+        order: The order of the differences (0 to code the values themselves, 1 or 2).
+        method: 'varint' or 'bitpack'.
+        step: Stored in the header for the float modes, 0 for integers.
+
+    Returns:
+        bytes: The header and the coded values.
+
+    Example:
+        >>> raw = decode_ecg_packets(packets, scaled = False)[1].ravel()
+        >>> data = encode_ints(raw)
+        >>> np.array_equal(decode_ints(data), raw)
+        True
+    '''
+    if method not in CODEC_METHODS:
+        raise ValueError(f"Unknown codec method: {method}")
+    if order not in (0, 1, 2):
+        raise ValueError("Difference order must be 0, 1 or 2.")
+    values = np.asarray(values, dtype = np.int64)
+    width = 0 if values.ndim == 1 else values.shape[1]
+    columns = values.reshape(len(values), max(width, 1)).T
+    for _ in range(order):
+        columns = np.diff(columns, axis = 1, prepend = 0)
+    unsigned = zigzag_encode(columns.ravel())
+    body = varint_encode(unsigned) if method == "varint" else bitpack_encode(unsigned)
+    return CODEC_HEADER.pack(CODEC_METHODS[method], order, width, len(values), step) + body
+
+
+def _decode(data):
+    method, order, width, count, step = CODEC_HEADER.unpack_from(data)
+    body = memoryview(data)[CODEC_HEADER.size:]
+    total = count * max(width, 1)
+    if method == VARINT:
+        unsigned = varint_decode(body, total)
+    elif method == BITPACK:
+        unsigned = bitpack_decode(body, total)
+    else:
+        raise ValueError(f"Unknown codec method: {method}")
+    columns = zigzag_decode(unsigned).reshape(max(width, 1), count)
+    for _ in range(order):
+        columns = np.cumsum(columns, axis = 1)
+    values = columns.T
+    return (values[:, 0] if width == 0 else values), step
+
+
+def decode_ints(data, dtype = np.int32):
+    '''
+    Decode the samples of :func:`encode_ints`.
+
+    Returns:
+        np.ndarray: The samples as the given dtype, shape (n,) or (n, width).
+    '''
+    return np.ascontiguousarray(_decode(data)[0], dtype = dtype)
+
+
+def encode_floats(values, max_error : float, order : int = 1, method : str = "bitpack"):
+    '''
+    Encode float samples (e.g. the MAGI axes) with a bounded error, by quantizing them to a step of 2 * max_error.
+
+    Args:
+        values: The float samples, shape (n,) or (n, width).
+        max_error: The largest allowed difference between a decoded and an original value.
+        order, method: See :func:`encode_ints`.
+
+    Returns:
+        bytes: The header and the coded values.
+
+    Example:
+        >>> data = encode_floats(samples, max_error = 0.001)
+        >>> np.abs(decode_floats(data) - samples).max() <= 0.001
+        True
+    '''
+    if max_error <= 0:
+        raise ValueError("The error bound must be positive.")
+    step = 2.0 * max_error
+    values = np.asarray(values, dtype = np.float64)
+    return encode_ints(np.rint(values / step), order, method, step)
+
+
+def decode_floats(data, dtype = np.float64):
+    '''
+    Decode the samples of :func:`encode_floats`. A float32 dtype adds its own rounding to the error bound.
+
+    Returns:
+        np.ndarray: The samples as the given dtype, shape (n,) or (n, width).
+    '''
+    values, step = _decode(data)
+    return np.ascontiguousarray(values * step, dtype = dtype)
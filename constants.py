@@ -16,6 +16,8 @@ Constants:
         A list of strings containing the MAGI requests types. 
         MAGI can be Magnetometer, Acceleometer, Gyroscope, Inertial Measurement Units.
         IMU can be IMU6 for acc and gyro, IMU6m for acc and magn, IMU9 for all three 
+    - MAGI_SENSOR_COUNT (dict): The number of sensors (xyz triplets per sample) of each MAGI request type.
+    - MAGI_SENSORS (dict): The sensors of each MAGI request type in the order their samples are sent.
     - ECG_REQUEST_TYPE (str): A string containing the ecg type.
     - HR_REQUEST_TYPE (str): A string containing the heart rate type.
     - TEMP_REQUEST_TYPE (str): A string containing the temperature type.
@@ -24,6 +26,13 @@ Constants:
     - MAGI_SAMPLE_RATES (list): A list of ints containing the accepted sample rates for MAGI.
     - ECG_SAMPLE_RATES (list): A list of ints containing the accepted sample rates for ECG.
     - VOLTS_PER_LSB (float): The number to multiply the sensors ecg samples to simulate real voltage.  
+    - ECG_SAMPLES_PER_PACKET (int): The number of samples of an ECG notification.
+    - HR_NOTIFY_RATE (int): The highest expected number of heart rate notifications per second.
+    - TEMP_NOTIFY_RATE (int): The expected number of temperature notifications per second.
+    - OVERFLOW_POLICIES (list): A list of strings with the overflow policies of the ring buffer stream stores.
+    - MAX_STREAM_GAPS (int): The number of most recent gap markers a stream store or client keeps.
+    - REFERENCE_IDS (list): The reference IDs given to the subscriptions, in the order they are used.
+    - DATA_PACKET_TYPE (int): The response type byte of the notifications carrying subscription data.
     - DEFAULT_FILE_PATH (str): A string containing the default path of the csv file if data will be stored to file.
 """
 
@@ -32,6 +41,8 @@ WRITE_CHARACTERISTIC_UUID = "34800001-7185-4d5d-b431-630e7050e8f0"
 NOTIFY_CHARACTERISTIC_UUID  = "34800002-7185-4d5d-b431-630e7050e8f0"
 BATTERY_LEVEL_UUID = "00002a19-0000-1000-8000-00805f9b34fb"
 MAGI_REQUEST_TYPES = ["magn", "acc", "gyro", "imu6", "imu6m", "imu9"]
+MAGI_SENSOR_COUNT = {"magn": 1, "acc": 1, "gyro": 1, "imu6": 2, "imu6m": 2, "imu9": 3}
+MAGI_SENSORS = {"magn": ["magn"], "acc": ["acc"], "gyro": ["gyro"], "imu6": ["acc", "gyro"], "imu6m": ["acc", "magn"], "imu9": ["acc", "gyro", "magn"]}
 ECG_REQUEST_TYPE = "ecg"
 HR_REQUEST_TYPE = "hr"
 TEMP_REQUEST_TYPE = "temp"
@@ -40,4 +51,17 @@ STOP_REQUEST_TYPE = "stop"
 MAGI_SAMPLE_RATES = [13,26,52,104,208,416,833,1666]
 ECG_SAMPLE_RATES = [125,128,200,250,256,500,512]
 VOLTS_PER_LSB = 1.0 / 20.0 / (1 << 17)
-DEFAULT_FILE_PATH = "./data_storage/" 
\ No newline at end of file
+ECG_SAMPLES_PER_PACKET = 16
+HR_NOTIFY_RATE = 4
+TEMP_NOTIFY_RATE = 1
+OVERFLOW_POLICIES = ["block", "drop_oldest", "drop_newest"]
+MAX_STREAM_GAPS = 1024
+REFERENCE_IDS = list(range(99, 256)) + list(range(1, 99))
+DATA_PACKET_TYPE = 2
+DEFAULT_FILE_PATH = "./data_storage/" 
+
+__all__ = ["DEVICENAME", "WRITE_CHARACTERISTIC_UUID", "NOTIFY_CHARACTERISTIC_UUID", "BATTERY_LEVEL_UUID", "MAGI_REQUEST_TYPES",
+           "MAGI_SENSOR_COUNT", "MAGI_SENSORS", "ECG_REQUEST_TYPE", "HR_REQUEST_TYPE", "TEMP_REQUEST_TYPE", "PATH",
+           "STOP_REQUEST_TYPE", "MAGI_SAMPLE_RATES", "ECG_SAMPLE_RATES", "VOLTS_PER_LSB", "ECG_SAMPLES_PER_PACKET",
+           "HR_NOTIFY_RATE", "TEMP_NOTIFY_RATE", "OVERFLOW_POLICIES", "MAX_STREAM_GAPS", "REFERENCE_IDS",
+           "DATA_PACKET_TYPE", "DEFAULT_FILE_PATH"]
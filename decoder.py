@@ -0,0 +1,237 @@
+"""
+Module Name: decoder.py
+Description: Vectorized batch decoding of raw movesense notifications into typed NumPy arrays.
+
+Every movesense notification starts with a response type byte and a reference byte, followed by
+a little endian uint32 timestamp (except heart rate) and the samples. Packets of a stream share
+the same length, so a batch of them can be joined and viewed through one structured dtype with
+np.frombuffer instead of unpacking each sample with struct.
+"""
+
+import numpy as np
+from constants import (VOLTS_PER_LSB, ECG_REQUEST_TYPE, HR_REQUEST_TYPE, TEMP_REQUEST_TYPE, MAGI_REQUEST_TYPES, MAGI_SENSOR_COUNT,
+                       ECG_SAMPLES_PER_PACKET)
+
+HEADER_SIZE = 6
+
+ECG_PACKET_DTYPE = np.dtype([('type', np.uint8), ('reference', np.uint8),
+                             ('timestamp', '<u4'), ('samples', '<i4', (ECG_SAMPLES_PER_PACKET,))])
+HR_PACKET_DTYPE = np.dtype([('type', np.uint8), ('reference', np.uint8),
+                            ('beat_rate', '<f4'), ('RR_int', '<u2')])
+TEMP_PACKET_DTYPE = np.dtype([('type', np.uint8), ('reference', np.uint8),
+                              ('temp', '<f4'), ('timestamp', '<u4')])
+
+
+def magi_packet_dtype(packet_size : int):
+    '''
+    Build the structured dtype of a MAGI packet with the given length.
+
+    Args:
+        packet_size: The length in bytes of the packet (6 + 4 * number of floats)
+
+    Returns:
+        np.dtype: The dtype with type, reference, timestamp and values fields
+
+    Raises:
+        ValueError: if the packet size does not hold whole float values.
+    '''
+    if packet_size < HEADER_SIZE or (packet_size - HEADER_SIZE) % 4:
+        raise ValueError(f"Invalid MAGI packet size: {packet_size}")
+    return np.dtype([('type', np.uint8), ('reference', np.uint8),
+                     ('timestamp', '<u4'), ('values', '<f4', ((packet_size - HEADER_SIZE) // 4,))])
+
+
+def _packets_view(packets, dtype : np.dtype):
+    '''
+    Join a list of equally sized packets and view them as a structured array of the given dtype.
+    '''
+    if isinstance(packets, (bytes, bytearray, memoryview)):
+        buffer = packets
+    else:
+        buffer = b''.join(packets)
+    if len(buffer) % dtype.itemsize:
+        raise ValueError(f"Packets are not a multiple of {dtype.itemsize} bytes.")
+    return np.frombuffer(buffer, dtype = dtype)
+
+
+def decode_ecg_packets(packets, scaled : bool = True):
+    '''
+    Decode a batch of ECG packets (70 bytes each).
+
+    Args:
+        packets: A list of byte arrays or one bytes object with the packets back to back
+        scaled: If True the samples are multiplied by VOLTS_PER_LSB, else the raw int32 counts are returned
+
+    Returns:
+        tuple: timestamps (uint32, shape (n,)) and samples (float64 or int32, shape (n, 16))
+
+    Example:
+        >>> timestamps, samples = decode_ecg_packets(packets)
+        >>> samples.ravel()
+        [s1, ..., s16, s1, ..., s16]
+    '''
+    view = _packets_view(packets, ECG_PACKET_DTYPE)
+    timestamps = view['timestamp'].astype(np.uint32)
+    if scaled:
+        return timestamps, view['samples'] * VOLTS_PER_LSB
+    return timestamps, view['samples'].astype(np.int32)
+
+
+def decode_magi_packets(packets, sensors : int = 1, packet_size = None):
+    '''
+    Decode a batch of MAGI packets into xyz triplets.
+    A packet holds the samples of each sensor one after the other (acc, gyro, magn), so the values
+    are reordered so that each row holds the xyz triplets of all the sensors for one sample.
+
+    Args:
+        packets: A list of equally sized byte arrays or one bytes object with the packets back to back
+        sensors: The number of sensors in the packet (1 for acc/gyro/magn, 2 for imu6/imu6m, 3 for imu9)
+        packet_size: The size in bytes of each packet, needed when the packets are one bytes object
+
+    Returns:
+        tuple: timestamps (uint32, shape (n,)) and samples (float32, shape (n, k, 3 * sensors)) where k are the samples per packet
+
+    Raises:
+        ValueError: if the packets can not hold whole xyz triplets for the given sensors, or are one bytes
+        object without a packet_size.
+    '''
+    if packet_size is None:
+        if isinstance(packets, (bytes, bytearray, memoryview)):
+            raise ValueError("The packet size is needed to decode MAGI packets given back to back.")
+        if not packets:
+            return np.empty(0, dtype = np.uint32), np.empty((0, 0, 3 * sensors), dtype = np.float32)
+        packet_size = len(packets[0])
+    view = _packets_view(packets, magi_packet_dtype(packet_size))
+    values = view['values']
+    if values.shape[1] % (3 * sensors):
+        raise ValueError(f"MAGI packet does not hold xyz triplets for {sensors} sensors.")
+    per_packet = values.shape[1] // (3 * sensors)
+    samples = values.reshape(len(view), sensors, per_packet, 3).transpose(0, 2, 1, 3)
+    return view['timestamp'].astype(np.uint32), np.ascontiguousarray(samples, dtype = np.float32).reshape(len(view), per_packet, 3 * sensors)
+
+
+def decode_hr_packets(packets):
+    '''
+    Decode a batch of HR packets (8 bytes each).
+
+    Returns:
+        tuple: beat rates (float32, shape (n,)) and RR intervals (uint16, shape (n,))
+    '''
+    view = _packets_view(packets, HR_PACKET_DTYPE)
+    return view['beat_rate'].astype(np.float32), view['RR_int'].astype(np.uint16)
+
+
+def decode_temp_packets(packets):
+    '''
+    Decode a batch of temperature packets (10 bytes each).
+
+    Returns:
+        tuple: timestamps (uint32, shape (n,)) and temperatures in kelvin (float32, shape (n,))
+    '''
+    view = _packets_view(packets, TEMP_PACKET_DTYPE)
+    return view['timestamp'].astype(np.uint32), view['temp'].astype(np.float32)
+
+
+class BatchDecoder:
+    '''
+    Keeps the raw packets of one stream and decodes them all at once when asked.
+
+    Args:
+        case:
+            The request type of the stream (ecg, hr, temp or one of the MAGI types).
+        packets:
+            List with the raw byte arrays not decoded yet.
+    '''
+    def __init__(self, case : str):
+        case = case.lower()
+        if case not in MAGI_REQUEST_TYPES and case not in (ECG_REQUEST_TYPE, HR_REQUEST_TYPE, TEMP_REQUEST_TYPE):
+            raise NameError("Wrong request.")
+        self.case = case
+        self.packets = []
+
+    def __len__(self):
+        return len(self.packets)
+
+    def append(self, data : bytearray):
+        '''
+        Store a raw packet. A copy is kept since bleak may reuse the given buffer.
+        '''
+        self.packets.append(bytes(data))
+
+    def decode(self):
+        '''
+        Decode and drop all the stored packets.
+
+        Returns:
+            tuple: The arrays of the matching decode_*_packets function. ECG and MAGI return
+            (timestamps, samples), HR returns (beat_rate, RR_int) and temp returns (timestamps, temp).
+        '''
+        packets, self.packets = self.packets, []
+        if self.case == ECG_REQUEST_TYPE:
+            return decode_ecg_packets(packets)
+        elif self.case == HR_REQUEST_TYPE:
+            return decode_hr_packets(packets)
+        elif self.case == TEMP_REQUEST_TYPE:
+            return decode_temp_packets(packets)
+        return decode_magi_packets(packets, MAGI_SENSOR_COUNT[self.case])
+
+
+def decode_samples(case : str, packets, packet_size = None):
+    '''
+    Decode a batch of packets of the given request type into one row per sample, with the packet
+    timestamp repeated for each of its samples.
+
+    Args:
+        case: The request type of the packets
+        packets: A list of equally sized byte arrays or one bytes object with the packets back to back
+        packet_size: The size in bytes of each packet, needed for MAGI packets given as one bytes object
+
+    Returns:
+        tuple: timestamps (uint32, shape (n,)) and samples. ECG gives float64 (n,), MAGI float32 (n, 3 * sensors),
+        HR float32 (n, 2) with [beat_rate, RR_int] and zero timestamps, temp float32 (n,).
+    '''
+    case = case.lower()
+    if case == ECG_REQUEST_TYPE:
+        timestamps, samples = decode_ecg_packets(packets)
+        return timestamps.repeat(samples.shape[1]), samples.ravel()
+    elif case == HR_REQUEST_TYPE:
+        beat_rate, RR_int = decode_hr_packets(packets)
+        return np.zeros(len(beat_rate), dtype = np.uint32), np.column_stack((beat_rate, RR_int.astype(np.float32)))
+    elif case == TEMP_REQUEST_TYPE:
+        return decode_temp_packets(packets)
+    elif case in MAGI_REQUEST_TYPES:
+        timestamps, samples = decode_magi_packets(packets, MAGI_SENSOR_COUNT[case], packet_size)
+        return timestamps.repeat(samples.shape[1]), samples.reshape(-1, samples.shape[2])
+    raise NameError("Wrong request.")
+
+
+def packet_timestamp(case : str, data : bytearray):
+    '''
+    Read the sensor timestamp of one packet without decoding its samples.
+
+    Args:
+        case: The request type of the packet
+        data: The raw packet
+
+    Returns:
+        int: The timestamp in milliseconds, 0 for heart rate packets which carry none.
+    '''
+    if case == HR_REQUEST_TYPE or len(data) < HEADER_SIZE:
+        return 0
+    if case == TEMP_REQUEST_TYPE:
+        return int.from_bytes(data[6:10], "little") if len(data) >= 10 else 0
+    return int.from_bytes(data[2:6], "little")
+
+
+def packet_samples(case : str, data : bytearray):
+    '''
+    Count the samples of one packet from its length, without decoding it.
+
+    Returns:
+        int: ECG 16, MAGI the samples of each sensor, HR and temp 1.
+    '''
+    if case == ECG_REQUEST_TYPE:
+        return ECG_SAMPLES_PER_PACKET
+    if case in MAGI_REQUEST_TYPES:
+        return (len(data) - HEADER_SIZE) // (12 * MAGI_SENSOR_COUNT[case])
+    return 1
@@ -0,0 +1,355 @@
+"""
+Module Name: ecg_pipeline.py
+Description: Incremental ECG processing stages that keep their state from block to block.
+
+The IIR filters are split with partial fractions into first-order recursions y[n] = p * y[n-1] + x[n],
+which are evaluated on whole chunks with a cumulative sum, so a block costs O(block) NumPy work and
+feeding a recording block by block gives the same output as feeding it at once.
+"""
+
+from math import log, pi, sin, cos
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Largest growth of the inverse pole powers inside one chunk, bounds the rounding error of the scan
+_MAX_GROWTH_LOG = log(1e3)
+
+
+def _scan(x, pole : complex, state : complex, powers, inverse):
+    '''
+    Evaluate y[n] = pole * y[n-1] + x[n] on a block, starting from y[-1] = state.
+
+    Returns:
+        tuple: The complex output and its last value.
+    '''
+    out = np.empty(len(x), dtype = np.complex128)
+    chunk = len(powers)
+    for start in range(0, len(x), chunk):
+        segment = x[start:start + chunk]
+        count = len(segment)
+        out[start:start + count] = powers[:count] * (np.cumsum(segment * inverse[:count]) + pole * state)
+        state = out[start + count - 1]
+    return out, state
+
+
+class IIRSection:
+    '''
+    A first or second order IIR filter with state, b and a as in scipy.signal.lfilter (a[0] normalized to 1).
+
+    Args:
+        b:
+            The numerator coefficients (up to 3).
+        a:
+            The denominator coefficients (up to 3).
+
+    Raises:
+        ValueError: if the filter is unstable or has a repeated pole.
+    '''
+    def __init__(self, b, a):
+        b = np.pad(np.asarray(b, dtype = np.float64), (0, 3 - len(b)))
+        a = np.pad(np.asarray(a, dtype = np.float64), (0, 3 - len(a)))
+        b, a = b / a[0], a / a[0]
+        self.b, self.a = b, a
+        if a[2] != 0.0:
+            poles = np.roots(a).astype(np.complex128)
+            if abs(poles[0] - poles[1]) < 1e-12:
+                raise ValueError("Repeated poles are not supported.")
+            # H = direct + sum(residue / (1 - pole z^-1))
+            self.direct = b[2] / a[2]
+            d0, d1 = b[0] - self.direct, b[1] - self.direct * a[1]
+            residues = [(d0 + d1 / poles[0]) / (1 - poles[1] / poles[0]), (d0 + d1 / poles[1]) / (1 - poles[0] / poles[1])]
+            # A complex conjugate pair needs only one scan
+            if abs(poles[0] - np.conj(poles[1])) < 1e-12 and poles[0].imag != 0.0:
+                self.poles, self.residues = [poles[0]], [2 * residues[0]]
+            else:
+                self.poles, self.residues = list(poles), residues
+        elif a[1] != 0.0:
+            self.direct = b[1] / a[1]
+            self.poles, self.residues = [complex(-a[1])], [complex(b[0] - self.direct)]
+        else:
+            self.direct, self.poles, self.residues = b[0], [], []
+        if b[2] != 0.0 and a[2] == 0.0 or b[1] != 0.0 and a[1] == 0.0:
+            raise ValueError("The numerator order can not exceed the denominator order.")
+        self._tables = []
+        for pole in self.poles:
+            magnitude = abs(pole)
+            if magnitude >= 1.0:
+                raise ValueError("Unstable filter.")
+            # The inverse powers grow as 1/|pole|^n, so fast decaying poles are scanned in short chunks
+            chunk = 4096 if -log(magnitude) < _MAX_GROWTH_LOG / 4096 else max(1, int(_MAX_GROWTH_LOG / -log(magnitude)))
+            powers = pole ** np.arange(chunk)
+            self._tables.append((powers, 1 / powers))
+        self.reset()
+
+    def reset(self):
+        self.state = [0j] * len(self.poles)
+
+    def process(self, x):
+        '''
+        Filter a block and keep the state for the next one.
+
+        Args:
+            x: The input samples.
+
+        Returns:
+            np.ndarray: The float64 output.
+        '''
+        x = np.asarray(x, dtype = np.float64)
+        y = self.direct * x
+        if not len(x):
+            return y
+        for index, (pole, residue) in enumerate(zip(self.poles, self.residues)):
+            scanned, self.state[index] = _scan(x, pole, self.state[index], *self._tables[index])
+            y += (residue * scanned).real
+        return y
+
+
+def baseline_filter(hz, cutoff : float = 0.5):
+    '''
+    A DC blocker y[n] = x[n] - x[n-1] + R y[n-1] removing the baseline wander below about cutoff Hz.
+    '''
+    R = 1.0 - 2 * pi * cutoff / hz
+    return IIRSection([1.0, -1.0], [1.0, -R])
+
+
+def highpass_filter(hz, cutoff : float, Q : float = 0.7071):
+    '''
+    A second order Butterworth (Q = 1/sqrt(2)) high-pass section.
+    '''
+    w0 = 2 * pi * cutoff / hz
+    alpha, c = sin(w0) / (2 * Q), cos(w0)
+    return IIRSection([(1 + c) / 2, -(1 + c), (1 + c) / 2], [1 + alpha, -2 * c, 1 - alpha])
+
+
+def lowpass_filter(hz, cutoff : float, Q : float = 0.7071):
+    '''
+    A second order Butterworth (Q = 1/sqrt(2)) low-pass section.
+    '''
+    w0 = 2 * pi * cutoff / hz
+    alpha, c = sin(w0) / (2 * Q), cos(w0)
+    return IIRSection([(1 - c) / 2, 1 - c, (1 - c) / 2], [1 + alpha, -2 * c, 1 - alpha])
+
+
+def notch_filter(hz, frequency : float = 50.0, Q : float = 30.0):
+    '''
+    A second order notch section removing the mains frequency.
+    '''
+    w0 = 2 * pi * frequency / hz
+    alpha, c = sin(w0) / (2 * Q), cos(w0)
+    return IIRSection([1.0, -2 * c, 1.0], [1 + alpha, -2 * c, 1 - alpha])
+
+
+class FilterChain:
+    '''
+    Runs filter stages one after the other on each block.
+
+    Args:
+        stages:
+            List of objects with a process(x) method, e.g. :class:`IIRSection`.
+    '''
+    def __init__(self, stages):
+        self.stages = list(stages)
+
+    def process(self, x):
+        for stage in self.stages:
+            x = stage.process(x)
+        return x
+
+    def reset(self):
+        for stage in self.stages:
+            stage.reset()
+
+
+def bandpass_chain(hz, low : float = 0.5, high : float = 40.0, notch = 50.0, baseline = True):
+    '''
+    The default ECG conditioning: baseline removal, band-pass (high-pass and low-pass sections) and a mains notch.
+
+    Args:
+        hz: The ECG sample rate.
+        low: The high-pass cutoff in Hz.
+        high: The low-pass cutoff in Hz (must be below hz / 2).
+        notch: The mains frequency to remove, None to skip the notch.
+        baseline: Boolean to add the DC blocker in front.
+
+    Returns:
+        FilterChain: The chain of the stages.
+    '''
+    if not 0 < low < high < hz / 2:
+        raise ValueError("Invalid band for the sample rate.")
+    stages = [baseline_filter(hz)] if baseline else []
+    stages += [highpass_filter(hz, low), lowpass_filter(hz, high)]
+    if notch is not None and notch < hz / 2:
+        stages.append(notch_filter(hz, notch))
+    return FilterChain(stages)
+
+
+class RPeakDetector:
+    '''
+    Online R-peak detector in the style of Pan-Tompkins on a band-passed ECG stream.
+    The squared derivative is integrated over a moving window, local maxima of the integrated signal
+    within +-refractory are compared against adaptive signal/noise thresholds, and each beat is placed at
+    the largest absolute filtered sample in the integration window before it.
+    A beat is emitted once refractory seconds of signal follow it, which bounds the latency.
+
+    Args:
+        hz:
+            The ECG sample rate.
+        window:
+            The integration window in seconds.
+        refractory:
+            The shortest time between two beats in seconds.
+        learning:
+            The seconds at the start of the stream used to set the initial signal and noise levels.
+        position:
+            The absolute index of the next sample.
+        beats:
+            Number of beats detected.
+    '''
+    def __init__(self, hz, window : float = 0.15, refractory : float = 0.2, learning : float = 2.0):
+        self.hz = hz
+        self.window = max(1, int(round(window * hz)))
+        self.refractory = max(1, int(round(refractory * hz)))
+        self.learning = max(1, int(round(learning * hz)))
+        self.position = 0
+        self.beats = 0
+        self._signal_level = 0.0
+        self._noise_level = 0.0
+        self._last_beat = None
+        self._last_r = None
+        self._last_x = 0.0
+        self._integrator_tail = np.zeros(self.window - 1)
+        # Kept history: integrated feature, filtered samples and times, starting at absolute index _start
+        self._start = 0
+        self._feature = np.empty(0)
+        self._filtered = np.empty(0)
+        self._times = np.empty(0)
+        self._checked = 0
+
+    def process(self, x, times = None):
+        '''
+        Feed a block of band-passed samples.
+
+        Args:
+            x: The filtered ECG samples.
+            times: The time of each sample (e.g. host seconds), None to use the sample index / hz.
+
+        Returns:
+            list: (sample index, time, RR interval in seconds or None) of each beat confirmed with this block.
+        '''
+        x = np.asarray(x, dtype = np.float64)
+        if times is None:
+            times = (self.position + np.arange(len(x))) / self.hz
+        times = np.asarray(times, dtype = np.float64)
+        # Squared derivative and moving window integration
+        derivative = np.diff(x, prepend = self._last_x)
+        if len(x):
+            self._last_x = x[-1]
+        energy = np.concatenate((self._integrator_tail, derivative * derivative))
+        sums = np.cumsum(energy)
+        feature = (sums[self.window - 1:] - np.concatenate(([0.0], sums[:-self.window]))) / self.window
+        self._integrator_tail = energy[len(energy) - (self.window - 1):] if self.window > 1 else energy[:0]
+        self._feature = np.concatenate((self._feature, feature))
+        self._filtered = np.concatenate((self._filtered, x))
+        self._times = np.concatenate((self._times, times))
+        self.position += len(x)
+        return self._detect()
+
+    def flush(self):
+        '''
+        Confirm the candidates of the end of the stream, without waiting for the refractory signal after them.
+        '''
+        return self._detect(final = True)
+
+    def _detect(self, final = False):
+        beats = []
+        R = self.refractory
+        length = len(self._feature)
+        if self._signal_level == 0.0:
+            # Initial levels from the learning period, the same however the stream is split in blocks
+            if length < self.learning and not final:
+                return beats
+            learned = self._feature[:self.learning]
+            if not len(learned):
+                return beats
+            self._signal_level = 0.25 * float(learned.max())
+            self._noise_level = 0.5 * float(learned.mean())
+        # Pad the ends so every sample has a +-R neighbourhood
+        padded = np.concatenate((np.full(R, -np.inf), self._feature, np.full(R, -np.inf)))
+        maxima = sliding_window_view(padded, 2 * R + 1).max(axis = 1)
+        last = length if final else length - R
+        local = np.flatnonzero((self._feature == maxima)[self._checked:max(last, self._checked)]) + self._checked
+        for index in local.tolist():
+            peak = self._feature[index]
+            absolute = self._start + index
+            if self._last_beat is not None and absolute - self._last_beat < R:
+                continue
+            threshold = self._noise_level + 0.25 * (self._signal_level - self._noise_level)
+            if peak > threshold and peak > 0:
+                self._signal_level = 0.125 * peak + 0.875 * self._signal_level
+                # The R-peak is the largest absolute filtered sample in the window leading to the feature maximum
+                low = max(0, index - self.window)
+                r_index = low + int(np.argmax(np.abs(self._filtered[low:index + 1])))
+                r_absolute = self._start + r_index
+                RR = None
+                if self._last_beat is not None:
+                    RR = (r_absolute - self._last_r) / self.hz
+                self._last_beat = absolute
+                self._last_r = r_absolute
+                self.beats += 1
+                beats.append((r_absolute, float(self._times[r_index]), RR))
+            else:
+                self._noise_level = 0.125 * peak + 0.875 * self._noise_level
+        self._checked = max(self._checked, last)
+        # Keep the history needed for the next neighbourhoods and R-peak searches
+        keep = max(0, min(self._checked - 2 * R - self.window, length))
+        if keep:
+            self._feature = self._feature[keep:]
+            self._filtered = self._filtered[keep:]
+            self._times = self._times[keep:]
+            self._start += keep
+            self._checked -= keep
+        return beats
+
+
+class ECGPipeline:
+    '''
+    Band-pass filtering and R-peak detection of an ECG stream, block by block.
+
+    Args:
+        filters:
+            The :class:`FilterChain` of the stream.
+        detector:
+            The :class:`RPeakDetector` of the stream.
+
+    Example:
+        >>> pipeline = ECGPipeline(512)
+        >>> async for times, samples in mv_client.stream("ecg", min_samples = 256):
+        ...     filtered, beats = pipeline.process(samples, times)
+    '''
+    def __init__(self, hz, low : float = 0.5, high : float = 40.0, notch = 50.0, window : float = 0.15, refractory : float = 0.2):
+        self.hz = hz
+        self.filters = bandpass_chain(hz, low, high, notch)
+        self.detector = RPeakDetector(hz, window, refractory)
+
+    def process(self, samples, times = None):
+        '''
+        Returns:
+            tuple: The filtered block and the list of the beats confirmed with it.
+        '''
+        filtered = self.filters.process(samples)
+        return filtered, self.detector.process(filtered, times)
+
+    def flush(self):
+        return self.detector.flush()
+
+
+def process_offline(samples, hz, times = None, **kwargs):
+    '''
+    Run an :class:`ECGPipeline` over a whole recording at once.
+
+    Returns:
+        tuple: The filtered samples and all the beats.
+    '''
+    pipeline = ECGPipeline(hz, **kwargs)
+    filtered, beats = pipeline.process(samples, times)
+    return filtered, beats + pipeline.flush()
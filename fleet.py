@@ -0,0 +1,173 @@
+"""
+Module Name: fleet.py
+Description: Runs many BLEClient instances concurrently on one event loop.
+"""
+
+from asyncio import Semaphore, gather
+from time import monotonic
+from movesense_class import BLEClient
+from util_fun import is_valid_mac_address
+
+
+class MovesenseFleet:
+    '''
+    Connects, configures and subscribes many movesense devices concurrently.
+    The connects are limited to max_connects at a time, since the BLE adapter stalls when too many run at once,
+    while the writes and subscriptions of the connected devices run freely.
+
+    Args:
+        clients:
+            Dictionary with the :class:`movesense_class.BLEClient` of each device address.
+        max_connects:
+            The maximum number of connects running at the same time.
+        startup_times:
+            Dictionary with the seconds each device took to connect, write its request and start notifying.
+        errors:
+            Dictionary with the exception of each device that failed to start or stop.
+        start_time:
+            Dictionary with the monotonic time each device started notifying, used for the throughput.
+        scanner:
+            A running :class:`scanner.MovesenseScanner`. The devices it has cached are connected with their BLEDevice,
+            skipping the device lookup of the backend.
+    '''
+    def __init__(self, addresses, max_connects : int = 4, ring_seconds = 60, overflow_policy = "drop_oldest", client_factory = BLEClient,
+                 scanner = None):
+        if max_connects <= 0:
+            raise ValueError("max_connects must be positive.")
+        self.clients = {}
+        for address in addresses:
+            if not is_valid_mac_address(address):
+                raise ValueError(f"Invalid address format: {address}")
+            self.clients[address] = client_factory(address, ring_seconds = ring_seconds, overflow_policy = overflow_policy)
+        self.max_connects = max_connects
+        self.scanner = scanner
+        self._connect_slots = None
+        self.startup_times = {}
+        self.errors = {}
+        self.start_time = {}
+
+    def __len__(self):
+        return len(self.clients)
+
+    def _requests(self, request, hz):
+        '''
+        Expand the request spec to a (request, hz) pair per device address.
+        '''
+        if isinstance(request, dict):
+            missing = set(self.clients) - set(request)
+            if missing:
+                raise ValueError(f"No request for devices: {sorted(missing)}")
+            return {address: (spec, None) if isinstance(spec, str) else tuple(spec) for address, spec in request.items()}
+        return {address: (request, hz) for address in self.clients}
+
+    async def _start_device(self, address : str, request : str, hz):
+        client = self.clients[address]
+        start = monotonic()
+        if self.scanner is not None and not client.is_connected:
+            device = self.scanner.get_device(address)
+            if device is not None:
+                client.set_device(device)
+        async with self._connect_slots:
+            await client.connect()
+        if not await client.write_characteristic(request, hz):
+            raise ValueError(f"Failed to write request {request}/{hz}.")
+        await client.start_notify()
+        if not client.is_notifying:
+            raise ValueError("Failed to start notifying.")
+        self.start_time[address] = monotonic()
+        self.startup_times[address] = self.start_time[address] - start
+
+    async def start(self, request, hz = None):
+        '''
+        Connect, write the request and start notifying on all the devices concurrently.
+
+        Args:
+            request:
+                The request type for all the devices, or a dictionary {address: (request, hz)} with a request per device.
+            hz:
+                The sample rate when a single request type is given.
+
+        Returns:
+            list: The addresses of the devices that started. The failures are kept in errors.
+
+        Example:
+            >>> fleet = MovesenseFleet(addresses, max_connects = 4)
+            >>> await fleet.start({chest: ("ecg", 512), wrist: ("imu9", 208)})
+            [chest, wrist]
+        '''
+        requests = self._requests(request, hz)
+        if self._connect_slots is None:
+            self._connect_slots = Semaphore(self.max_connects)
+        addresses = list(requests)
+        results = await gather(*(self._start_device(address, *requests[address]) for address in addresses), return_exceptions = True)
+        started = []
+        for address, result in zip(addresses, results):
+            if isinstance(result, BaseException):
+                self.errors[address] = result
+            else:
+                self.errors.pop(address, None)
+                started.append(address)
+        return started
+
+    async def _stop_device(self, address : str):
+        client = self.clients[address]
+        if client.is_notifying:
+            await client.stop_notify()
+        if client.is_connected:
+            result = await client.disconnect()
+            if isinstance(result, Exception):
+                raise result
+
+    async def stop(self):
+        '''
+        Stop notifying and disconnect all the connected devices concurrently.
+
+        Returns:
+            list: The addresses of the devices that failed to stop. Their exceptions are kept in errors.
+        '''
+        addresses = list(self.clients)
+        results = await gather(*(self._stop_device(address) for address in addresses), return_exceptions = True)
+        failed = []
+        for address, result in zip(addresses, results):
+            if isinstance(result, BaseException):
+                self.errors[address] = result
+                failed.append(address)
+        return failed
+
+    def get_stream(self, address : str, request = None):
+        '''
+        Returns:
+            The ring buffer of a device's request type (the current one if None).
+        '''
+        return self.clients[address].get_stream(request)
+
+    def health(self):
+        '''
+        Poll the packet loss, gap and jitter counters of every device (see :func:`movesense_class.BLEClient.get_health`).
+
+        Returns:
+            dict: The health of each address.
+        '''
+        return {address : client.get_health() for address, client in self.clients.items()}
+
+    def throughput(self):
+        '''
+        Report the data received by each device since it started notifying.
+
+        Returns:
+            dict: For each address the packets, bytes and samples received and their rates per second.
+        '''
+        now = monotonic()
+        report = {}
+        for address, client in self.clients.items():
+            elapsed = now - self.start_time[address] if address in self.start_time else 0.0
+            samples = sum(store.write_position for store in client.streams.values())
+            report[address] = {
+                'packets' : client.packet_count,
+                'bytes' : client.byte_count,
+                'samples' : samples,
+                'packets_per_s' : client.packet_count / elapsed if elapsed > 0 else 0.0,
+                'bytes_per_s' : client.byte_count / elapsed if elapsed > 0 else 0.0,
+                'samples_per_s' : samples / elapsed if elapsed > 0 else 0.0,
+            }
+        return report
@@ -0,0 +1,199 @@
+"""
+Module Name: health.py
+Description: Packet loss, gap and jitter counters of the notification streams.
+
+The spacing of consecutive sensor timestamps of a stream is checked against the spacing expected for its
+request type and rate. The counters are plain attributes updated in place, so polling them does not touch
+the data path.
+"""
+
+from time import time
+from constants import ECG_REQUEST_TYPE, HR_REQUEST_TYPE, TEMP_REQUEST_TYPE, MAGI_REQUEST_TYPES, ECG_SAMPLES_PER_PACKET
+
+
+class StreamGap:
+    '''
+    Marker of a break of a stream while its device was disconnected, put in the stream in place of the missing data.
+
+    Args:
+        request:
+            The request type of the stream.
+        reference:
+            The reference ID of the stream.
+        start, end:
+            The host times in seconds of the disconnect and of the restored subscription.
+    '''
+    def __init__(self, request : str, reference : int, start : float, end : float):
+        self.request = request
+        self.reference = reference
+        self.start = start
+        self.end = end
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+    def __repr__(self):
+        return f"StreamGap({self.request!r}, {self.reference}, {self.duration:.3f} s)"
+
+
+class StreamHealth:
+    '''
+    Health counters of one stream (one subscription).
+
+    Args:
+        request:
+            The request type of the stream.
+        hz:
+            The sample rate of the stream.
+        alpha:
+            The weight of the newest value in the rolling (exponentially weighted) jitter statistics.
+        packets:
+            Number of packets received.
+        lost:
+            Number of packets missing from the gaps of the sensor timestamps.
+        gaps:
+            Number of gaps with at least one lost packet.
+        max_gap_ms:
+            The longest gap between two consecutive packets in milliseconds.
+        duplicates:
+            Number of packets with the same timestamp as the previous one.
+        out_of_order:
+            Number of packets older than the previous one.
+        jitter_ms:
+            Rolling standard deviation of the sensor timestamp spacing from the expected one.
+        arrival_jitter_ms:
+            Rolling standard deviation of the host receive spacing from the expected one.
+        disconnects:
+            Number of times the stream was restored after its device disconnected.
+        disconnected_s:
+            The total seconds the stream was broken off by disconnects.
+        dropped_batches:
+            Number of packet batches not processed because every slot of the process offload was in flight.
+        dropped_packets:
+            Number of packets in the dropped batches.
+        last_host_time:
+            The host time in seconds of the last packet.
+    '''
+    def __init__(self, request : str, hz = None, alpha : float = 0.05):
+        self.request = request
+        self.hz = hz
+        self.alpha = alpha
+        self.packets = 0
+        self.lost = 0
+        self.gaps = 0
+        self.max_gap_ms = 0.0
+        self.duplicates = 0
+        self.out_of_order = 0
+        self.jitter_ms = 0.0
+        self.arrival_jitter_ms = 0.0
+        self.disconnects = 0
+        self.disconnected_s = 0.0
+        self.dropped_batches = 0
+        self.dropped_packets = 0
+        self.last_host_time = None
+        self.last_timestamp = None
+        self._jitter_var = 0.0
+        self._arrival_var = 0.0
+
+    def expected_spacing(self, samples : int):
+        '''
+        Returns:
+            float: The expected milliseconds between two packets of the given samples, None if the stream has no timestamps.
+        '''
+        if self.request == HR_REQUEST_TYPE:
+            return None
+        if self.request == TEMP_REQUEST_TYPE:
+            return 1000.0
+        if self.request == ECG_REQUEST_TYPE:
+            samples = ECG_SAMPLES_PER_PACKET
+        if self.request in MAGI_REQUEST_TYPES or self.request == ECG_REQUEST_TYPE:
+            return samples * 1000.0 / self.hz
+        return None
+
+    def update(self, timestamp, host_time : float, samples : int = 1):
+        '''
+        Check one packet against the previous one.
+
+        Args:
+            timestamp: The unwrapped sensor timestamp of the packet in milliseconds (None for HR).
+            host_time: The host receive time in seconds.
+            samples: The number of samples in the packet.
+        '''
+        self.packets += 1
+        previous_host, self.last_host_time = self.last_host_time, host_time
+        expected = self.expected_spacing(samples)
+        if expected is None or timestamp is None:
+            return
+        if self.last_timestamp is None:
+            self.last_timestamp = timestamp
+            return
+        gap = timestamp - self.last_timestamp
+        if gap == 0:
+            self.duplicates += 1
+            return
+        if gap < 0:
+            # A late packet fills one of the counted gaps
+            self.out_of_order += 1
+            if self.lost:
+                self.lost -= 1
+            return
+        self.last_timestamp = timestamp
+        spacing = max(1, round(gap / expected))
+        if spacing > 1:
+            self.lost += spacing - 1
+            self.gaps += 1
+        if gap > self.max_gap_ms:
+            self.max_gap_ms = float(gap)
+        a = self.alpha
+        deviation = gap - spacing * expected
+        self._jitter_var = (1 - a) * self._jitter_var + a * deviation * deviation
+        self.jitter_ms = self._jitter_var ** 0.5
+        if previous_host is not None:
+            arrival = (host_time - previous_host) * 1000.0 - spacing * expected
+            self._arrival_var = (1 - a) * self._arrival_var + a * arrival * arrival
+            self.arrival_jitter_ms = self._arrival_var ** 0.5
+
+    @property
+    def loss_rate(self):
+        '''
+        Returns:
+            float: The lost packets over all the expected packets.
+        '''
+        total = self.packets + self.lost
+        return self.lost / total if total else 0.0
+
+    def snapshot(self, now = None):
+        '''
+        Returns:
+            dict: The counters of the stream and the seconds since its last packet.
+        '''
+        now = time() if now is None else now
+        return {
+            'request' : self.request, 'hz' : self.hz, 'packets' : self.packets, 'lost' : self.lost,
+            'loss_rate' : self.loss_rate, 'gaps' : self.gaps, 'max_gap_ms' : self.max_gap_ms,
+            'duplicates' : self.duplicates, 'out_of_order' : self.out_of_order,
+            'jitter_ms' : self.jitter_ms, 'arrival_jitter_ms' : self.arrival_jitter_ms,
+            'disconnects' : self.disconnects, 'disconnected_s' : self.disconnected_s,
+            'dropped_batches' : self.dropped_batches, 'dropped_packets' : self.dropped_packets,
+            'seconds_since_last' : now - self.last_host_time if self.last_host_time is not None else None,
+        }
+
+
+def device_health(streams : dict, now = None):
+    '''
+    Gather the health of the streams of one device.
+
+    Args:
+        streams: Dictionary with the :class:`StreamHealth` of each reference ID.
+
+    Returns:
+        dict: The snapshot of each reference ID under 'streams' and the summed packets, lost, duplicates and out_of_order.
+    '''
+    now = time() if now is None else now
+    snapshots = {reference : health.snapshot(now) for reference, health in streams.items()}
+    totals = {key : sum(snapshot[key] for snapshot in snapshots.values()) for key in ('packets', 'lost', 'duplicates', 'out_of_order')}
+    expected = totals['packets'] + totals['lost']
+    totals['loss_rate'] = totals['lost'] / expected if expected else 0.0
+    totals['streams'] = snapshots
+    return totals
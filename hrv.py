@@ -0,0 +1,194 @@
+"""
+Module Name: hrv.py
+Description: Rolling heart rate variability metrics over the RR intervals of the HR stream.
+
+Each window keeps running sums of the RR intervals in it and of their successive differences,
+so adding an interval and evicting the old ones costs O(1) amortized, and the metrics are read from the sums.
+"""
+
+from collections import deque
+from math import sqrt
+import numpy as np
+
+# Running sums are kept relative to this RR (ms) for precision
+_RR_REFERENCE = 800.0
+
+
+class HRVWindow:
+    '''
+    Sliding time window of accepted RR intervals with running sums.
+
+    Args:
+        seconds:
+            The length of the window.
+        count:
+            Number of RR intervals in the window.
+    '''
+    def __init__(self, seconds : float):
+        if seconds <= 0:
+            raise ValueError("Window must be positive.")
+        self.seconds = seconds
+        self._beats = deque()
+        self._sum = 0.0
+        self._sum_squares = 0.0
+        self._diffs = 0
+        self._sum_diff_squares = 0.0
+        self._nn50 = 0
+
+    @property
+    def count(self):
+        return len(self._beats)
+
+    def _add(self, rr : float, diff, sign = 1):
+        x = rr - _RR_REFERENCE
+        self._sum += sign * x
+        self._sum_squares += sign * x * x
+        self._add_diff(diff, sign)
+
+    def _add_diff(self, diff, sign = 1):
+        if diff is not None:
+            self._diffs += sign
+            self._sum_diff_squares += sign * diff * diff
+            self._nn50 += sign * (abs(diff) > 50.0)
+
+    def append(self, time : float, rr : float, diff = None):
+        '''
+        Add an RR interval and evict the ones older than the window.
+
+        Args:
+            time: The time of the beat in seconds.
+            rr: The RR interval in milliseconds.
+            diff: The difference from the previous accepted RR interval, None if it follows an artifact.
+        '''
+        self._beats.append((time, rr, diff))
+        self._add(rr, diff)
+        while self._beats and self._beats[0][0] <= time - self.seconds:
+            old_time, old_rr, old_diff = self._beats.popleft()
+            self._add(old_rr, old_diff, -1)
+            # The difference of the new oldest beat is to the evicted one, so it leaves the window too
+            if self._beats and self._beats[0][2] is not None:
+                first_time, first_rr, first_diff = self._beats[0]
+                self._add_diff(first_diff, -1)
+                self._beats[0] = (first_time, first_rr, None)
+
+    def metrics(self):
+        '''
+        Returns:
+            dict: The count, mean RR (ms), mean HR (bpm), SDNN (ms), RMSSD (ms) and pNN50 (%) of the window.
+        '''
+        n = len(self._beats)
+        if n == 0:
+            return {'count' : 0, 'mean_rr' : None, 'mean_hr' : None, 'sdnn' : None, 'rmssd' : None, 'pnn50' : None}
+        mean = self._sum / n
+        variance = max(0.0, (self._sum_squares - n * mean * mean) / (n - 1)) if n > 1 else 0.0
+        mean_rr = _RR_REFERENCE + mean
+        return {
+            'count' : n,
+            'mean_rr' : mean_rr,
+            'mean_hr' : 60000.0 / mean_rr,
+            'sdnn' : sqrt(variance) if n > 1 else None,
+            'rmssd' : sqrt(max(0.0, self._sum_diff_squares) / self._diffs) if self._diffs else None,
+            'pnn50' : 100.0 * self._nn50 / self._diffs if self._diffs else None,
+        }
+
+
+class HRVEngine:
+    '''
+    Incremental HRV metrics over several sliding windows, fed with the RR intervals of the HR stream.
+    RR intervals outside [min_rr, max_rr] or differing from the running mean of the accepted ones by more
+    than max_change are rejected as artifacts or ectopic beats, and no successive difference is taken across them.
+
+    Args:
+        windows:
+            The window lengths in seconds.
+        min_rr, max_rr:
+            The accepted RR range in milliseconds.
+        max_change:
+            The largest accepted relative change from the running mean RR.
+        accepted:
+            Number of accepted RR intervals.
+        rejected:
+            Number of RR intervals rejected as artifacts.
+
+    Example:
+        >>> engine = HRVEngine(windows = (30, 300))
+        >>> engine.update_hr(await hr_from_queue(mv_client.queue))
+        >>> engine.metrics()[30]['rmssd']
+        42.1
+    '''
+    def __init__(self, windows = (30, 300), min_rr : float = 300.0, max_rr : float = 2000.0, max_change : float = 0.2):
+        self.windows = {seconds : HRVWindow(seconds) for seconds in windows}
+        self.min_rr = min_rr
+        self.max_rr = max_rr
+        self.max_change = max_change
+        self.accepted = 0
+        self.rejected = 0
+        self._time = 0.0
+        self._previous = None
+        self._running_mean = None
+        self._metrics = None
+
+    def update(self, rr : float, time = None):
+        '''
+        Add one RR interval.
+
+        Args:
+            rr: The RR interval in milliseconds.
+            time: The time of the beat in seconds. The sum of the RR intervals if None.
+
+        Returns:
+            bool: True if accepted, False if rejected as an artifact.
+        '''
+        rr = float(rr)
+        self._time = self._time + rr / 1000.0 if time is None else float(time)
+        self._metrics = None
+        if not self.min_rr <= rr <= self.max_rr or (self._running_mean is not None and abs(rr - self._running_mean) > self.max_change * self._running_mean):
+            self.rejected += 1
+            self._previous = None
+            # A long run of rejections means the rhythm changed, so follow it slowly
+            if self._running_mean is not None and self.min_rr <= rr <= self.max_rr:
+                self._running_mean = 0.9 * self._running_mean + 0.1 * rr
+            return False
+        self._running_mean = rr if self._running_mean is None else 0.75 * self._running_mean + 0.25 * rr
+        diff = rr - self._previous if self._previous is not None else None
+        self._previous = rr
+        for window in self.windows.values():
+            window.append(self._time, rr, diff)
+        self.accepted += 1
+        return True
+
+    def update_many(self, rr_intervals, times = None):
+        '''
+        Add RR intervals in order.
+
+        Returns:
+            int: The number of accepted intervals.
+        '''
+        rr_intervals = np.asarray(rr_intervals, dtype = np.float64).tolist()
+        times = [None] * len(rr_intervals) if times is None else np.asarray(times, dtype = np.float64).tolist()
+        return sum(self.update(rr, time) for rr, time in zip(rr_intervals, times))
+
+    def update_hr(self, hr_data, times = None):
+        '''
+        Add the RR intervals of HR data, either the structured array of :func:`util_fun.hr_from_queue`
+        or the (n, 2) [beat_rate, RR_int] samples of the HR ring buffer stream.
+
+        Returns:
+            int: The number of accepted intervals.
+        '''
+        if getattr(hr_data, 'dtype', None) is not None and hr_data.dtype.names:
+            rr_intervals = hr_data['RR_int']
+        else:
+            rr_intervals = np.asarray(hr_data)[:, 1]
+        return self.update_many(rr_intervals, times)
+
+    def metrics(self):
+        '''
+        The current metrics of every window. Computed once after an update and shared by all the readers.
+
+        Returns:
+            dict: The metrics (see :func:`HRVWindow.metrics`) of each window length.
+        '''
+        if self._metrics is None:
+            self._metrics = {seconds : window.metrics() for seconds, window in self.windows.items()}
+        return self._metrics
@@ -8,11 +8,43 @@ Date: ...
 #  Imports 
 from bleak import BleakClient 
 from asyncio import Event, Queue  
+from collections import deque
 # from os.path import exists 
-from util_fun import * 
+from constants import (WRITE_CHARACTERISTIC_UUID, NOTIFY_CHARACTERISTIC_UUID, BATTERY_LEVEL_UUID, ECG_REQUEST_TYPE, HR_REQUEST_TYPE,
+                       TEMP_REQUEST_TYPE, STOP_REQUEST_TYPE, VOLTS_PER_LSB, OVERFLOW_POLICIES, MAX_STREAM_GAPS,
+                       REFERENCE_IDS, DATA_PACKET_TYPE)
+from util_fun import is_valid_mac_address, is_valid_request
+from math import ceil
+from health import StreamHealth, StreamGap, device_health
+from time import time, time_ns, perf_counter_ns
 import struct 
 
-# TODO: Proccess windows of 16 samples each time or more 
+__all__ = ["BLEClient"]
+
+_ECG_STRUCT = struct.Struct('<I16i')
+
+# numpy and the modules using it are imported with the first client (see _import_data_path), not with this module
+stream_store = stream_layout = SharedStreamWriter = shared_stream_name = None
+decode_samples = packet_timestamp = packet_samples = ClockSync = StreamTimer = None
+np = None
+
+
+def _import_data_path():
+    '''
+    Import numpy and the decoders, buffers and clocks of the clients. Called by the first client, so that importing
+    the module alone (e.g. for a CLI that only validates addresses) does not import numpy. Creating a client does.
+    '''
+    global stream_store, stream_layout, SharedStreamWriter, shared_stream_name
+    global decode_samples, packet_timestamp, packet_samples, ClockSync, StreamTimer, np
+    if np is not None:
+        return
+    from buffers import stream_store, stream_layout
+    from shared_stream import SharedStreamWriter, shared_stream_name
+    from decoder import decode_samples, packet_timestamp, packet_samples
+    from timestamps import ClockSync, StreamTimer
+    # Bound last, it marks the imports done
+    import numpy as np
+
 # TODO: Make documentation for the project using sphinx
 
 class BLEClient:
@@ -26,6 +58,11 @@ class BLEClient:
             The MAC addrese of the ble device.
         client:
             The bleak client object
+        device:
+            The bleak BLEDevice of the device (e.g. from :class:`scanner.MovesenseScanner`). If given, the BleakClient is
+            created with it instead of the address, which skips the device lookup at connect.
+        adapter:
+            The Bluetooth adapter the BleakClient connects through (e.g. "hci1", BlueZ only), None for the default.
         battery_level:
             The battery level of the device in the range of [0,100]. Need the call of set_battery_level() method to set.
         is_connected:
@@ -40,16 +77,67 @@ class BLEClient:
             String to hold the request type (ecg, hr, magn imu6, imu6m, imu9) and stop to write null to device 
         hz:
             Integer for the sample rate of each request
+        ring_seconds:
+            If set, the decoded data are written to a preallocated ring buffer per request type holding that many seconds of data,
+            instead of the queue.
+        overflow_policy:
+            The overflow policy of the ring buffers ('drop_oldest' or 'drop_newest'). 'block' is rejected, as waiting
+            for a reader would stall the notification handler.
+        streams:
+            Dictionary with the ring buffer (:class:`buffers.RingBuffer`) of each request type, when ring_seconds is set.
+        subscriptions:
+            Dictionary with the request, hz, active flag, store, timer (:class:`timestamps.StreamTimer`), health
+            (:class:`health.StreamHealth`) and offload packet batch of each reference ID written to the device. Used to route each packet to its
+            decoder by its reference byte.
+        clock:
+            The :class:`timestamps.ClockSync` fit between the sensor clock and the host receive time of the packets.
+        unknown_packets:
+            Number of notifications with a reference ID not written by this client.
+        response_packets:
+            Number of notifications that are not data packets (e.g. command responses), which are not decoded.
+        recorder:
+            A :class:`recorder.PacketRecorder` to append every raw notification to, None to not record.
+        decode:
+            Boolean. If False the notifications are only recorded, with their health counted, and not decoded.
+        session:
+            A :class:`session_store.SessionWriter` the decoded samples are written to, None to not store them.
+        publishers:
+            Dictionary with the :class:`shared_stream.SharedStreamWriter` each request type is published to.
+        offload:
+            A :class:`offload.ProcessOffload` the raw packets are batched to, None to decode in the event loop.
+        batch_packets:
+            The number of packets of a stream sent to the offload at once.
+        disconnect_callbacks:
+            List of functions called with this client when the connection drops without a call to :func:`disconnect`.
+        disconnected_at:
+            The host time in seconds the connection last dropped, None if it did not.
+        gaps:
+            Deque of the :class:`health.StreamGap` markers of the streams broken off by disconnects, the most recent MAX_STREAM_GAPS.
+        packet_count:
+            Number of notifications received.
+        byte_count:
+            Number of notification bytes received.
+        profiler:
+            A :class:`profiling.Profiler` timing the handler, decoder, enqueue and dequeue stages while it is enabled,
+            None to not profile.
         
         TODO: set comments for file storation 
         TODO: Remove file implimentations       
     '''
     # Constractor
-    def __init__(self, device_address = None):
+    def __init__(self, device_address = None, ring_seconds = None, overflow_policy = "drop_oldest", client = None, device = None,
+                 adapter = None):
+        _import_data_path()
         # self.device_address = device_address
+        self.device = device
+        self.adapter = adapter
+        if device_address is None and device is not None:
+            device_address = str(device.address)
         if device_address is not None and is_valid_mac_address(device_address):
             self.device_address = device_address
-            self.client = BleakClient(self.device_address)
+            # A given client object (e.g. simulator.SimulatedBleakClient) is used instead of a BleakClient
+            self.client = client if client is not None else self._bleak_client(device if device is not None else self.device_address)
+            self._watch_disconnect(self.client)
         else:
             self.device_address = None
             self.client = None 
@@ -60,6 +148,30 @@ class BLEClient:
         self.queue = Queue()
         self.case = None
         self.hz = None
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {overflow_policy}")
+        if overflow_policy == "block":
+            raise ValueError("The 'block' overflow policy would stall the notification handler, use 'drop_oldest' or 'drop_newest'.")
+        self.ring_seconds = ring_seconds
+        self.overflow_policy = overflow_policy
+        self.streams = {}
+        self.subscriptions = {}
+        self.clock = ClockSync()
+        self.unknown_packets = 0
+        self.response_packets = 0
+        self.recorder = None
+        self.decode = True
+        self.session = None
+        self.publishers = {}
+        self.offload = None
+        self.batch_packets = 32
+        self.disconnect_callbacks = []
+        self.disconnected_at = None
+        self.gaps = deque(maxlen = MAX_STREAM_GAPS)
+        self._closing = False
+        self.packet_count = 0
+        self.byte_count = 0
+        self.profiler = None
         # # File
         # self.is_stored = False
         # self.file_object = None
@@ -98,6 +210,48 @@ class BLEClient:
         return self.device_address
     
     
+    def set_device(self, device):
+        '''
+        Use a BLEDevice (e.g. cached by :class:`scanner.MovesenseScanner`) for the next connects, so the backend
+        does not look the device up again. The BleakClient is recreated with it when not connected.
+
+        Args:
+            device:
+                The bleak BLEDevice of this client's address.
+
+        Raises:
+            ValueError: The device has another address.
+        '''
+        if self.device_address is not None and str(device.address).upper() != self.device_address.upper():
+            raise ValueError(f"Device {device.address} is not {self.device_address}.")
+        self.device = device
+        if isinstance(self.client, BleakClient) and not self.is_connected:
+            self.client = self._bleak_client(device)
+
+    def _bleak_client(self, address_or_device):
+        kwargs = {'adapter' : self.adapter} if self.adapter is not None else {}
+        return BleakClient(address_or_device, disconnected_callback = self._on_disconnect, **kwargs)
+
+    def _watch_disconnect(self, client):
+        '''
+        Register the disconnect callback on a given client object that takes one (e.g. simulator.SimulatedBleakClient).
+        '''
+        if not isinstance(client, BleakClient) and getattr(client, 'disconnected_callback', False) is None:
+            client.disconnected_callback = self._on_disconnect
+
+    def _on_disconnect(self, client):
+        '''
+        Called by bleak when the connection drops. Resets the connection flags, and if the drop was not asked for
+        by :func:`disconnect` calls the disconnect_callbacks (e.g. of :class:`supervisor.ConnectionSupervisor`).
+        '''
+        self.is_connected = False
+        self.is_notifying = False
+        if self._closing:
+            return
+        self.disconnected_at = time()
+        for callback in list(self.disconnect_callbacks):
+            callback(self)
+
     def set_client(self):
         '''
         Set up the Bleak Client object to the class
@@ -110,7 +264,7 @@ class BLEClient:
         '''
         try:
             if not self.client: 
-                self.client = BleakClient(self.device_address)
+                self.client = self._bleak_client(self.device if self.device is not None else self.device_address)
                 return True
             else:
                 raise ValueError("Client allready set.")
@@ -205,6 +359,7 @@ class BLEClient:
             raise ValueError("No client connected.")
 
         try:
+            self._closing = True
             if self.case != STOP_REQUEST_TYPE:
                 await self.write_characteristic("stop")
                 self.case = STOP_REQUEST_TYPE
@@ -214,6 +369,7 @@ class BLEClient:
 
             if not self.client.is_connected:
                 self.is_connected = self.client.is_connected
+                self.is_notifying = False
                 return True
 
             else:
@@ -221,6 +377,8 @@ class BLEClient:
 
         except Exception as e:
             return ConnectionError(f"Failed to connect: {str(e)}")    
+        finally:
+            self._closing = False
 
 
     async def read_characteristic(self, UUID_char):
@@ -248,10 +406,35 @@ class BLEClient:
         except Exception as e:
             print(f"read_characteristic()_E: {e}")
 
-    async def write_characteristic(self, request = str, hz = int, response = False):
+    def _new_reference(self):
+        '''
+        Find a reference ID for a new subscription. IDs never used by this client are preferred, so that
+        packets still in flight for a stopped subscription are not decoded with the layout of a new one.
+        '''
+        for reference in REFERENCE_IDS:
+            if reference not in self.subscriptions:
+                return reference
+        for reference in REFERENCE_IDS:
+            if not self.subscriptions[reference]['active']:
+                return reference
+        raise ValueError("No free reference ID.")
+
+    def get_reference(self, request : str):
+        '''
+        Returns:
+            The reference ID of the active subscription of a request type, None if not subscribed.
+        '''
+        for reference, subscription in self.subscriptions.items():
+            if subscription['active'] and subscription['request'] == request:
+                return reference
+        return None
+
+    async def write_characteristic(self, request = str, hz = int, response = False, reference = None):
         '''
             Perform a write operation on the specified characteristic to the connected device. Depending on the response can wait for data after the request is made.
-            Validates the given request type and set the case of the request type writen to the remote device.
+            Validates the given request type and subscribes to it with its own reference ID, so that different request types
+            can stream at the same time. Writing a request type already subscribed replaces its subscription.
+            A stop request unsubscribes the given reference, or all the subscriptions if no reference is given.
 
             Args:
                 request:
@@ -260,6 +443,8 @@ class BLEClient:
                     Integer for the wanted sample rate if needed.
                 response:
                     Boolean for the write type. If True, will write the data and then wait for a response (request) else will queue the data to be writen (command).
+                reference:
+                    Integer with the reference ID to stop. Used only by the stop request.
 
             Returns:
                 The data from the response if exists else True if write operation succeeded   
@@ -278,13 +463,39 @@ class BLEClient:
             # Set up request
             path = is_valid_request(request, hz)
             if path:
-                bytearray_rq =  bytearray([1, 99]) + bytearray(path, "utf-8")
+                request = request.lower()
+                if request == HR_REQUEST_TYPE:
+                    hz = None
+                # Replace the subscription of the same request type
+                previous = self.get_reference(request)
+                if previous is not None:
+                    await self._unsubscribe(previous, response)
+                reference = self._new_reference()
+                bytearray_rq =  bytearray([1, reference]) + bytearray(path, "utf-8")
+                store = None
+                if self.ring_seconds:
+                    store = self.streams.get(request)
+                    if store is None or previous is None or self.subscriptions[previous]['hz'] != hz:
+                        store = stream_store(request, hz, self.ring_seconds, self.overflow_policy)
+                    self.streams[request] = store
+                self.subscriptions[reference] = {'request' : request, 'hz' : hz, 'path' : path, 'active' : True, 'store' : store, 'timer' : StreamTimer(hz),
+                                                'health' : StreamHealth(request, hz), 'batch' : [], 'batch_times' : []}
                 self.case = request
                 self.hz = hz
+                self._record_streams()
             elif request.lower() == STOP_REQUEST_TYPE:
-                bytearray_rq = bytearray([2, 99])
-                self.case = STOP_REQUEST_TYPE
-                self.hz = None
+                references = [reference] if reference is not None else [ref for ref, sub in self.subscriptions.items() if sub['active']]
+                if not references:
+                    # Nothing subscribed by this client, stop the default reference
+                    references = [REFERENCE_IDS[0]]
+                for ref in references[:-1]:
+                    await self._unsubscribe(ref, response)
+                bytearray_rq = bytearray([2, references[-1]])
+                if references[-1] in self.subscriptions:
+                    self.subscriptions[references[-1]]['active'] = False
+                active = [sub for sub in self.subscriptions.values() if sub['active']]
+                self.case = active[-1]['request'] if active else STOP_REQUEST_TYPE
+                self.hz = active[-1]['hz'] if active else None
             else:
                 raise NameError("Wrong request.") 
             
@@ -298,6 +509,61 @@ class BLEClient:
 
         except Exception as e:
             print(f"write_characteristic()_E: {e}")
+
+    async def resubscribe(self, response = False):
+        '''
+        Write the active subscriptions again with their reference IDs, e.g. after a reconnect. The streams keep their
+        stores, timers and health counters.
+
+        Returns:
+            list: The reference IDs written.
+
+        Raises:
+            ValueError: No device connection.
+        '''
+        if not self.is_connected:
+            raise ValueError("No device connection.")
+        references = [reference for reference, subscription in self.subscriptions.items() if subscription['active']]
+        for reference in references:
+            path = self.subscriptions[reference]['path']
+            await self.client.write_gatt_char(WRITE_CHARACTERISTIC_UUID, bytearray([1, reference]) + bytearray(path, "utf-8"), response=response)
+        return references
+
+    async def mark_gap(self, start : float, end : float):
+        '''
+        Put a :class:`health.StreamGap` marker in every active stream: in the ring buffer store (see
+        :func:`buffers.RingBuffer.mark_gap`) or the queue, and count it in the stream health.
+
+        Args:
+            start: The host time in seconds the stream broke off.
+            end: The host time in seconds the stream was restored.
+
+        Returns:
+            list: The markers.
+        '''
+        gaps = []
+        for reference, subscription in self.subscriptions.items():
+            if not subscription['active']:
+                continue
+            gap = StreamGap(subscription['request'], reference, start, end)
+            subscription['health'].disconnects += 1
+            subscription['health'].disconnected_s += gap.duration
+            if subscription['store'] is not None:
+                subscription['store'].mark_gap(gap)
+            else:
+                await self.queue.put(gap)
+            gaps.append(gap)
+        self.gaps.extend(gaps)
+        return gaps
+
+    async def _unsubscribe(self, reference : int, response = False):
+        '''
+        Write the stop command of a reference ID and mark its subscription as inactive.
+        The subscription stays in the dispatch table to decode the packets still in flight.
+        '''
+        await self.client.write_gatt_char(WRITE_CHARACTERISTIC_UUID, bytearray([2, reference]), response=response)
+        if reference in self.subscriptions:
+            self.subscriptions[reference]['active'] = False
     
     async def start_notify(self):
         '''
@@ -340,6 +606,7 @@ class BLEClient:
                     if self.is_notifying:
                         await self.client.stop_notify(NOTIFY_CHARACTERISTIC_UUID)
                         self.is_notifying = False
+                        await self.flush_offload()
                         # # Close file if opend
                         # if self.file_object:
                         #     close_csv(self.file_object)
@@ -356,6 +623,234 @@ class BLEClient:
         except Exception as e:
             print(f"stop_notify()_E: {e}")        
     
+    def set_recorder(self, recorder, decode = True):
+        '''
+        Record every raw notification with its host receive time and reference ID.
+
+        Args:
+            recorder:
+                A :class:`recorder.PacketRecorder` (or :class:`recorder.BackgroundRecorder`), or None to stop recording.
+                The request and rate of each reference ID are written to its segment headers.
+            decode:
+                Boolean. If False the notifications are only recorded, saving the decoding time. The clock fit and
+                the health counters, which read the packet headers only, are still updated.
+        '''
+        self.recorder = recorder
+        self.decode = decode
+        self._record_streams()
+
+    def _record_streams(self):
+        '''
+        Write the request and rate of each reference ID to the recorder, so the recording decodes offline.
+        '''
+        if self.recorder is not None:
+            self.recorder.set_streams({reference : (subscription['request'], subscription['hz'])
+                                       for reference, subscription in self.subscriptions.items()})
+
+    def set_session(self, session):
+        '''
+        Write the decoded samples of every stream with their times to a compressed session store,
+        keyed by the device address, request type and reference ID.
+
+        Args:
+            session:
+                A :class:`session_store.SessionWriter`, or None to stop writing.
+        '''
+        self.session = session
+
+    def publish(self, request = None, hz = None, seconds = None, name = None):
+        '''
+        Publish the decoded samples of a request type to a named shared memory ring buffer, which any number of
+        local processes can read without copying through :class:`shared_stream.SharedStreamReader`.
+        The times are the same as the ring buffer stream ones (sensor milliseconds, host seconds for HR).
+
+        Args:
+            request:
+                The request type to publish. The current case if None.
+            hz:
+                The sample rate of the request. The current one if None.
+            seconds:
+                How many seconds of data the shared ring holds. ring_seconds, or 60 if not set.
+            name:
+                The shared memory name. :func:`shared_stream.shared_stream_name` of the device and request if None.
+
+        Returns:
+            str: The shared memory name of the stream.
+
+        Example:
+            >>> name = mv_client.publish("ecg", 512)
+            >>> # in another process
+            >>> reader = SharedStreamReader(name)
+        '''
+        request = (request if request is not None else self.case).lower()
+        hz = hz if hz is not None else self.hz
+        seconds = seconds if seconds is not None else self.ring_seconds or 60
+        rate, width = stream_layout(request, hz)
+        name = name if name is not None else shared_stream_name(self.device_address or "local", request)
+        self.unpublish(request)
+        self.publishers[request] = SharedStreamWriter(name, max(1, ceil(seconds * rate)), np.float32, width, request, hz)
+        return name
+
+    def unpublish(self, request = None):
+        '''
+        Stop publishing a request type (all of them if None) and remove its shared memory.
+        '''
+        requests = list(self.publishers) if request is None else [request.lower()]
+        for request in requests:
+            publisher = self.publishers.pop(request, None)
+            if publisher is not None:
+                publisher.close()
+
+    def set_profiler(self, profiler):
+        '''
+        Time the stages of the data path in a profiler, see :class:`profiling.Profiler`. It only times while
+        enabled, so it can stay set and be switched on when needed.
+
+        Args:
+            profiler: The profiler, None to remove it.
+        '''
+        self.profiler = profiler
+
+    def set_offload(self, offload, batch_packets : int = 32):
+        '''
+        Send the raw packets of the streams in batches to worker processes, so the event loop only receives
+        and enqueues. The results of the batches come back in order from the offload (see :class:`offload.ProcessOffload`).
+
+        Args:
+            offload:
+                A :class:`offload.ProcessOffload`, or None to decode in the event loop again.
+            batch_packets:
+                The number of packets of a stream sent at once.
+        '''
+        self.offload = offload
+        self.batch_packets = batch_packets
+
+    async def flush_offload(self):
+        '''
+        Send the partial packet batches of every stream to the offload.
+        '''
+        if self.offload is None:
+            return
+        for subscription in self.subscriptions.values():
+            if subscription['batch']:
+                packets, times = subscription['batch'], subscription['batch_times']
+                subscription['batch'], subscription['batch_times'] = [], []
+                await self.offload.submit_packets(subscription['request'], packets, times, subscription['hz'])
+
+    def _submit_batch(self, subscription):
+        '''
+        Send the packet batch of a stream to the offload without waiting for a slot, the notification callback must
+        not block. A batch finding every slot in flight is dropped and counted in the health of the stream.
+        '''
+        packets, times = subscription['batch'], subscription['batch_times']
+        subscription['batch'], subscription['batch_times'] = [], []
+        if self.offload.try_submit_packets(subscription['request'], packets, times, subscription['hz']) is None:
+            subscription['health'].dropped_batches += 1
+            subscription['health'].dropped_packets += len(packets)
+
+    def get_stream(self, request = None):
+        '''
+        Get the ring buffer of a request type. Used when the client is created with ring_seconds.
+
+        Args:
+            request:
+                The request type of the stream. The current case if None.
+
+        Returns:
+            The :class:`buffers.RingBuffer` of the stream or None if there is not one.
+        '''
+        return self.streams.get(request if request is not None else self.case)
+
+    def read_stream(self, request = None, count = None):
+        '''
+        Pop samples from the ring buffer of a request type with the host time of each sample, mapped from the
+        sensor time through the clock fit. Used when the client is created with ring_seconds.
+
+        Args:
+            request:
+                The request type of the stream. The current case if None.
+            count:
+                Maximum number of samples to read, None for all.
+
+        Returns:
+            tuple: float64 host times in seconds since the epoch and the samples.
+
+        Raises:
+            ValueError: No stream for the request.
+        '''
+        request = request if request is not None else self.case
+        store = self.get_stream(request)
+        if store is None:
+            raise ValueError(f"No stream for request {request}.")
+        profiler = self.profiler if self.profiler is not None and self.profiler.enabled else None
+        if profiler is not None:
+            started = perf_counter_ns()
+        times, samples = store.read(count)
+        if profiler is not None:
+            profiler.record("dequeue", self.device_address, request, perf_counter_ns() - started)
+        if request == HR_REQUEST_TYPE or len(times) == 0:
+            return np.array(times, dtype = np.float64), samples
+        return self.clock.to_host(times), samples
+
+    async def stream(self, request = None, min_samples : int = 256, max_latency_ms : float = 100, max_samples = None, copy = True):
+        '''
+        Asynchronous iterator over blocks of samples of a request type. A block is yielded as soon as min_samples
+        are available, or when max_latency_ms passed since samples became available, whichever comes first.
+        Real-time consumers can ask for small blocks and a short latency, bulk consumers for large blocks.
+        Used when the client is created with ring_seconds. Stops when notifying stops and the stream is empty.
+
+        Args:
+            request:
+                The request type of the stream. The current case if None.
+            min_samples:
+                The block size that is yielded at once.
+            max_latency_ms:
+                The longest time in milliseconds a sample waits before its block is yielded.
+            max_samples:
+                The maximum samples of a block, None for all the available ones.
+            copy:
+                If False the samples may be views of the ring buffer, valid until the writer wraps around.
+
+        Yields:
+            tuple: float64 host times in seconds and the samples (see :func:`read_stream`).
+
+        Example:
+            >>> async for times, samples in mv_client.stream("ecg", min_samples = 512, max_latency_ms = 50):
+            ...     process(times, samples)
+        '''
+        request = request if request is not None else self.case
+        latency = max_latency_ms / 1000
+        while True:
+            store = self.get_stream(request)
+            if store is None:
+                raise ValueError(f"No stream for request {request}.")
+            if not await store.wait(1, latency):
+                if not self.is_notifying:
+                    return
+                continue
+            await store.wait(min_samples, latency)
+            times, samples = self.read_stream(request, max_samples)
+            yield times, samples.copy() if copy else samples
+
+    def get_health(self):
+        '''
+        Poll the packet loss, gap and jitter counters of the streams, without touching the data path.
+
+        Returns:
+            dict: The summed counters of the device with the snapshot of each reference ID under 'streams',
+            plus the notifications with unknown reference IDs and the ones that are not data packets.
+        '''
+        health = device_health({reference : subscription['health'] for reference, subscription in self.subscriptions.items()})
+        health['unknown_packets'] = self.unknown_packets
+        health['response_packets'] = self.response_packets
+        return health
+
+    def host_times(self, sensor_ms):
+        '''
+        Map sensor times (unwrapped milliseconds, e.g. from :func:`timestamps.expand_timestamps`) to host times in seconds.
+        '''
+        return self.clock.to_host(sensor_ms)
+
     async def empty_queue(self):
         '''
         Emptying the asyncio type queue of the class.
@@ -376,41 +871,127 @@ class BLEClient:
             data:
                 Byte Array with the data to be handled
         '''
-        # Decode data
-        formated_data = self._proccess_data(data)
-        # # Case to store to file
-        # # if self.is_stored and self.file_object:
-        # if self.is_stored:
-        #     if self.case == ECG_REQUEST_TYPE:
-        #         self._write_ecg_data_file(formated_data)
-        #     else:
-        #         self.file_writer.writerow(formated_data)
-        # # Case store to queue
-        # else:
-        #     await self.queue.put(formated_data)
-        await self.queue.put(formated_data)
+        host_time = time_ns()
+        # Switched off the profiling costs this check only
+        profiler = self.profiler if self.profiler is not None and self.profiler.enabled else None
+        if profiler is not None:
+            started = perf_counter_ns()
+        self.packet_count += 1
+        self.byte_count += len(data)
+        # Route the data packets by their reference ID, a command response may carry the reference of a subscription
+        is_data = len(data) > 1 and data[0] == DATA_PACKET_TYPE
+        subscription = self.subscriptions.get(data[1]) if is_data else None
+        case = subscription['request'] if subscription else None
+        try:
+            # Lossless raw recording before any decoding
+            if self.recorder is not None:
+                self.recorder.write(data, sensor_timestamp = packet_timestamp(case, data), host_time = host_time)
+            if not is_data:
+                self.response_packets += 1
+                return
+            if subscription is None:
+                self.unknown_packets += 1
+                return
+            if case == TEMP_REQUEST_TYPE and len(data) != 10:
+                return
+            host_s = host_time / 1e9
+            count = packet_samples(case, data)
+            timestamp = None
+            if case != HR_REQUEST_TYPE:
+                timestamp = subscription['timer'].unwrapper.unwrap(packet_timestamp(case, data))
+                self.clock.update(timestamp, host_s)
+            # The headers only, so the clock fit and the health counters also run when only recording
+            subscription['health'].update(timestamp, host_s, count)
+            if not self.decode:
+                return
+            # Decoding and processing in the worker processes
+            if self.offload is not None:
+                subscription['batch'].append(bytes(data))
+                subscription['batch_times'].append(host_s if timestamp is None else timestamp)
+                if len(subscription['batch']) >= self.batch_packets:
+                    if profiler is not None:
+                        stage = perf_counter_ns()
+                    self._submit_batch(subscription)
+                    if profiler is not None:
+                        profiler.record("enqueue", self.device_address, case, perf_counter_ns() - stage)
+                return
+            # Ring buffer stream store, shared memory publisher and session store with the time of each sample
+            publisher = self.publishers.get(case)
+            if subscription['store'] is not None or publisher is not None or self.session is not None:
+                if profiler is not None:
+                    stage = perf_counter_ns()
+                timestamps, samples = decode_samples(case, [data])
+                if profiler is not None:
+                    profiler.record("decode", self.device_address, case, perf_counter_ns() - stage)
+                if case == HR_REQUEST_TYPE:
+                    times = host_s
+                else:
+                    times = subscription['timer'].sample_times_from(timestamp, len(samples))
+                if publisher is not None:
+                    publisher.write(times, samples)
+                if self.session is not None:
+                    self.session.write(self.device_address, case, data[1], times, samples, subscription['hz'])
+                if subscription['store'] is not None:
+                    if profiler is not None:
+                        stage = perf_counter_ns()
+                    subscription['store'].write(times, samples)
+                    if profiler is not None:
+                        profiler.record("enqueue", self.device_address, case, perf_counter_ns() - stage)
+                    return
+            # Decode data
+            if profiler is not None:
+                stage = perf_counter_ns()
+            formated_data = self._proccess_data(data, case)
+            if profiler is not None:
+                profiler.record("decode", self.device_address, case, perf_counter_ns() - stage)
+            # # Case to store to file
+            # # if self.is_stored and self.file_object:
+            # if self.is_stored:
+            #     if self.case == ECG_REQUEST_TYPE:
+            #         self._write_ecg_data_file(formated_data)
+            #     else:
+            #         self.file_writer.writerow(formated_data)
+            # # Case store to queue
+            # else:
+            #     await self.queue.put(formated_data)
+            if formated_data is not None:
+                if profiler is not None:
+                    stage = perf_counter_ns()
+                await self.queue.put(formated_data)
+                if profiler is not None:
+                    profiler.record("enqueue", self.device_address, case, perf_counter_ns() - stage)
+        finally:
+            if profiler is not None:
+                stream = case if case is not None else "unknown"
+                profiler.count(self.device_address, stream, len(data))
+                profiler.record("handler", self.device_address, stream, perf_counter_ns() - started)
     
-    def _proccess_data(self, data):
+    def _proccess_data(self, data, case = None):
         '''
-        Check the current request case and decode given data
+        Check the request case and decode given data
 
         Args:
             data:
                 Byte Array containg the data to be decoded
+            case:
+                The request type of the data. The current case if None.
 
         Returns:
             formated_data:
                 The decoded data. 
         '''
+        if case is None:
+            case = self.case
+        formated_data = None
         # Temperature
-        if self.case == TEMP_REQUEST_TYPE:
+        if case == TEMP_REQUEST_TYPE:
             if len(data) == 10:
                 formated_data = self._temp_data_handler(data)
         # Heart rate and RR interval
-        elif self.case == HR_REQUEST_TYPE:
+        elif case == HR_REQUEST_TYPE:
             formated_data = self._hr_data_handler(data)
         # ECG 
-        elif self.case == ECG_REQUEST_TYPE:
+        elif case == ECG_REQUEST_TYPE:
             formated_data = self._ecg_data_handler(data)
         # MAGI format
         else:
@@ -418,6 +999,7 @@ class BLEClient:
         
         return formated_data
     
+    @staticmethod
     def _magi_data_handler(data : bytearray):
         '''
         Takes a byte array and reads its length. The lenght will be a multiple of 3 plus 6.
@@ -436,15 +1018,10 @@ class BLEClient:
             >>> magi_data_handler(data)
             (123, 1.25, 12.4, -2.01)
         '''
-        timestamp = struct.unpack('<I', data[2:6])[0]
-        x = [timestamp]
-        # To access its x,y,z for each sample
-        for index in range( int( (len(data) - 6) / 4) ):
-            start = index * 4 + 6
-            end = index * 4 + 10
-            x.append(struct.unpack('<f', data[start:end])[0])  
-        return x
+        # One unpack call for the timestamp and all the floats, no slice copies
+        return list(struct.unpack_from('<I%df' % ((len(data) - 6) // 4), data, 2))
 
+    @staticmethod
     def _ecg_data_handler(data : bytearray):
         '''
         Unpack a bytearray to timestamp (bytes 2:6) and to 16 samples of 4 bytes (bytes 6:70)
@@ -463,14 +1040,10 @@ class BLEClient:
             >>> ecg_data_handler(data)
             (123, s1, ..., s16)
         '''
-        timestamp = struct.unpack('<I', data[2:6])[0]
-        x = [timestamp]
-        # To access its x,y,z for each sample
-        for index in range(16):
-            sample = VOLTS_PER_LSB * struct.unpack('<i', data[(index*4 + 6):(index*4 + 10)])[0]
-            x.append(sample)
-        return x
+        timestamp, *samples = _ECG_STRUCT.unpack_from(data, 2)
+        return [timestamp] + [VOLTS_PER_LSB * sample for sample in samples]
 
+    @staticmethod
     def _hr_data_handler(data : bytearray):
         '''
         Unpack a bytearray to average beat rate (bytes 2:6) and to interval between beats rates (RR-interval)
@@ -493,6 +1066,7 @@ class BLEClient:
         RR_interval = struct.unpack('<H', data[6:8])[0]
         return [heart_rate, RR_interval]
 
+    @staticmethod
     def _temp_data_handler(data : bytearray):
         '''
         Unpack a bytearray to timestamp (bytes 2:6) and to internal devise temperature (bytes 6:10).
@@ -0,0 +1,272 @@
+"""
+Module Name: movesense_record.py
+Description: Command line recording of the raw notifications of many movesense devices.
+
+The devices are given by address, each with its own request and rate, or found with a scan filter. They are
+connected and subscribed concurrently through a :class:`fleet.MovesenseFleet` and every raw notification is
+recorded losslessly with a :class:`recorder.BackgroundRecorder` per device, all of them written by one
+:class:`recorder.WriterThread` in large batches, so the event loop never waits on the disk. A throughput and
+packet loss summary is printed while recording. The recording stops after the duration or on SIGINT / SIGTERM,
+then every device stops notifying and is disconnected and the last packets are written.
+
+The recording directory holds the segments of each device (prefix: the address without colons, see
+:class:`recorder.RecordingReader`) and recording.json with the request, rate and reference IDs of each device.
+
+Run from the repository root with:
+    python movesense_record.py --device 0C:8C:DC:41:DB:EB=ecg/512 --device 0C:8C:DC:41:DB:EC=imu9/208 --duration 600
+    python movesense_record.py --scan 2234 --request imu9 --hz 104 --output recordings/walk
+"""
+
+import argparse
+import asyncio
+import json
+import signal
+import sys
+from datetime import datetime, timezone
+from functools import partial
+from os import makedirs
+from os.path import join
+from time import monotonic
+from constants import HR_REQUEST_TYPE
+from util_fun import is_valid_mac_address, is_valid_request
+
+# The addresses the simulated scanner advertises with --simulate
+SIMULATED_ADDRESSES = ["00:00:00:00:00:01", "00:00:00:00:00:02", "00:00:00:00:00:03"]
+
+
+def parse_device(spec : str, request : str, hz = None):
+    '''
+    Read a device spec ADDRESS[=REQUEST[/HZ]], the request and rate defaulting to the given ones.
+
+    Returns:
+        tuple: The address and the (request, hz) pair.
+
+    Raises:
+        ValueError: Invalid address, request or rate.
+
+    Example:
+        >>> parse_device("0C:8C:DC:41:DB:EB=imu9/208", "ecg", 512)
+        ('0C:8C:DC:41:DB:EB', ('imu9', 208))
+    '''
+    address, _, stream = spec.partition("=")
+    address = address.strip().upper()
+    if not is_valid_mac_address(address):
+        raise ValueError(f"Invalid address: {address}")
+    if stream:
+        request, _, rate = stream.partition("/")
+        hz = int(rate) if rate else None
+    request = request.lower()
+    if request == HR_REQUEST_TYPE:
+        hz = None
+    if not is_valid_request(request, hz):
+        raise ValueError(f"Invalid request for {address}: {request}/{hz}")
+    return address, (request, hz)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog = "movesense_record.py", description = "Record the raw notifications of movesense devices.")
+    devices = parser.add_argument_group("devices")
+    devices.add_argument("--device", action = "append", default = [], metavar = "ADDRESS[=REQUEST[/HZ]]",
+                         help = "a device to record, with its own request and rate (repeatable)")
+    devices.add_argument("--scan", nargs = "?", const = "", metavar = "FILTER",
+                         help = "record the advertising devices whose address, name or serial contains FILTER")
+    devices.add_argument("--scan-timeout", type = float, default = 5.0, help = "seconds to scan for (default 5)")
+    devices.add_argument("--max-devices", type = int, default = None, help = "the most scanned devices to record")
+    parser.add_argument("--request", default = "ecg", help = "the request of the devices without one (default ecg)")
+    parser.add_argument("--hz", type = int, default = 512, help = "the rate of the devices without one (default 512)")
+    parser.add_argument("--duration", type = float, default = None, help = "seconds to record, until a signal if not given")
+    parser.add_argument("--output", default = None, help = "the recording directory (default recordings/<UTC time>)")
+    parser.add_argument("--interval", type = float, default = 5.0, help = "seconds between the summaries (default 5)")
+    parser.add_argument("--quiet", action = "store_true", help = "print no summaries while recording")
+    parser.add_argument("--max-connects", type = int, default = 4, help = "connects running at the same time (default 4)")
+    parser.add_argument("--batch-packets", type = int, default = 1024, help = "packets per disk write of a device (default 1024)")
+    parser.add_argument("--segment-mb", type = int, default = 64, help = "size of the recording segments in MB (default 64)")
+    parser.add_argument("--simulate", action = "store_true", help = "record simulated devices instead of hardware")
+    return parser
+
+
+async def find_devices(args, scanner_factory):
+    '''
+    Scan for args.scan_timeout seconds.
+
+    Returns:
+        tuple: The running :class:`scanner.MovesenseScanner` and the addresses matching the filter, strongest first.
+    '''
+    from scanner import MovesenseScanner
+    scanner = MovesenseScanner(ttl = max(60.0, args.scan_timeout), scanner_factory = scanner_factory)
+    await scanner.start()
+    await asyncio.sleep(args.scan_timeout)
+    pattern = args.scan.upper()
+    addresses = [entry.address.upper() for entry in scanner.devices()
+                 if pattern in entry.address.upper() or pattern in str(entry.name).upper()]
+    return scanner, addresses[:args.max_devices] if args.max_devices is not None else addresses
+
+
+def summary(fleet, recorders : dict, writer, elapsed : float, previous : dict, interval : float):
+    '''
+    Returns:
+        str: A line of the recording totals and a line per device with its packet and byte rates over the last
+        interval and its lost packets.
+    '''
+    written = sum(recorder.bytes for recorder in recorders.values())
+    lines = [f"[{elapsed:8.1f} s] {sum(client.is_notifying for client in fleet.clients.values())}/{len(fleet)} notifying"
+             f"  {written / 1e6:9.2f} MB recorded  writer backlog {writer.backlog()}"]
+    for address, client in fleet.clients.items():
+        health = client.get_health()
+        packets, size = client.packet_count, client.byte_count
+        last_packets, last_size = previous.get(address, (0, 0))
+        previous[address] = (packets, size)
+        stream = f"{client.case}/{client.hz}" if client.hz else str(client.case)
+        lines.append(f"  {address}  {stream:<10} {(packets - last_packets) / interval:8.1f} pkt/s"
+                     f" {(size - last_size) / interval / 1e3:8.1f} kB/s  lost {health['lost']} ({100 * health['loss_rate']:.2f} %)")
+    return "\n".join(lines)
+
+
+def metadata(fleet, requests : dict, started : datetime, stopped = None):
+    '''
+    Returns:
+        dict: The recording description written to recording.json.
+    '''
+    devices = {}
+    for address, client in fleet.clients.items():
+        request, hz = requests[address]
+        devices[address] = {
+            'request' : request, 'hz' : hz, 'prefix' : address.replace(":", ""),
+            'references' : {str(reference) : {'request' : subscription['request'], 'hz' : subscription['hz']}
+                            for reference, subscription in client.subscriptions.items()},
+            'packets' : client.packet_count, 'bytes' : client.byte_count,
+            'error' : repr(fleet.errors[address]) if address in fleet.errors else None,
+        }
+        if stopped is not None:
+            health = client.get_health()
+            devices[address]['health'] = {key : health[key] for key in ('packets', 'lost', 'duplicates', 'out_of_order', 'loss_rate')}
+    return {'started' : started.isoformat(), 'stopped' : stopped.isoformat() if stopped is not None else None, 'devices' : devices}
+
+
+def _write_metadata(path : str, content : dict):
+    with open(path, "w") as file:
+        json.dump(content, file, indent = 2)
+
+
+async def record(args):
+    '''
+    Record until the duration passed or a signal arrived.
+
+    Returns:
+        int: The exit status, 0 if recorded, 1 if no device started.
+    '''
+    from fleet import MovesenseFleet
+    from movesense_class import BLEClient
+    from recorder import PacketRecorder, BackgroundRecorder, WriterThread
+    client_factory, scanner_factory = BLEClient, None
+    if args.simulate:
+        from simulator import simulated_ble_client, SimulatedBleakScanner
+        client_factory = partial(simulated_ble_client, speed = 1)
+        scanner_factory = partial(SimulatedBleakScanner, addresses = SIMULATED_ADDRESSES)
+    elif args.scan is not None:
+        from bleak import BleakScanner
+        scanner_factory = BleakScanner
+
+    requests = dict(parse_device(spec, args.request, args.hz) for spec in args.device)
+    scanner = None
+    if args.scan is not None:
+        scanner, found = await find_devices(args, scanner_factory)
+        print(f"Found {len(found)} devices: {', '.join(found)}")
+        for address in found:
+            requests.setdefault(address, parse_device(address, args.request, args.hz)[1])
+    if not requests:
+        print("No devices to record.", file = sys.stderr)
+        if scanner is not None:
+            await scanner.stop()
+        return 1
+
+    started_at = datetime.now(timezone.utc)
+    output = args.output or join("recordings", started_at.strftime("%Y%m%dT%H%M%SZ"))
+    makedirs(output, exist_ok = True)
+    fleet = MovesenseFleet(list(requests), args.max_connects, client_factory = client_factory, scanner = scanner)
+    writer = WriterThread()
+    recorders = {}
+    for address, client in fleet.clients.items():
+        recorders[address] = BackgroundRecorder(PacketRecorder(output, address.replace(":", ""), args.segment_mb * 1024 * 1024),
+                                                writer, args.batch_packets)
+        client.set_recorder(recorders[address], decode = False)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signal_number, stop.set)
+        except (NotImplementedError, RuntimeError, ValueError):
+            # Windows event loops have no signal handlers
+            signal.signal(signal_number, lambda *_: loop.call_soon_threadsafe(stop.set))
+
+    status = 0
+    try:
+        started = await fleet.start(requests)
+        if scanner is not None:
+            await scanner.stop()
+        for address, error in fleet.errors.items():
+            print(f"{address} failed to start: {error!r}", file = sys.stderr)
+        if not started:
+            status = 1
+            return status
+        print(f"Recording {len(started)} devices to {output}" + (f" for {args.duration:g} s" if args.duration else ", Ctrl+C to stop"))
+        _write_metadata(join(output, "recording.json"), metadata(fleet, requests, started_at))
+        start = monotonic()
+        deadline = start + args.duration if args.duration else None
+        previous = {}
+        last = start
+        while not stop.is_set():
+            timeout = args.interval if deadline is None else min(args.interval, deadline - monotonic())
+            if timeout > 0:
+                try:
+                    await asyncio.wait_for(stop.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            now = monotonic()
+            if not args.quiet and now - last > 0:
+                print(summary(fleet, recorders, writer, now - start, previous, now - last), flush = True)
+            # The slow streams reach the disk at least every interval
+            for recorder in recorders.values():
+                recorder.flush()
+            last = now
+            if deadline is not None and now >= deadline:
+                break
+    finally:
+        print("Stopping and disconnecting...", flush = True)
+        failed = await fleet.stop()
+        for address in failed:
+            print(f"{address} failed to stop: {fleet.errors[address]!r}", file = sys.stderr)
+        for recorder in recorders.values():
+            recorder.close()
+        await loop.run_in_executor(None, writer.close)
+        if scanner is not None:
+            await scanner.stop()
+        _write_metadata(join(output, "recording.json"), metadata(fleet, requests, started_at, datetime.now(timezone.utc)))
+        if writer.error is not None:
+            print(f"Writing failed: {writer.error!r}", file = sys.stderr)
+            status = 1
+        packets = sum(recorder.packets for recorder in recorders.values())
+        print(f"Recorded {packets} packets ({sum(recorder.bytes for recorder in recorders.values()) / 1e6:.2f} MB) to {output}")
+    return status
+
+
+def main(argv = None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if not args.device and args.scan is None and not args.simulate:
+        parser.error("give --device, --scan or --simulate")
+    if args.simulate and not args.device and args.scan is None:
+        args.scan = ""
+    try:
+        for spec in args.device:
+            parse_device(spec, args.request, args.hz)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.interval <= 0:
+        parser.error("--interval must be positive")
+    return asyncio.run(record(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,264 @@
+"""
+Module Name: offload.py
+Description: Offload of the heavy stream processing from the BLE event loop to a pool of worker processes.
+
+The event loop that services bleak only copies the raw packets (or finished sample blocks) into a free
+shared memory slot and submits its layout, so no large array is pickled. A worker attaches to the slot,
+decodes and runs the user function on views of it, and the results come back in submission order.
+"""
+
+import asyncio
+from collections import deque, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from os import cpu_count
+import numpy as np
+from decoder import decode_samples
+from timestamps import expand_timestamps
+
+# Shared memory segments a worker keeps attached
+_ATTACHED_LIMIT = 64
+_attached = OrderedDict()
+
+
+def _attach(name : str):
+    '''
+    Attach (once per worker) to a shared memory slot of the parent.
+    '''
+    segment = _attached.get(name)
+    if segment is None:
+        segment = _attached[name] = shared_memory.SharedMemory(name = name)
+        # Slots replaced by larger ones are not used again
+        while len(_attached) > _ATTACHED_LIMIT:
+            try:
+                _attached.popitem(last = False)[1].close()
+            except BufferError:
+                pass
+    return segment
+
+
+def _view(buffer, layout):
+    offset, dtype, shape = layout
+    return np.ndarray(shape, dtype = dtype, buffer = buffer, offset = offset)
+
+
+def _run_block(function, name : str, layouts, args):
+    buffer = _attach(name).buf
+    return function(*(_view(buffer, layout) for layout in layouts), *args)
+
+
+def _run_packets(function, name : str, request : str, hz, packets, times_layout, args):
+    buffer = _attach(name).buf
+    offset, size, packet_size = packets
+    packet_times = _view(buffer, times_layout)
+    timestamps, samples = decode_samples(request, buffer[offset:offset + size], packet_size)
+    per_packet = len(samples) // len(packet_times) if len(packet_times) else 0
+    if hz and per_packet > 1:
+        times = expand_timestamps(packet_times, per_packet, hz)
+    else:
+        times = packet_times.repeat(per_packet)
+    return function(times, samples, *args)
+
+
+class ProcessOffload:
+    '''
+    Runs a function on blocks of stream data in a pool of worker processes, through reused shared memory slots.
+    At most one block per slot is in flight, so submitting waits for a free slot when the workers fall behind,
+    and :func:`try_submit_packets` returns None instead of waiting (for the BLE notification callback).
+
+    Args:
+        function:
+            A module level (picklable) function called in a worker as function(times, samples, *args),
+            or with the submitted arrays for :func:`submit`. Its arguments are views of shared memory
+            valid only during the call, so it must return what it keeps.
+        workers:
+            Number of worker processes, the number of CPUs if None.
+        slots:
+            Number of shared memory slots (blocks in flight), twice the workers if None.
+        slot_size:
+            The initial size in bytes of a slot. A slot grows to fit a larger block.
+        args:
+            Extra arguments passed to the function.
+        submitted:
+            Number of blocks submitted.
+        completed:
+            Number of results returned in order.
+
+    Example:
+        >>> offload = ProcessOffload(analyze, workers = 4)
+        >>> mv_client.set_offload(offload, batch_packets = 64)
+        >>> async for result in offload.results():
+        ...     print(result)
+    '''
+    def __init__(self, function, workers = None, slots = None, slot_size : int = 1 << 20, args = ()):
+        self.function = function
+        self.workers = workers if workers is not None else cpu_count() or 1
+        self.args = tuple(args)
+        self.executor = ProcessPoolExecutor(self.workers)
+        slots = slots if slots is not None else 2 * self.workers
+        self._slots = [shared_memory.SharedMemory(create = True, size = slot_size) for _ in range(slots)]
+        self._free = deque(range(slots))
+        self._waiters = deque()
+        self._pending = deque()
+        self.submitted = 0
+        self.completed = 0
+
+    def __len__(self):
+        return len(self._pending)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _take(self, size : int):
+        '''
+        Take a free slot of at least size bytes without waiting, None if every slot is in flight.
+        '''
+        if not self._free:
+            return None
+        index = self._free.popleft()
+        slot = self._slots[index]
+        if slot.size < size:
+            # The old slot is free, so no worker is reading it
+            slot.close()
+            slot.unlink()
+            slot = self._slots[index] = shared_memory.SharedMemory(create = True, size = 1 << (size - 1).bit_length())
+        return index, slot
+
+    async def _acquire(self, size : int):
+        taken = self._take(size)
+        while taken is None:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            await waiter
+            taken = self._take(size)
+        return taken
+
+    def _release(self, index : int):
+        self._free.append(index)
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+
+    def _submit(self, index : int, runner, *args):
+        future = asyncio.get_running_loop().run_in_executor(self.executor, runner, self.function, self._slots[index].name, *args, self.args)
+        future.add_done_callback(lambda _: self._release(index))
+        self._pending.append(future)
+        self.submitted += 1
+        return future
+
+    @staticmethod
+    def _layout(arrays):
+        layouts, offset = [], 0
+        for array in arrays:
+            # 8 byte aligned arrays
+            offset = (offset + 7) & ~7
+            layouts.append((offset, array.dtype.str, array.shape))
+            offset += array.nbytes
+        return layouts, offset
+
+    async def submit(self, *arrays):
+        '''
+        Copy arrays (e.g. the times and samples of a :func:`movesense_class.BLEClient.stream` block) to a slot
+        and run function(*arrays, *args) on them in a worker.
+
+        Returns:
+            asyncio.Future: The result of the block. Results are also returned in order by :func:`results`.
+        '''
+        arrays = [np.ascontiguousarray(array) for array in arrays]
+        layouts, size = self._layout(arrays)
+        index, slot = await self._acquire(size)
+        for array, layout in zip(arrays, layouts):
+            _view(slot.buf, layout)[...] = array
+        return self._submit(index, _run_block, layouts)
+
+    async def submit_packets(self, request : str, packets, packet_times, hz = None):
+        '''
+        Copy raw packets of one stream to a slot and decode them in a worker, which runs function(times, samples, *args)
+        with the samples of :func:`decoder.decode_samples` and the time of each sample.
+
+        Args:
+            request: The request type of the packets.
+            packets: A list of equally sized raw packets.
+            packet_times: The time of each packet (unwrapped sensor milliseconds, host seconds for HR).
+            hz: The sample rate, to spread the samples of a packet after its time.
+
+        Returns:
+            asyncio.Future: The result of the batch.
+        '''
+        layout = self._packet_layout(packets, packet_times)
+        index, slot = await self._acquire(layout[-1])
+        return self._submit_packets(index, slot, request, hz, layout)
+
+    def try_submit_packets(self, request : str, packets, packet_times, hz = None):
+        '''
+        :func:`submit_packets` without waiting, for callers that must not block such as the BLE notification callback.
+
+        Returns:
+            asyncio.Future: The result of the batch, None if every slot is in flight and the batch was not submitted.
+        '''
+        if not self._free:
+            return None
+        layout = self._packet_layout(packets, packet_times)
+        index, slot = self._take(layout[-1])
+        return self._submit_packets(index, slot, request, hz, layout)
+
+    def _packet_layout(self, packets, packet_times):
+        data = b''.join(packets)
+        packet_times = np.asarray(packet_times, dtype = np.float64)
+        (times_layout,), times_size = self._layout([packet_times])
+        offset = (times_size + 7) & ~7
+        # The packets of a batch are equally sized, the MAGI decoder needs the size to split them
+        packet_size = len(packets[0]) if len(packets) else 0
+        return data, packet_times, times_layout, offset, packet_size, offset + len(data)
+
+    def _submit_packets(self, index : int, slot, request : str, hz, layout):
+        data, packet_times, times_layout, offset, packet_size, _ = layout
+        _view(slot.buf, times_layout)[...] = packet_times
+        slot.buf[offset:offset + len(data)] = data
+        return self._submit(index, _run_packets, request, hz, (offset, len(data), packet_size), times_layout)
+
+    async def next_result(self):
+        '''
+        Wait for the result of the oldest submitted block.
+
+        Raises:
+            IndexError: Nothing submitted.
+            Exception: The exception raised by the function in the worker.
+        '''
+        future = self._pending.popleft()
+        result = await future
+        self.completed += 1
+        return result
+
+    def ready(self):
+        '''
+        Returns:
+            list: The finished results in order, up to the first block still running, without waiting.
+        '''
+        results = []
+        while self._pending and self._pending[0].done():
+            results.append(self._pending.popleft().result())
+            self.completed += 1
+        return results
+
+    async def results(self):
+        '''
+        Asynchronous iterator over the results in submission order, until nothing is pending.
+        '''
+        while self._pending:
+            yield await self.next_result()
+
+    def close(self):
+        '''
+        Wait for the workers to finish and free the shared memory slots.
+        '''
+        self.executor.shutdown(wait = True)
+        for slot in self._slots:
+            slot.close()
+            slot.unlink()
+        self._slots = []
@@ -0,0 +1,295 @@
+"""
+Module Name: orientation.py
+Description: Batched orientation estimation (quaternions) for the IMU streams of many devices at once.
+
+The samples of all the devices are stacked and the Madgwick gradient descent filter steps through time
+once for all of them with NumPy, so adding devices costs little extra. Acc+magn (imu6m) has no gyroscope
+and its orientation is computed directly from gravity and the magnetic field for the whole block.
+Gyroscope bias and magnetometer calibration are kept per device address and can be saved to a JSON file.
+"""
+
+import json
+from os.path import exists
+import numpy as np
+from constants import MAGI_SENSORS
+
+GRAVITY = 9.81
+DEG_TO_RAD = np.pi / 180.0
+
+
+def split_imu(samples, request : str):
+    '''
+    Split MAGI samples into an (N, 3) array per sensor.
+
+    Args:
+        samples: The (N, 3 * sensors) samples of :func:`decoder.decode_samples` or of the ring buffer stream.
+        request: The MAGI request type of the samples.
+
+    Returns:
+        dict: The xyz samples of each sensor ('acc', 'gyro', 'magn').
+
+    Example:
+        >>> split_imu(samples, "imu9")['gyro'].shape
+        (N, 3)
+    '''
+    sensors = MAGI_SENSORS[request.lower()]
+    samples = np.asarray(samples).reshape(-1, 3 * len(sensors))
+    return {sensor : samples[:, 3 * index:3 * index + 3] for index, sensor in enumerate(sensors)}
+
+
+class ImuCalibration:
+    '''
+    Calibration state of one device.
+
+    Args:
+        gyro_bias:
+            The gyroscope bias in deg/s, learned while the device is still.
+        mag_min, mag_max:
+            The smallest and largest magnetometer reading of each axis, giving the hard iron offset and
+            the (diagonal) soft iron scale.
+        alpha:
+            The weight of one still sample in the bias average.
+    '''
+    def __init__(self, gyro_bias = None, mag_min = None, mag_max = None, alpha : float = 0.01):
+        self.gyro_bias = np.zeros(3) if gyro_bias is None else np.asarray(gyro_bias, dtype = np.float64)
+        self.mag_min = None if mag_min is None else np.asarray(mag_min, dtype = np.float64)
+        self.mag_max = None if mag_max is None else np.asarray(mag_max, dtype = np.float64)
+        self.alpha = alpha
+
+    def update_gyro(self, gyro, acc = None, threshold : float = 3.0):
+        '''
+        Learn the gyroscope bias from the samples taken while still (small rotation and, if given, only gravity).
+        '''
+        still = np.linalg.norm(gyro - self.gyro_bias, axis = 1) < threshold
+        if acc is not None:
+            still &= np.abs(np.linalg.norm(acc, axis = 1) - GRAVITY) < 0.5
+        count = int(still.sum())
+        if count:
+            weight = 1.0 - (1.0 - self.alpha) ** count
+            self.gyro_bias = (1.0 - weight) * self.gyro_bias + weight * gyro[still].mean(axis = 0)
+
+    def update_magn(self, magn):
+        if not len(magn):
+            return
+        low, high = magn.min(axis = 0), magn.max(axis = 0)
+        self.mag_min = low if self.mag_min is None else np.minimum(self.mag_min, low)
+        self.mag_max = high if self.mag_max is None else np.maximum(self.mag_max, high)
+
+    def correct_gyro(self, gyro):
+        return gyro - self.gyro_bias
+
+    def correct_magn(self, magn, min_range : float = 20.0):
+        '''
+        Remove the hard iron offset and scale the axes to the same radius, once each axis has seen min_range µT.
+        '''
+        if self.mag_min is None:
+            return magn
+        ranges = self.mag_max - self.mag_min
+        if np.any(ranges < min_range):
+            return magn
+        radius = ranges / 2
+        return (magn - (self.mag_max + self.mag_min) / 2) * (radius.mean() / radius)
+
+    def to_dict(self):
+        return {'gyro_bias' : self.gyro_bias.tolist(),
+                'mag_min' : None if self.mag_min is None else self.mag_min.tolist(),
+                'mag_max' : None if self.mag_max is None else self.mag_max.tolist()}
+
+
+class CalibrationStore:
+    '''
+    The calibrations of many devices by address, kept in a JSON file.
+
+    Args:
+        path:
+            The JSON file. Loaded if it exists.
+        calibrations:
+            Dictionary with the :class:`ImuCalibration` of each address.
+    '''
+    def __init__(self, path = None):
+        self.path = path
+        self.calibrations = {}
+        if path is not None and exists(path):
+            with open(path) as file:
+                for address, values in json.load(file).items():
+                    self.calibrations[address] = ImuCalibration(**values)
+
+    def get(self, address : str):
+        if address not in self.calibrations:
+            self.calibrations[address] = ImuCalibration()
+        return self.calibrations[address]
+
+    def save(self, path = None):
+        path = path if path is not None else self.path
+        if path is None:
+            raise ValueError("No calibration file given.")
+        with open(path, "w") as file:
+            json.dump({address : calibration.to_dict() for address, calibration in self.calibrations.items()}, file, indent = 2)
+
+
+def _normalize(vectors):
+    norm = np.linalg.norm(vectors, axis = -1, keepdims = True)
+    return np.divide(vectors, norm, out = np.zeros_like(vectors), where = norm > 0)
+
+
+def _quaternion_multiply(a, b):
+    w1, x1, y1, z1 = np.moveaxis(a, -1, 0)
+    w2, x2, y2, z2 = np.moveaxis(b, -1, 0)
+    return np.stack((w1 * w2 - x1 * x2 - y1 * y2 - z1 * z2,
+                     w1 * x2 + x1 * w2 + y1 * z2 - z1 * y2,
+                     w1 * y2 - x1 * z2 + y1 * w2 + z1 * x2,
+                     w1 * z2 + x1 * y2 - y1 * x2 + z1 * w2), axis = -1)
+
+
+def madgwick_step(q, gyro, acc, magn = None, beta : float = 0.1, dt : float = 0.01):
+    '''
+    One Madgwick filter step for D devices at once.
+
+    Args:
+        q: The (D, 4) quaternions [w, x, y, z].
+        gyro: The (D, 3) rotation rates in rad/s.
+        acc: The (D, 3) accelerations (any unit).
+        magn: The (D, 3) magnetic fields (any unit), None for the 6 axis filter.
+        beta: The gain of the gradient correction.
+        dt: The sample period in seconds.
+
+    Returns:
+        np.ndarray: The (D, 4) updated quaternions.
+    '''
+    q0, q1, q2, q3 = q.T
+    a = _normalize(acc)
+    # Gravity objective and Jacobian
+    f = np.stack((2 * (q1 * q3 - q0 * q2) - a[:, 0],
+                  2 * (q0 * q1 + q2 * q3) - a[:, 1],
+                  2 * (0.5 - q1 * q1 - q2 * q2) - a[:, 2]), axis = 1)
+    zero = np.zeros_like(q0)
+    J = np.stack((np.stack((-2 * q2, 2 * q3, -2 * q0, 2 * q1), axis = 1),
+                  np.stack((2 * q1, 2 * q0, 2 * q3, 2 * q2), axis = 1),
+                  np.stack((zero, -4 * q1, -4 * q2, zero), axis = 1)), axis = 1)
+    gradient = np.einsum('dij,di->dj', J, f)
+    if magn is not None:
+        m = _normalize(magn)
+        # Earth field reference from the measured field rotated to the earth frame
+        h = _quaternion_multiply(_quaternion_multiply(q, np.concatenate((zero[:, None], m), axis = 1)), q * [1, -1, -1, -1])
+        bx, bz = np.hypot(h[:, 1], h[:, 2]), h[:, 3]
+        f = np.stack((2 * bx * (0.5 - q2 * q2 - q3 * q3) + 2 * bz * (q1 * q3 - q0 * q2) - m[:, 0],
+                      2 * bx * (q1 * q2 - q0 * q3) + 2 * bz * (q0 * q1 + q2 * q3) - m[:, 1],
+                      2 * bx * (q0 * q2 + q1 * q3) + 2 * bz * (0.5 - q1 * q1 - q2 * q2) - m[:, 2]), axis = 1)
+        J = np.stack((np.stack((-2 * bz * q2, 2 * bz * q3, -4 * bx * q2 - 2 * bz * q0, -4 * bx * q3 + 2 * bz * q1), axis = 1),
+                      np.stack((-2 * bx * q3 + 2 * bz * q1, 2 * bx * q2 + 2 * bz * q0, 2 * bx * q1 + 2 * bz * q3, -2 * bx * q0 + 2 * bz * q2), axis = 1),
+                      np.stack((2 * bx * q2, 2 * bx * q3 - 4 * bz * q1, 2 * bx * q0 - 4 * bz * q2, 2 * bx * q1), axis = 1)), axis = 1)
+        gradient += np.einsum('dij,di->dj', J, f)
+    # Without a measured direction (zero vector) there is no correction
+    gradient = _normalize(gradient) * (np.linalg.norm(acc, axis = 1) > 0)[:, None]
+    q_dot = 0.5 * _quaternion_multiply(q, np.concatenate((zero[:, None], gyro), axis = 1)) - beta * gradient
+    return _normalize(q + q_dot * dt)
+
+
+def orientation_from_acc_magn(acc, magn):
+    '''
+    The orientation of each sample from gravity and the magnetic field (no gyroscope), vectorized over the block.
+
+    Args:
+        acc: The (..., 3) accelerations.
+        magn: The (..., 3) magnetic fields.
+
+    Returns:
+        np.ndarray: The (..., 4) quaternions [w, x, y, z] rotating the sensor frame to the earth frame (x north, y west, z up).
+    '''
+    # At rest the accelerometer measures the reaction to gravity, pointing up
+    up = _normalize(acc)
+    west = _normalize(np.cross(up, magn))
+    north = np.cross(west, up)
+    # Rows are the earth axes in the sensor frame, so the matrix rotates sensor vectors to the earth frame
+    R = np.stack((north, west, up), axis = -2)
+    trace = R[..., 0, 0] + R[..., 1, 1] + R[..., 2, 2]
+    w = np.sqrt(np.maximum(0.0, 1 + trace)) / 2
+    x = np.copysign(np.sqrt(np.maximum(0.0, 1 + R[..., 0, 0] - R[..., 1, 1] - R[..., 2, 2])) / 2, R[..., 2, 1] - R[..., 1, 2])
+    y = np.copysign(np.sqrt(np.maximum(0.0, 1 - R[..., 0, 0] + R[..., 1, 1] - R[..., 2, 2])) / 2, R[..., 0, 2] - R[..., 2, 0])
+    z = np.copysign(np.sqrt(np.maximum(0.0, 1 - R[..., 0, 0] - R[..., 1, 1] + R[..., 2, 2])) / 2, R[..., 1, 0] - R[..., 0, 1])
+    return _normalize(np.stack((w, x, y, z), axis = -1))
+
+
+class OrientationEstimator:
+    '''
+    Orientation of many IMU devices with the same request type and rate, updated block by block.
+
+    Args:
+        addresses:
+            The device addresses, in the order of the stacked samples.
+        hz:
+            The sample rate of the streams.
+        request:
+            The MAGI request type ('imu6', 'imu6m' or 'imu9').
+        beta:
+            The gain of the Madgwick gradient correction.
+        calibration:
+            A :class:`CalibrationStore` with the calibration of each address.
+        quaternions:
+            The (D, 4) current orientation of each device.
+
+    Example:
+        >>> estimator = OrientationEstimator(addresses, 208, "imu9", calibration = CalibrationStore("calibration.json"))
+        >>> quaternions = estimator.update({address : samples, ...})
+        >>> estimator.calibration.save()
+    '''
+    def __init__(self, addresses, hz, request : str = "imu9", beta : float = 0.1, calibration = None):
+        request = request.lower()
+        if request not in ("imu6", "imu6m", "imu9"):
+            raise ValueError(f"Orientation needs an IMU request, not {request}.")
+        self.addresses = list(addresses)
+        self.hz = hz
+        self.request = request
+        self.beta = beta
+        self.calibration = calibration if calibration is not None else CalibrationStore()
+        self.quaternions = np.tile([1.0, 0.0, 0.0, 0.0], (len(self.addresses), 1))
+
+    def _sensors(self, address : str, samples):
+        sensors = split_imu(np.asarray(samples, dtype = np.float64), self.request)
+        calibration = self.calibration.get(address)
+        if 'gyro' in sensors:
+            calibration.update_gyro(sensors['gyro'], sensors['acc'])
+            sensors['gyro'] = calibration.correct_gyro(sensors['gyro']) * DEG_TO_RAD
+        if 'magn' in sensors:
+            calibration.update_magn(sensors['magn'])
+            sensors['magn'] = calibration.correct_magn(sensors['magn'])
+        return sensors
+
+    def update(self, blocks):
+        '''
+        Run the filter over a block of samples of every device. Devices may have different numbers of samples,
+        the shorter ones are left unchanged at the extra steps.
+
+        Args:
+            blocks: Dictionary with the (N, 3 * sensors) samples of each address (missing addresses have none).
+
+        Returns:
+            dict: The (N, 4) quaternions of each address in blocks.
+        '''
+        sensors = {address : self._sensors(address, samples) for address, samples in blocks.items()}
+        counts = np.array([len(sensors[address]['acc']) if address in sensors else 0 for address in self.addresses])
+        steps = int(counts.max()) if len(counts) else 0
+        devices = len(self.addresses)
+        if self.request == "imu6m":
+            results = {}
+            for index, address in enumerate(self.addresses):
+                if address in sensors:
+                    results[address] = orientation_from_acc_magn(sensors[address]['acc'], sensors[address]['magn'])
+                    if len(results[address]):
+                        self.quaternions[index] = results[address][-1]
+            return results
+        # Stack to (steps, D, 3), zero padded
+        stacked = {name : np.zeros((steps, devices, 3)) for name in ('acc', 'gyro', 'magn')}
+        for index, address in enumerate(self.addresses):
+            for name, values in sensors.get(address, {}).items():
+                stacked[name][:len(values), index] = values
+        magn = stacked['magn'] if self.request == "imu9" else None
+        output = np.empty((steps, devices, 4))
+        dt = 1.0 / self.hz
+        q = self.quaternions
+        for step in range(steps):
+            updated = madgwick_step(q, stacked['gyro'][step], stacked['acc'][step], None if magn is None else magn[step], self.beta, dt)
+            q = np.where((counts > step)[:, None], updated, q)
+            output[step] = q
+        self.quaternions = q
+        return {address : output[:counts[index], index] for index, address in enumerate(self.addresses) if address in sensors}
@@ -0,0 +1,261 @@
+"""
+Module Name: profiling.py
+Description: Runtime switchable timing of the hot path stages with fixed bucket latency histograms.
+
+A :class:`Profiler` set on a BLEClient times, with perf_counter_ns, the whole notification handler, the decoders,
+the enqueue to the ring buffer, queue or offload and the dequeue of the consumers, per device and stream, and
+counts the packets and bytes of each stream. Switched off, each packet costs the client one attribute check.
+
+The histograms are HDR style: exact below 2 ** SUB_BUCKET_BITS ns, then every power of two is split in
+2 ** SUB_BUCKET_BITS linear sub-buckets, so a recorded value is off by less than 1 / 2 ** SUB_BUCKET_BITS of it
+(6 %) from 1 ns up to MAX_LATENCY_NS, with a fixed memory per histogram and a record of a few integer operations.
+"""
+
+from contextlib import contextmanager
+from itertools import accumulate
+from time import monotonic, perf_counter_ns
+
+SUB_BUCKET_BITS = 4
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+# Longer values (~68.7 s) are counted in the last bucket
+MAX_LATENCY_NS = 1 << 36
+BUCKET_COUNT = (36 - SUB_BUCKET_BITS + 1) * SUB_BUCKETS
+# The stages timed by BLEClient
+PROFILE_STAGES = ["handler", "decode", "enqueue", "dequeue"]
+QUANTILES = [0.5, 0.9, 0.99, 0.999]
+# The power of two bucket bounds of the Prometheus histograms, 1.024 us to 68.7 s
+_PROMETHEUS_BOUNDS = range(10, 37)
+
+
+def bucket_index(value : int):
+    '''
+    Returns:
+        int: The histogram bucket of a value in ns.
+    '''
+    if value < SUB_BUCKETS:
+        return max(value, 0)
+    shift = value.bit_length() - SUB_BUCKET_BITS - 1
+    return min((shift + 1) * SUB_BUCKETS + (value >> shift) - SUB_BUCKETS, BUCKET_COUNT - 1)
+
+
+def bucket_bounds(index : int):
+    '''
+    Returns:
+        tuple: The lowest value and the value past the highest one in ns of a histogram bucket.
+    '''
+    if index < SUB_BUCKETS:
+        return index, index + 1
+    shift = index // SUB_BUCKETS - 1
+    mantissa = SUB_BUCKETS + index % SUB_BUCKETS
+    return mantissa << shift, (mantissa + 1) << shift
+
+
+class LatencyHistogram:
+    '''
+    Fixed bucket latency histogram of values in ns.
+
+    Args:
+        counts:
+            List with the number of values of each bucket.
+        count, total:
+            Number and sum of the values recorded.
+        min, max:
+            The smallest and largest values recorded, None before any.
+
+    Example:
+        >>> histogram = LatencyHistogram()
+        >>> histogram.record(1500)
+        >>> histogram.record(90000)
+        >>> histogram.quantile(0.5)
+        1535
+    '''
+    def __init__(self):
+        self.counts = [0] * BUCKET_COUNT
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def record(self, value : int):
+        '''
+        Count a value in ns.
+        '''
+        # bucket_index inlined, this runs for every stage of every packet
+        if value < SUB_BUCKETS:
+            index = max(value, 0)
+        else:
+            shift = value.bit_length() - SUB_BUCKET_BITS - 1
+            index = min((shift + 1) * SUB_BUCKETS + (value >> shift) - SUB_BUCKETS, BUCKET_COUNT - 1)
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        if self.max is None or value > self.max:
+            self.max = value
+        if self.min is None or value < self.min:
+            self.min = value
+
+    def quantile(self, q : float):
+        '''
+        Returns:
+            int: The highest value in ns of the bucket holding the q quantile (at most max), None before any values.
+        '''
+        if not self.count:
+            return None
+        rank = max(1, q * self.count)
+        for index, cumulative in enumerate(accumulate(self.counts)):
+            if cumulative >= rank:
+                return min(bucket_bounds(index)[1] - 1, self.max)
+        return self.max
+
+    def snapshot(self):
+        '''
+        Returns:
+            dict: The count, mean, quantiles and max in ns.
+        '''
+        snapshot = {'count' : self.count, 'mean_ns' : self.total / self.count if self.count else None,
+                    'min_ns' : self.min, 'max_ns' : self.max}
+        for q in QUANTILES:
+            snapshot['p' + f"{q * 100:g}".replace(".", "")] = self.quantile(q)
+        return snapshot
+
+
+class Profiler:
+    '''
+    Latency histograms of the pipeline stages and packet counters per device and stream. Set it on the clients
+    with :func:`movesense_class.BLEClient.set_profiler`, then switch it on and off at any time.
+
+    Args:
+        enabled:
+            Boolean. The clients only time and count while it is set.
+        histograms:
+            Dictionary with the :class:`LatencyHistogram` of each (stage, device, stream).
+        packets:
+            Dictionary with the [packets, bytes] received of each (device, stream).
+        started:
+            The monotonic time the profiler was last enabled or reset, the start of the rates.
+
+    Example:
+        >>> profiler = Profiler()
+        >>> mv_client.set_profiler(profiler)
+        >>> profiler.enable()
+        >>> ...
+        >>> profiler.snapshot()["streams"]["0C:8C:DC:41:DB:EB"]["ecg"]["latency"]["decode"]["p99"]
+        12543
+    '''
+    def __init__(self, enabled : bool = False):
+        self.enabled = enabled
+        self.histograms = {}
+        self.packets = {}
+        self.started = monotonic()
+        self._elapsed = 0.0
+
+    def enable(self):
+        if not self.enabled:
+            self.started = monotonic()
+            self.enabled = True
+
+    def disable(self):
+        if self.enabled:
+            self._elapsed += monotonic() - self.started
+            self.enabled = False
+
+    def reset(self):
+        '''
+        Clear the histograms and counters.
+        '''
+        self.histograms = {}
+        self.packets = {}
+        self.started = monotonic()
+        self._elapsed = 0.0
+
+    def elapsed(self):
+        '''
+        Returns:
+            float: The seconds the profiler has been enabled since the last reset.
+        '''
+        return self._elapsed + (monotonic() - self.started if self.enabled else 0.0)
+
+    def record(self, stage : str, device, stream, nanoseconds : int):
+        '''
+        Add the duration of a stage to its histogram.
+        '''
+        key = (stage, device, stream)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = LatencyHistogram()
+        histogram.record(nanoseconds)
+
+    def count(self, device, stream, size : int):
+        '''
+        Count a packet of size bytes of a stream.
+        '''
+        key = (device, stream)
+        counts = self.packets.get(key)
+        if counts is None:
+            self.packets[key] = [1, size]
+        else:
+            counts[0] += 1
+            counts[1] += size
+
+    @contextmanager
+    def timer(self, stage : str, device = None, stream = None):
+        '''
+        Time a block, e.g. a consumer reading the queue, when enabled.
+
+        Example:
+            >>> with profiler.timer("dequeue", address, "ecg"):
+            ...     data = await ecg_from_queue(mv_client.queue)
+        '''
+        if not self.enabled:
+            yield
+            return
+        start = perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.record(stage, device, stream, perf_counter_ns() - start)
+
+    def snapshot(self):
+        '''
+        Returns:
+            dict: The enabled flag and elapsed seconds, and under 'streams' for each device and stream its packets,
+            bytes, their rates per second and the snapshot of each stage histogram under 'latency'.
+        '''
+        elapsed = self.elapsed()
+        streams = {}
+
+        def entry(device, stream):
+            return streams.setdefault(device, {}).setdefault(stream, {'packets' : 0, 'bytes' : 0, 'packets_per_s' : 0.0,
+                                                                      'bytes_per_s' : 0.0, 'latency' : {}})
+        for (device, stream), (packets, size) in self.packets.items():
+            stats = entry(device, stream)
+            stats['packets'], stats['bytes'] = packets, size
+            if elapsed > 0:
+                stats['packets_per_s'], stats['bytes_per_s'] = packets / elapsed, size / elapsed
+        for (stage, device, stream), histogram in self.histograms.items():
+            entry(device, stream)['latency'][stage] = histogram.snapshot()
+        return {'enabled' : self.enabled, 'elapsed_s' : elapsed, 'streams' : streams}
+
+    def prometheus(self, prefix : str = "movesense"):
+        '''
+        Returns:
+            str: The counters and histograms in the Prometheus text exposition format, the latencies in seconds.
+        '''
+        lines = [f"# HELP {prefix}_packets_total Notifications received.", f"# TYPE {prefix}_packets_total counter"]
+        for (device, stream), (packets, _) in sorted(self.packets.items(), key = str):
+            lines.append(f'{prefix}_packets_total{{device="{device}",stream="{stream}"}} {packets}')
+        lines += [f"# HELP {prefix}_bytes_total Notification bytes received.", f"# TYPE {prefix}_bytes_total counter"]
+        for (device, stream), (_, size) in sorted(self.packets.items(), key = str):
+            lines.append(f'{prefix}_bytes_total{{device="{device}",stream="{stream}"}} {size}')
+        name = f"{prefix}_stage_latency_seconds"
+        lines += [f"# HELP {name} Duration of the pipeline stages.", f"# TYPE {name} histogram"]
+        for (stage, device, stream), histogram in sorted(self.histograms.items(), key = str):
+            labels = f'stage="{stage}",device="{device}",stream="{stream}"'
+            cumulative = list(accumulate(histogram.counts))
+            for power in _PROMETHEUS_BOUNDS:
+                below = cumulative[bucket_index(1 << power) - 1]
+                lines.append(f'{name}_bucket{{{labels},le="{(1 << power) / 1e9:.6g}"}} {below}')
+            lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+            lines.append(f'{name}_sum{{{labels}}} {histogram.total / 1e9:.9g}')
+            lines.append(f'{name}_count{{{labels}}} {histogram.count}')
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,556 @@
+"""
+Module Name: recorder.py
+Description: Append-only recording of raw notifications into segmented files with an index, and memory-mapped replay.
+
+Each segment is a pair of files:
+    <prefix>_<number>.mvr   records of [length (uint16), reference (uint8), host time ns (int64)] followed by the raw packet
+    <prefix>_<number>.idx   one INDEX_DTYPE entry per record, used to find a time range with a binary search
+    <prefix>_<number>.streams   JSON header with the request and rate of each reference ID, to decode the segment offline
+
+A :class:`BackgroundRecorder` collects the packets in memory and leaves the writes to a :class:`WriterThread`,
+which appends each batch with one write per file, so the event loop never waits on the disk.
+"""
+
+import json
+import struct
+from bisect import bisect_left, bisect_right
+from os import makedirs, listdir
+from os.path import join, exists, getsize
+from queue import SimpleQueue
+from threading import Event, Thread
+from time import time_ns
+import numpy as np
+from decoder import decode_samples
+from timestamps import TIMESTAMP_WRAP, TimestampUnwrapper
+
+RECORD_HEADER = struct.Struct('<HBq')
+INDEX_DTYPE = np.dtype([('offset', '<u8'), ('host_time', '<i8'), ('sensor_timestamp', '<u4'),
+                        ('length', '<u2'), ('reference', 'u1'), ('pad', 'u1')])
+_INDEX_ENTRY = struct.Struct('<QqIHBx')
+DATA_SUFFIX = ".mvr"
+INDEX_SUFFIX = ".idx"
+STREAMS_SUFFIX = ".streams"
+
+
+def _segment_name(prefix : str, number : int):
+    return f"{prefix}_{number:06d}"
+
+
+class PacketRecorder:
+    '''
+    Appends raw notifications to segmented files without decoding them.
+
+    Args:
+        directory:
+            The directory of the recording. Created if it does not exist.
+        prefix:
+            The start of the segment file names.
+        segment_size:
+            The number of bytes after which a new segment is started.
+        segment:
+            The number of the current segment.
+        packets:
+            Number of packets written.
+        streams:
+            Dictionary with the (request, hz) of each reference ID, written to the header of every segment.
+    '''
+    def __init__(self, directory : str, prefix : str = "capture", segment_size : int = 64 * 1024 * 1024):
+        if segment_size <= RECORD_HEADER.size:
+            raise ValueError("Segment size too small.")
+        makedirs(directory, exist_ok = True)
+        self.directory = directory
+        self.prefix = prefix
+        self.segment_size = segment_size
+        self.segment = -1
+        self.packets = 0
+        self.streams = {}
+        self._data_file = None
+        self._index_file = None
+        self._offset = 0
+        # Continue after the segments of a previous recording with the same prefix
+        existing = _list_segments(directory, prefix)
+        self._next_segment = existing[-1] + 1 if existing else 0
+        self._open_segment()
+
+    def _open_segment(self):
+        self._close_segment()
+        self.segment = self._next_segment
+        self._next_segment += 1
+        name = join(self.directory, _segment_name(self.prefix, self.segment))
+        self._data_file = open(name + DATA_SUFFIX, "ab")
+        self._index_file = open(name + INDEX_SUFFIX, "ab")
+        self._offset = 0
+        self._write_streams()
+
+    def _write_streams(self):
+        name = join(self.directory, _segment_name(self.prefix, self.segment))
+        content = {str(reference) : {'request' : request, 'hz' : hz} for reference, (request, hz) in self.streams.items()}
+        with open(name + STREAMS_SUFFIX, "w") as file:
+            json.dump(content, file)
+
+    def set_streams(self, streams : dict):
+        '''
+        Set the request and rate of each reference ID, e.g. the subscriptions of a client
+        (see :func:`movesense_class.BLEClient.set_recorder`), and rewrite the header of the current segment.
+        A reference ID reused for another stream starts a new segment, so that each header holds for all its packets.
+
+        Args:
+            streams: Dictionary with the (request, hz) of each reference ID.
+        '''
+        streams = {int(reference) : (request, hz) for reference, (request, hz) in streams.items()}
+        if streams != self.streams:
+            reused = any(self.streams.get(reference, stream) != stream for reference, stream in streams.items())
+            self.streams = streams
+            if self._data_file is not None:
+                if reused and self._offset:
+                    self._open_segment()
+                else:
+                    self._write_streams()
+
+    def _close_segment(self):
+        if self._data_file is not None:
+            self._data_file.close()
+            self._index_file.close()
+            self._data_file = None
+            self._index_file = None
+
+    def write(self, data : bytearray, reference = None, sensor_timestamp : int = 0, host_time = None):
+        '''
+        Append one raw packet.
+
+        Args:
+            data: The raw notification bytes.
+            reference: The reference ID of the packet. Read from data[1] if None.
+            sensor_timestamp: The sensor timestamp of the packet in milliseconds.
+            host_time: The host receive time in nanoseconds since the epoch. Now if None.
+        '''
+        if self._data_file is None:
+            raise ValueError("Recorder is closed.")
+        if host_time is None:
+            host_time = time_ns()
+        if reference is None:
+            reference = data[1] if len(data) > 1 else 0
+        length = len(data)
+        if self._offset and self._offset + RECORD_HEADER.size + length > self.segment_size:
+            self._open_segment()
+        offset = self._offset + RECORD_HEADER.size
+        self._data_file.write(RECORD_HEADER.pack(length, reference, host_time))
+        self._data_file.write(data)
+        self._index_file.write(_INDEX_ENTRY.pack(offset, host_time, sensor_timestamp, length, reference))
+        self._offset = offset + length
+        self.packets += 1
+
+    def write_batch(self, packets):
+        '''
+        Append many raw packets with one write per file (per segment when a batch crosses a segment end).
+
+        Args:
+            packets: List of (data, reference, sensor_timestamp, host_time) tuples, see :func:`write`.
+        '''
+        if self._data_file is None:
+            raise ValueError("Recorder is closed.")
+        records, entries = [], []
+        for data, reference, sensor_timestamp, host_time in packets:
+            if reference is None:
+                reference = data[1] if len(data) > 1 else 0
+            length = len(data)
+            if self._offset and self._offset + RECORD_HEADER.size + length > self.segment_size:
+                self._write_records(records, entries)
+                self._open_segment()
+            offset = self._offset + RECORD_HEADER.size
+            records.append(RECORD_HEADER.pack(length, reference, host_time))
+            records.append(data)
+            entries.append(_INDEX_ENTRY.pack(offset, host_time, sensor_timestamp, length, reference))
+            self._offset = offset + length
+            self.packets += 1
+        self._write_records(records, entries)
+
+    def _write_records(self, records : list, entries : list):
+        # The data before their index entries, a crash leaves at most data without an entry
+        if records:
+            self._data_file.write(b"".join(records))
+            self._index_file.write(b"".join(entries))
+            records.clear()
+            entries.clear()
+
+    def flush(self):
+        if self._data_file is not None:
+            self._data_file.flush()
+            self._index_file.flush()
+
+    def close(self):
+        '''
+        Flush and close the current segment.
+        '''
+        self._close_segment()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class WriterThread:
+    '''
+    A daemon thread running the file writes handed to it, in order. One thread can serve the recorders of many devices.
+
+    Args:
+        jobs_done:
+            Number of writes done.
+        error:
+            The exception of the first failed write, None if none. Raised by the next :func:`submit`.
+    '''
+    def __init__(self, name : str = "recorder-writer"):
+        self.jobs_done = 0
+        self.error = None
+        self._jobs = SimpleQueue()
+        self._thread = Thread(target = self._run, name = name, daemon = True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            function, args = job
+            try:
+                function(*args)
+            except Exception as e:
+                if self.error is None:
+                    self.error = e
+            self.jobs_done += 1
+
+    def submit(self, function, *args):
+        '''
+        Run function(*args) in the thread after the writes submitted before.
+
+        Raises:
+            The exception of a failed earlier write.
+        '''
+        if self.error is not None:
+            raise self.error
+        self._jobs.put((function, args))
+
+    def backlog(self):
+        '''
+        Returns:
+            int: The number of writes waiting.
+        '''
+        return self._jobs.qsize()
+
+    def sync(self, timeout = None):
+        '''
+        Wait until the writes submitted before are done. Blocks, so call it from a thread (e.g. run_in_executor)
+        when an event loop is running.
+
+        Returns:
+            bool: True if they are done, False at timeout.
+        '''
+        done = Event()
+        self.submit(done.set)
+        return done.wait(timeout)
+
+    def close(self, timeout = None):
+        '''
+        Finish the submitted writes and end the thread.
+        '''
+        self._jobs.put(None)
+        self._thread.join(timeout)
+
+
+class BackgroundRecorder:
+    '''
+    Records like :class:`PacketRecorder`, with the disk writes in a :class:`WriterThread`. A write only adds the
+    packet to a batch in memory and every batch_packets packets the batch is handed to the thread.
+
+    Args:
+        recorder:
+            The :class:`PacketRecorder` written to, closed with this one.
+        writer:
+            The :class:`WriterThread` doing the writes, shared by the recorders of many devices. An own one if None.
+        batch_packets:
+            The number of packets handed to the writer at once.
+        packets, bytes:
+            Number and bytes of the packets recorded.
+
+    Example:
+        >>> writer = WriterThread()
+        >>> recorder = BackgroundRecorder(PacketRecorder("recording", prefix = "chest"), writer)
+        >>> mv_client.set_recorder(recorder, decode = False)
+        >>> ...
+        >>> recorder.close()
+        >>> writer.close()
+    '''
+    def __init__(self, recorder : PacketRecorder, writer : WriterThread = None, batch_packets : int = 1024):
+        if batch_packets <= 0:
+            raise ValueError("batch_packets must be positive.")
+        self.recorder = recorder
+        self.writer = writer if writer is not None else WriterThread()
+        self.batch_packets = batch_packets
+        self.packets = 0
+        self.bytes = 0
+        self._own_writer = writer is None
+        self._batch = []
+        self._closed = False
+
+    def write(self, data : bytearray, reference = None, sensor_timestamp : int = 0, host_time = None):
+        '''
+        Add one raw packet to the batch, see :func:`PacketRecorder.write`.
+        '''
+        if self._closed:
+            raise ValueError("Recorder is closed.")
+        self._batch.append((bytes(data), reference, sensor_timestamp, time_ns() if host_time is None else host_time))
+        self.packets += 1
+        self.bytes += len(data)
+        if len(self._batch) >= self.batch_packets:
+            self.flush()
+
+    def set_streams(self, streams : dict):
+        '''
+        Set the request and rate of each reference ID in the writer thread, after the packets before, see :func:`PacketRecorder.set_streams`.
+        '''
+        self.flush()
+        self.writer.submit(self.recorder.set_streams, dict(streams))
+
+    def _write(self, batch : list):
+        self.recorder.write_batch(batch)
+        self.recorder.flush()
+
+    def flush(self):
+        '''
+        Hand the packets of the batch to the writer thread. Call it periodically so that slow streams reach the disk in time.
+        '''
+        if self._batch:
+            batch, self._batch = self._batch, []
+            self.writer.submit(self._write, batch)
+
+    def close(self):
+        '''
+        Hand over the last packets and close the recorder after them, and end an own writer thread.
+        '''
+        if self._closed:
+            return
+        self.flush()
+        self._closed = True
+        self.writer.submit(self.recorder.close)
+        if self._own_writer:
+            self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _list_segments(directory : str, prefix : str):
+    '''
+    Returns:
+        list: The sorted numbers of the segments of a recording.
+    '''
+    if not exists(directory):
+        return []
+    numbers = []
+    for name in listdir(directory):
+        if name.startswith(prefix + "_") and name.endswith(DATA_SUFFIX):
+            number = name[len(prefix) + 1:-len(DATA_SUFFIX)]
+            if number.isdigit():
+                numbers.append(int(number))
+    return sorted(numbers)
+
+
+class RecordingReader:
+    '''
+    Memory maps the segments of a recording and finds time ranges through their indexes.
+
+    Args:
+        segments:
+            List of (index, data) pairs of each non empty segment, both memory mapped.
+        segment_streams:
+            List with the dictionary of the (request, hz) of each reference ID of each segment, from its header
+            (empty for recordings made before the headers).
+        streams:
+            Dictionary with the (request, hz) of each reference ID over all the segments, the latest one if
+            a reference ID was reused. Requests are resolved per segment with segment_streams.
+    '''
+    def __init__(self, directory : str, prefix : str = "capture"):
+        self.segments = []
+        self.segment_streams = []
+        self.streams = {}
+        for number in _list_segments(directory, prefix):
+            name = join(directory, _segment_name(prefix, number))
+            # A crash may leave a partial index entry at the end
+            entries = getsize(name + INDEX_SUFFIX) // INDEX_DTYPE.itemsize
+            if entries == 0:
+                continue
+            index = np.memmap(name + INDEX_SUFFIX, dtype = INDEX_DTYPE, mode = "r", shape = (entries,))
+            data = np.memmap(name + DATA_SUFFIX, dtype = np.uint8, mode = "r")
+            # Drop index entries whose packet was not fully written
+            complete = int(np.searchsorted(index['offset'] + index['length'], len(data), side = "right"))
+            if complete:
+                streams = {}
+                if exists(name + STREAMS_SUFFIX):
+                    with open(name + STREAMS_SUFFIX) as file:
+                        streams = {int(reference) : (stream['request'], stream['hz']) for reference, stream in json.load(file).items()}
+                self.segments.append((index[:complete], data))
+                self.segment_streams.append(streams)
+                self.streams.update(streams)
+        self._starts = [int(index['host_time'][0]) for index, _ in self.segments]
+        self._ends = [int(index['host_time'][-1]) for index, _ in self.segments]
+        self._sensor_indexes = {}
+
+    def __len__(self):
+        return sum(len(index) for index, _ in self.segments)
+
+    def _packets(self, segment : int, entries):
+        data = self.segments[segment][1]
+        return [data[offset:offset + length] for offset, length in zip(entries['offset'].tolist(), entries['length'].tolist())]
+
+    def _segment_references(self, segment : int, stream, hz = None):
+        '''
+        Returns:
+            list: The reference IDs of a stream in a segment, the ones its header maps to the request type (and rate)
+            if the stream is a request type.
+        '''
+        if isinstance(stream, str):
+            request = stream.lower()
+            return [reference for reference, (recorded, recorded_hz) in self.segment_streams[segment].items()
+                    if recorded == request and (hz is None or recorded_hz == hz)]
+        return [stream]
+
+    def references(self, stream, hz = None):
+        '''
+        Returns:
+            list: The reference IDs a stream, given by reference ID or by request type (and rate), has in any segment.
+        '''
+        return sorted({reference for segment in range(len(self.segments)) for reference in self._segment_references(segment, stream, hz)})
+
+    def read_range(self, start = None, end = None, reference = None, hz = None):
+        '''
+        Get the packets received between two host times. The segments and the packets in them are found with binary searches.
+
+        Args:
+            start: The first host time in nanoseconds (inclusive). From the start if None.
+            end: The last host time in nanoseconds (inclusive). To the end if None.
+            reference: Keep only the packets of this reference ID, or of this request type in the segment headers.
+            hz: With a request type, keep only the packets of this rate.
+
+        Returns:
+            tuple: The index entries (INDEX_DTYPE array) and a list with the raw packets as zero-copy uint8 arrays.
+        '''
+        start = self._starts[0] if start is None and self.segments else start
+        end = self._ends[-1] if end is None and self.segments else end
+        entries, packets = [], []
+        for segment in range(bisect_left(self._ends, start), bisect_right(self._starts, end)):
+            index = self.segments[segment][0]
+            times = index['host_time']
+            selected = index[np.searchsorted(times, start, side = "left"):np.searchsorted(times, end, side = "right")]
+            if reference is not None:
+                selected = selected[np.isin(selected['reference'], self._segment_references(segment, reference, hz))]
+            entries.append(selected)
+            packets.extend(self._packets(segment, selected))
+        if not entries:
+            return np.empty(0, dtype = INDEX_DTYPE), []
+        return np.concatenate(entries), packets
+
+    def _sensor_index(self, stream, hz = None):
+        '''
+        Gather the entries of a stream once, with the segment of each, split in runs at the device resets, with
+        the sensor timestamps of each run unwrapped from its start.
+        '''
+        key = (stream, hz)
+        if key not in self._sensor_indexes:
+            segments, entries = [], []
+            for segment, (index, _) in enumerate(self.segments):
+                selected = index[np.isin(index['reference'], self._segment_references(segment, stream, hz))]
+                entries.append(selected)
+                segments.append(np.full(len(selected), segment, dtype = np.int32))
+            if entries:
+                entries, segments = np.concatenate(entries), np.concatenate(segments)
+            else:
+                entries, segments = np.empty(0, dtype = INDEX_DTYPE), np.empty(0, dtype = np.int32)
+            raw = entries['sensor_timestamp'].astype(np.int64)
+            steps = np.diff(raw)
+            # A step back of less than half the range is a reset, a larger one a rollover
+            runs = np.concatenate(([0], np.flatnonzero((steps < 0) & (steps > -TIMESTAMP_WRAP // 2)) + 1, [len(raw)]))
+            times = np.concatenate([TimestampUnwrapper().unwrap(raw[first:last]) for first, last in zip(runs[:-1], runs[1:])]
+                                   + [np.empty(0, dtype = np.int64)])
+            self._sensor_indexes[key] = (entries, segments, times, runs)
+        return self._sensor_indexes[key]
+
+    def _sensor_selection(self, reference, start : int, end : int, hz = None):
+        entries, segments, times, runs = self._sensor_index(reference, hz)
+        selected = []
+        for first, last in zip(runs[:-1].tolist(), runs[1:].tolist()):
+            run = times[first:last]
+            selected.append(np.arange(first + np.searchsorted(run, start, side = "left"), first + np.searchsorted(run, end, side = "right")))
+        selected = np.concatenate(selected) if selected else np.empty(0, dtype = np.int64)
+        return entries[selected], segments[selected]
+
+    def read_sensor_range(self, reference, start : int, end : int, hz = None):
+        '''
+        Get the packets of a stream between two sensor timestamps. The timestamps are unwrapped past the uint32
+        rollover, and a device reset starts a new run unwrapped from its first timestamp. Each run is searched in
+        O(log n) and the packets of every run inside the range are returned, in recording order.
+
+        Args:
+            reference: The reference ID of the stream, or its request type to find its reference IDs in the header of each segment.
+            start: The first unwrapped sensor timestamp in milliseconds (inclusive).
+            end: The last unwrapped sensor timestamp in milliseconds (inclusive).
+            hz: With a request type, keep only the packets of this rate.
+
+        Returns:
+            tuple: The index entries (INDEX_DTYPE array) and a list with the raw packets as zero-copy uint8 arrays.
+        '''
+        entries, segments = self._sensor_selection(reference, start, end, hz)
+        packets = []
+        for entry, segment in zip(entries, segments.tolist()):
+            packets.append(self.segments[segment][1][int(entry['offset']):int(entry['offset']) + int(entry['length'])])
+        return entries, packets
+
+    def decode_sensor_range(self, reference, start : int, end : int, hz = None):
+        '''
+        Decode the packets of :func:`read_sensor_range`, each with the request type its segment header gives its
+        reference ID. The packets are decoded in runs of the same request, rate and packet size.
+
+        Returns:
+            tuple: The index entries and the timestamps and samples of :func:`decoder.decode_samples`.
+
+        Raises:
+            KeyError: A packet whose request type is not in its segment header.
+            ValueError: The reference ID was used for several request types, give the request type instead.
+        '''
+        entries, segments = self._sensor_selection(reference, start, end, hz)
+        streams = []
+        for entry, segment in zip(entries, segments.tolist()):
+            stream = self.segment_streams[segment].get(int(entry['reference']))
+            if stream is None:
+                raise KeyError(f"No request type recorded for reference {int(entry['reference'])} in segment {segment}.")
+            streams.append(stream)
+        if len({request for request, _ in streams}) > 1:
+            raise ValueError(f"Reference {reference} was recorded for several request types.")
+        if not streams:
+            request = reference if isinstance(reference, str) else self.streams.get(reference, (None,))[0]
+            if request is None:
+                raise KeyError(f"No request type recorded for {reference}.")
+            return (entries,) + decode_samples(request, [])
+        timestamps, samples = [], []
+        first = 0
+        for last in range(1, len(entries) + 1):
+            if last < len(entries) and streams[last] == streams[first] and entries[last]['length'] == entries[first]['length']:
+                continue
+            packets = self._read_packets(entries[first:last], segments[first:last])
+            decoded = decode_samples(streams[first][0], packets)
+            timestamps.append(decoded[0])
+            samples.append(decoded[1])
+            first = last
+        return entries, np.concatenate(timestamps), np.concatenate(samples)
+
+    def _read_packets(self, entries, segments):
+        '''
+        Returns:
+            list: The raw packets of index entries as bytes, given the segment of each entry.
+        '''
+        return [self.segments[segment][1][int(entry['offset']):int(entry['offset']) + int(entry['length'])].tobytes()
+                for entry, segment in zip(entries, segments.tolist())]
@@ -0,0 +1,223 @@
+"""
+Module Name: scanner.py
+Description: Long running scanner keeping a cache of the movesense devices currently advertising.
+
+Instead of a full discover before every connect, one scanner runs in the background and remembers the
+BLEDevice object, RSSI and last advertisement time of every movesense device it hears. Entries not heard for
+longer than the TTL are evicted. Connecting with a cached BLEDevice skips the device lookup of the backend,
+so a connect or reconnect takes only the connect time.
+"""
+
+from asyncio import Event, create_task, sleep, wait_for, TimeoutError as AsyncTimeoutError, CancelledError
+from time import monotonic
+from bleak import BleakScanner
+from constants import DEVICENAME
+
+
+def parse_serial(name):
+    '''
+    Returns:
+        str: The serial number of a movesense advertisement name, None if the name has none.
+
+    Example:
+        >>> parse_serial("Movesense 223430000019")
+        '223430000019'
+    '''
+    if not name or not name.startswith(DEVICENAME):
+        return None
+    serial = name[len(DEVICENAME):].strip()
+    return serial or None
+
+
+class MovesenseAdvertisement:
+    '''
+    The cached advertisement of one device.
+
+    Args:
+        device:
+            The bleak BLEDevice, which BleakClient accepts instead of the address.
+        address, name, serial:
+            The address, advertised name and serial number parsed from the name.
+        rssi:
+            The signal strength of the last advertisement in dBm.
+        first_seen, last_seen:
+            The monotonic times of the first and last advertisements.
+        count:
+            Number of advertisements heard.
+    '''
+    def __init__(self, device, rssi, now : float):
+        self.device = device
+        self.address = str(device.address)
+        self.name = device.name
+        self.serial = parse_serial(device.name)
+        self.rssi = rssi
+        self.first_seen = now
+        self.last_seen = now
+        self.count = 1
+
+    def age(self, now = None):
+        '''
+        Returns:
+            float: The seconds since the last advertisement.
+        '''
+        return (monotonic() if now is None else now) - self.last_seen
+
+    def to_list(self):
+        '''
+        Returns:
+            list: [address, name] as :func:`util_fun.scan_movesense_address` returns.
+        '''
+        return [self.address, str(self.name)]
+
+
+class MovesenseScanner:
+    '''
+    A background BleakScanner with a TTL cache of movesense advertisements by address.
+
+    Args:
+        ttl:
+            The seconds an entry stays in the cache without a new advertisement.
+        scanner_factory:
+            Called with detection_callback to create the scanner (BleakScanner, or a simulator).
+        cache:
+            Dictionary with the :class:`MovesenseAdvertisement` of each (upper case) address.
+        is_scanning:
+            Boolean scanning status.
+
+    Example:
+        >>> async with MovesenseScanner(ttl = 30) as scanner:
+        ...     advertisement = await scanner.wait_for("0C:8C:DC:41:DB:EB", timeout = 10)
+        ...     mv_client = BLEClient(advertisement.address, device = advertisement.device)
+    '''
+    def __init__(self, ttl : float = 60.0, scanner_factory = BleakScanner):
+        if ttl <= 0:
+            raise ValueError("TTL must be positive.")
+        self.ttl = ttl
+        self.scanner_factory = scanner_factory
+        self.cache = {}
+        self.is_scanning = False
+        self._scanner = None
+        self._evict_task = None
+        self._seen = {}
+
+    def __len__(self):
+        return len(self.devices())
+
+    def _detection_callback(self, device, advertisement_data):
+        name = device.name or getattr(advertisement_data, 'local_name', None)
+        if not name or not name.startswith(DEVICENAME):
+            return
+        now = monotonic()
+        rssi = getattr(advertisement_data, 'rssi', None)
+        address = str(device.address).upper()
+        entry = self.cache.get(address)
+        if entry is None:
+            entry = self.cache[address] = MovesenseAdvertisement(device, rssi, now)
+        else:
+            entry.device = device
+            entry.rssi = rssi
+            entry.last_seen = now
+            entry.count += 1
+        if entry.name is None:
+            entry.name, entry.serial = name, parse_serial(name)
+        event = self._seen.pop(address, None)
+        if event is not None:
+            event.set()
+
+    async def _evict_loop(self):
+        try:
+            while True:
+                await sleep(self.ttl / 2)
+                self.evict()
+        except CancelledError:
+            pass
+
+    def evict(self, now = None):
+        '''
+        Remove the entries not advertised within the TTL.
+
+        Returns:
+            int: The number of entries removed.
+        '''
+        now = monotonic() if now is None else now
+        expired = [address for address, entry in self.cache.items() if entry.age(now) > self.ttl]
+        for address in expired:
+            del self.cache[address]
+        return len(expired)
+
+    async def start(self):
+        '''
+        Start scanning in the background. Does nothing if already scanning.
+        '''
+        if self.is_scanning:
+            return
+        self._scanner = self.scanner_factory(detection_callback = self._detection_callback)
+        await self._scanner.start()
+        self.is_scanning = True
+        self._evict_task = create_task(self._evict_loop())
+
+    async def stop(self):
+        '''
+        Stop scanning. The cache is kept.
+        '''
+        if not self.is_scanning:
+            return
+        self._evict_task.cancel()
+        await self._scanner.stop()
+        self.is_scanning = False
+        self._scanner = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+
+    def get(self, address : str):
+        '''
+        Returns:
+            MovesenseAdvertisement: The fresh cache entry of an address, None if not heard within the TTL.
+        '''
+        entry = self.cache.get(address.upper())
+        if entry is None or entry.age() > self.ttl:
+            return None
+        return entry
+
+    def get_device(self, address : str):
+        '''
+        Returns:
+            The cached BLEDevice of an address, None if not heard within the TTL.
+        '''
+        entry = self.get(address)
+        return entry.device if entry is not None else None
+
+    def devices(self):
+        '''
+        Returns:
+            list: The fresh entries, strongest signal first.
+        '''
+        now = monotonic()
+        entries = [entry for entry in self.cache.values() if entry.age(now) <= self.ttl]
+        return sorted(entries, key = lambda entry: -entry.rssi if entry.rssi is not None else float("inf"))
+
+    async def wait_for(self, address : str, timeout : float = 10.0):
+        '''
+        Get the cache entry of an address, waiting for its advertisement if it is not cached.
+
+        Returns:
+            MovesenseAdvertisement: The entry of the address.
+
+        Raises:
+            TimeoutError: Not heard within the timeout.
+        '''
+        entry = self.get(address)
+        if entry is not None:
+            return entry
+        event = self._seen.setdefault(address.upper(), Event())
+        try:
+            await wait_for(event.wait(), timeout)
+        except AsyncTimeoutError:
+            self._seen.pop(address.upper(), None)
+            raise TimeoutError(f"{address} not advertising.")
+        return self.get(address)
@@ -0,0 +1,409 @@
+"""
+Module Name: session_store.py
+Description: Compressed, chunked columnar storage of decoded sessions with a time range index per chunk.
+
+Every stream (device address, request type and reference ID) is a directory of column files:
+    <directory>/<address>/<request>_<reference>/
+        times.col     the compressed chunks of the float64 sample times
+        samples.col   the compressed chunks of the samples
+        chunks.idx    one CHUNK_DTYPE entry per chunk with its offsets, sizes, sample count and time range
+        stream.json   the address, request, reference, hz, dtype and width of the stream
+The samples of a stream are collected while capturing, and each full chunk is handed to a :class:`recorder.WriterThread`,
+which compresses and writes it, so the event loop of the clients never compresses. A chunk is compressed
+with zlib after its bytes are shuffled (byte i of every value together), which groups the slowly changing high
+bytes of the values. With the 'delta' codec the samples are coded with :mod:`codec` instead: integers losslessly, and floats within
+an error bound. ECG, decoded as counts times VOLTS_PER_LSB, is quantized back to its counts, so it stays lossless.
+A range read memory maps the columns and decompresses only the chunks that overlap the range.
+"""
+
+import json
+import zlib
+from os import makedirs, listdir
+from os.path import join, exists, getsize, isdir
+import numpy as np
+from buffers import SampleBuffer
+from recorder import WriterThread
+from codec import encode_ints, decode_ints, encode_floats, decode_floats
+from constants import VOLTS_PER_LSB, ECG_REQUEST_TYPE
+
+CHUNK_DTYPE = np.dtype([('times_offset', '<u8'), ('samples_offset', '<u8'), ('times_size', '<u4'), ('samples_size', '<u4'),
+                        ('count', '<u4'), ('pad', '<u4'), ('first_time', '<f8'), ('last_time', '<f8')])
+TIMES_FILE = "times.col"
+SAMPLES_FILE = "samples.col"
+INDEX_FILE = "chunks.idx"
+META_FILE = "stream.json"
+SESSION_CODECS = ["zlib", "delta"]
+
+
+def _address_directory(address : str):
+    return address.replace(':', '').upper()
+
+
+def _stream_directory(request : str, reference : int):
+    return f"{request.lower()}_{int(reference)}"
+
+
+def compress_column(values, level : int = 6):
+    '''
+    Shuffle the bytes of an array by significance and compress them with zlib.
+
+    Returns:
+        bytes: The compressed chunk.
+    '''
+    values = np.ascontiguousarray(values)
+    shuffled = values.view(np.uint8).reshape(-1, values.dtype.itemsize).T
+    return zlib.compress(shuffled.tobytes(), level)
+
+
+def decompress_column(data, dtype, count : int, width = None):
+    '''
+    Undo :func:`compress_column`.
+
+    Returns:
+        np.ndarray: The count values (rows of width values) of the chunk.
+    '''
+    dtype = np.dtype(dtype)
+    shuffled = np.frombuffer(zlib.decompress(data), dtype = np.uint8).reshape(dtype.itemsize, -1)
+    values = np.ascontiguousarray(shuffled.T).view(dtype)
+    return values.reshape(count) if width is None else values.reshape(count, width)
+
+
+class _StreamWriter:
+    '''
+    The open column files and the pending chunk of one stream. The full chunks are compressed and written by the writer thread.
+    '''
+    def __init__(self, path : str, meta : dict, chunk_size : int, level : int, writer : WriterThread):
+        makedirs(path, exist_ok = True)
+        if exists(join(path, META_FILE)):
+            with open(join(path, META_FILE)) as file:
+                previous = json.load(file)
+            previous.setdefault('codec', "zlib")
+            previous.setdefault('max_error', None)
+            if any(previous[key] != meta[key] for key in ('dtype', 'width', 'codec', 'max_error')):
+                raise ValueError(f"Stream {path} was written with different samples or codec.")
+        else:
+            with open(join(path, META_FILE), "w") as file:
+                json.dump(meta, file, indent = 2)
+        self.width = meta['width']
+        self.max_error = meta.get('max_error')
+        self.codec = meta.get('codec', "zlib")
+        self.chunk_size = chunk_size
+        self.level = level
+        self.writer = writer
+        self.times = SampleBuffer(np.float64, None, chunk_size)
+        self.samples = SampleBuffer(np.dtype(meta['dtype']), self.width, chunk_size)
+        self._times_file = open(join(path, TIMES_FILE), "ab")
+        self._samples_file = open(join(path, SAMPLES_FILE), "ab")
+        self._index_file = open(join(path, INDEX_FILE), "ab")
+        self.chunks = 0
+
+    def write(self, times, samples):
+        self.times.extend(times)
+        self.samples.extend(samples)
+        if len(self.times) >= self.chunk_size:
+            self.write_chunk()
+
+    def write_chunk(self):
+        '''
+        Hand the pending samples to the writer thread as a chunk.
+        '''
+        if len(self.times) == 0:
+            return
+        self.writer.submit(self._write_chunk, self.times.to_array(), self.samples.to_array())
+        self.times.clear()
+        self.samples.clear()
+
+    def _write_chunk(self, times, samples):
+        count = len(times)
+        times_data = compress_column(times, self.level)
+        if self.max_error is not None:
+            samples_data = encode_floats(samples, self.max_error)
+        elif self.codec == "delta":
+            samples_data = encode_ints(samples)
+        else:
+            samples_data = compress_column(samples, self.level)
+        entry = np.zeros(1, dtype = CHUNK_DTYPE)
+        entry['times_offset'] = self._times_file.tell()
+        entry['samples_offset'] = self._samples_file.tell()
+        entry['times_size'] = len(times_data)
+        entry['samples_size'] = len(samples_data)
+        entry['count'] = count
+        entry['first_time'] = times.min()
+        entry['last_time'] = times.max()
+        self._times_file.write(times_data)
+        self._samples_file.write(samples_data)
+        # The index entry goes last, so a reader never sees a chunk that is not fully written
+        self._times_file.flush()
+        self._samples_file.flush()
+        self._index_file.write(entry.tobytes())
+        self._index_file.flush()
+        self.chunks += 1
+
+    def close(self):
+        self.write_chunk()
+        self.writer.submit(self._close_files)
+
+    def _close_files(self):
+        self._times_file.close()
+        self._samples_file.close()
+        self._index_file.close()
+
+
+class SessionWriter:
+    '''
+    Writes the decoded samples of many streams incrementally, one compressed chunk at a time.
+    Writing to an existing session appends to its streams.
+
+    Args:
+        directory:
+            The directory of the session. Created if it does not exist.
+        chunk_size:
+            The number of samples of a chunk.
+        level:
+            The zlib compression level (1 fastest to 9 smallest).
+        codec:
+            'zlib' to compress the samples losslessly with zlib, or 'delta' to code them with :mod:`codec`.
+        max_error:
+            The error bound of the float samples with the 'delta' codec, one value or a dictionary by request type.
+            Float streams without a bound are compressed with zlib. ECG defaults to VOLTS_PER_LSB / 2 (lossless).
+        writer:
+            The :class:`recorder.WriterThread` compressing and writing the chunks, which may be shared with
+            recorders. An own one if None.
+        streams:
+            Dictionary with the open stream writers by (address, request, reference).
+
+    Example:
+        >>> with SessionWriter("session") as session:
+        ...     session.write("0C:8C:DC:2C:8E:2A", "ecg", 99, times, samples, hz = 512)
+    '''
+    def __init__(self, directory : str, chunk_size : int = 8192, level : int = 6, codec : str = "zlib", max_error = None,
+                 writer : WriterThread = None):
+        if chunk_size <= 0:
+            raise ValueError("Chunk size must be positive.")
+        if codec not in SESSION_CODECS:
+            raise ValueError(f"Unknown codec: {codec}")
+        makedirs(directory, exist_ok = True)
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.level = level
+        self.codec = codec
+        self.max_error = max_error
+        self.writer = writer if writer is not None else WriterThread("session-writer")
+        self._own_writer = writer is None
+        self.streams = {}
+
+    def _max_error(self, request : str, samples):
+        '''
+        Returns:
+            The error bound of the float samples of a request with the delta codec, None to store them losslessly.
+        '''
+        if self.codec != "delta" or samples.dtype.kind != 'f':
+            return None
+        if isinstance(self.max_error, dict):
+            error = self.max_error.get(request)
+        else:
+            error = self.max_error
+        if error is None and request == ECG_REQUEST_TYPE:
+            error = VOLTS_PER_LSB / 2
+        return error
+
+    def write(self, address : str, request : str, reference : int, times, samples, hz = None):
+        '''
+        Append samples of a stream. A chunk is compressed and written when chunk_size samples are collected.
+
+        Args:
+            address: The address of the device.
+            request: The request type of the stream.
+            reference: The reference ID of the stream.
+            times: The time of each sample (or one time for all of them), e.g. sensor milliseconds.
+            samples: The decoded samples, shape (n,) or (n, width).
+            hz: The sample rate, kept in the stream metadata.
+        '''
+        samples = np.asarray(samples)
+        if len(samples) == 0:
+            return
+        key = (address, request.lower(), int(reference))
+        stream = self.streams.get(key)
+        if stream is None:
+            width = samples.shape[1] if samples.ndim > 1 else None
+            max_error = self._max_error(key[1], samples)
+            codec = "delta" if self.codec == "delta" and (max_error is not None or samples.dtype.kind in 'iu') else "zlib"
+            meta = {'address' : address, 'request' : key[1], 'reference' : key[2], 'hz' : hz,
+                    'dtype' : samples.dtype.str, 'width' : width, 'codec' : codec, 'max_error' : max_error}
+            path = join(self.directory, _address_directory(address), _stream_directory(key[1], key[2]))
+            stream = self.streams[key] = _StreamWriter(path, meta, self.chunk_size, self.level, self.writer)
+        stream.write(np.broadcast_to(np.asarray(times, dtype = np.float64), (len(samples),)), samples)
+
+    def flush(self, wait : bool = False):
+        '''
+        Hand the pending samples of every stream to the writer as (smaller) chunks.
+
+        Args:
+            wait: If True, block until the writer wrote them, e.g. before reading the session.
+        '''
+        for stream in self.streams.values():
+            stream.write_chunk()
+        if wait:
+            self.writer.sync()
+
+    def close(self):
+        '''
+        Write the last chunks and close the streams, waiting for the writer.
+
+        Raises:
+            The exception of a failed chunk write.
+        '''
+        for stream in self.streams.values():
+            stream.close()
+        self.streams = {}
+        if self._own_writer:
+            self.writer.close()
+        else:
+            self.writer.sync()
+        if self.writer.error is not None:
+            raise self.writer.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class _StreamReader:
+    '''
+    The memory mapped columns and chunk index of one stream.
+    '''
+    def __init__(self, path : str):
+        with open(join(path, META_FILE)) as file:
+            self.meta = json.load(file)
+        self.dtype = np.dtype(self.meta['dtype'])
+        self.width = self.meta['width']
+        self.codec = self.meta.get('codec', "zlib")
+        self.max_error = self.meta.get('max_error')
+        # A crash may leave a partial entry at the end of the index
+        entries = getsize(join(path, INDEX_FILE)) // CHUNK_DTYPE.itemsize
+        if entries:
+            self.index = np.array(np.memmap(join(path, INDEX_FILE), dtype = CHUNK_DTYPE, mode = "r", shape = (entries,)))
+            self.times = np.memmap(join(path, TIMES_FILE), dtype = np.uint8, mode = "r")
+            self.samples = np.memmap(join(path, SAMPLES_FILE), dtype = np.uint8, mode = "r")
+        else:
+            self.index = np.empty(0, dtype = CHUNK_DTYPE)
+        # Chunks are searched by time when the stream times only increase
+        self.ordered = bool(np.all(self.index['first_time'][1:] >= self.index['last_time'][:-1]))
+
+    def __len__(self):
+        return int(self.index['count'].sum())
+
+    def chunk(self, number : int):
+        entry = self.index[number]
+        count = int(entry['count'])
+        offset, size = int(entry['times_offset']), int(entry['times_size'])
+        times = decompress_column(self.times[offset:offset + size], np.float64, count)
+        offset, size = int(entry['samples_offset']), int(entry['samples_size'])
+        data = self.samples[offset:offset + size]
+        if self.max_error is not None:
+            samples = decode_floats(data, self.dtype)
+        elif self.codec == "delta":
+            samples = decode_ints(data, self.dtype)
+        else:
+            samples = decompress_column(data, self.dtype, count, self.width)
+        return times, samples
+
+    def read(self, start = None, end = None):
+        first_times, last_times = self.index['first_time'], self.index['last_time']
+        start = -np.inf if start is None else start
+        end = np.inf if end is None else end
+        if self.ordered:
+            chunks = range(int(np.searchsorted(last_times, start, side = "left")), int(np.searchsorted(first_times, end, side = "right")))
+        else:
+            chunks = np.flatnonzero((last_times >= start) & (first_times <= end)).tolist()
+        times, samples = [], []
+        for number in chunks:
+            chunk_times, chunk_samples = self.chunk(number)
+            if chunk_times[0] < start or chunk_times[-1] > end or not self.ordered:
+                keep = (chunk_times >= start) & (chunk_times <= end)
+                chunk_times, chunk_samples = chunk_times[keep], chunk_samples[keep]
+            times.append(chunk_times)
+            samples.append(chunk_samples)
+        if not times:
+            shape = (0,) if self.width is None else (0, self.width)
+            return np.empty(0, dtype = np.float64), np.empty(shape, dtype = self.dtype)
+        return np.concatenate(times), np.concatenate(samples)
+
+
+class SessionReader:
+    '''
+    Lazy reader of a session written by :class:`SessionWriter`. Streams are opened (memory mapped) on first use.
+
+    Args:
+        directory:
+            The directory of the session.
+
+    Example:
+        >>> session = SessionReader("session")
+        >>> times, samples = session.read("0C:8C:DC:2C:8E:2A", "ecg", start = t0, end = t0 + 600000)
+    '''
+    def __init__(self, directory : str):
+        self.directory = directory
+        self._paths = {}
+        for address in sorted(listdir(directory)) if isdir(directory) else []:
+            for stream in sorted(listdir(join(directory, address))) if isdir(join(directory, address)) else []:
+                path = join(directory, address, stream)
+                if exists(join(path, META_FILE)):
+                    with open(join(path, META_FILE)) as file:
+                        meta = json.load(file)
+                    self._paths[(meta['address'], meta['request'], meta['reference'])] = path
+        self._streams = {}
+
+    def streams(self):
+        '''
+        Returns:
+            list: The (address, request, reference) key of every stream of the session.
+        '''
+        return list(self._paths)
+
+    def _stream(self, address : str, request : str, reference = None):
+        request = request.lower()
+        keys = [key for key in self._paths if key[0] == address and key[1] == request and (reference is None or key[2] == reference)]
+        if not keys:
+            raise KeyError(f"No stream {request} of {address}" + (f" with reference {reference}." if reference is not None else "."))
+        streams = []
+        for key in keys:
+            if key not in self._streams:
+                self._streams[key] = _StreamReader(self._paths[key])
+            streams.append(self._streams[key])
+        return streams
+
+    def metadata(self, address : str, request : str, reference = None):
+        '''
+        Returns:
+            dict: The metadata of the stream with the number of samples and chunks and its time range.
+        '''
+        stream = self._stream(address, request, reference)[0]
+        index = stream.index
+        return dict(stream.meta, samples = len(stream), chunks = len(index),
+                    first_time = float(index['first_time'].min()) if len(index) else None,
+                    last_time = float(index['last_time'].max()) if len(index) else None)
+
+    def read(self, address : str, request : str, reference = None, start = None, end = None):
+        '''
+        Read the samples of a stream in a time range. Only the chunks overlapping the range are decompressed.
+
+        Args:
+            address: The address of the device.
+            request: The request type of the stream.
+            reference: The reference ID of the stream. All the streams of the request, one after the other, if None.
+            start: The first time (inclusive), in the unit the times were written with. From the start if None.
+            end: The last time (inclusive). To the end if None.
+
+        Returns:
+            tuple: The float64 times and the samples.
+
+        Raises:
+            KeyError: No such stream in the session.
+        '''
+        parts = [stream.read(start, end) for stream in self._stream(address, request, reference)]
+        if len(parts) == 1:
+            return parts[0]
+        return np.concatenate([times for times, _ in parts]), np.concatenate([samples for _, samples in parts])
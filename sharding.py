@@ -0,0 +1,443 @@
+"""
+Module Name: sharding.py
+Description: Spreads a large fleet over worker processes, each with its own event loop and BLE adapter.
+
+One event loop decodes the notifications of a few dozen devices at most before it falls behind. The sharded
+fleet plans the devices onto shards by their expected data rate, runs every shard as a
+:class:`fleet.MovesenseFleet` in its own process bound to one adapter, and talks to it over a pipe. A worker
+sends the decoded samples of its streams as compact binary blocks (a small header followed by the raw host
+times and samples), its health counters every health_interval and the replies to the control commands of
+the parent. The workers are spawned, so the client_factory must be picklable (a module level function, or a
+functools.partial of one).
+"""
+
+import pickle
+import struct
+from asyncio import get_running_loop, run, sleep, wait_for, TimeoutError as AsyncTimeoutError
+from functools import partial
+from inspect import isawaitable
+from itertools import count
+from multiprocessing import get_context
+from os import cpu_count
+from threading import Thread
+import numpy as np
+from buffers import stream_layout, stream_store
+from fleet import MovesenseFleet
+from movesense_class import BLEClient
+
+# Message kinds: a binary block of samples, or any other pickled message
+BLOCK = 0
+OBJECT = 1
+# Kind, address length, request length, samples, width (0 for one value per sample)
+BLOCK_HEADER = struct.Struct('<BBBIH')
+# The client methods the parent can call on a device of a worker
+SHARD_COMMANDS = ("write_characteristic", "resubscribe", "start_notify", "stop_notify", "set_battery_level",
+                  "get_battery_level", "get_health")
+
+
+def expected_rate(request : str, hz = None):
+    '''
+    Returns:
+        float: The bytes per second of decoded samples and times a request produces, the load it puts on a worker.
+
+    Example:
+        >>> expected_rate("ecg", 512)
+        6144.0
+    '''
+    rate, width = stream_layout(request, hz)
+    return float(rate * (4 * (width or 1) + 8))
+
+
+def plan_shards(requests : dict, shards : int):
+    '''
+    Spread the devices onto shards, each device on the least loaded shard, the fastest devices first.
+
+    Args:
+        requests: Dictionary with the (request, hz) of each device address.
+        shards: The number of shards.
+
+    Returns:
+        tuple: The list of the {address: (request, hz)} dictionary of each shard and the list of their expected loads.
+    '''
+    if shards <= 0:
+        raise ValueError("The number of shards must be positive.")
+    plans = [{} for _ in range(shards)]
+    loads = [0.0] * shards
+    rates = {address : expected_rate(*spec) for address, spec in requests.items()}
+    for address in sorted(rates, key = lambda address: -rates[address]):
+        shard = min(range(shards), key = lambda index: (loads[index], len(plans[index])))
+        plans[shard][address] = requests[address]
+        loads[shard] += rates[address]
+    return plans, loads
+
+
+def pack_block(address : str, request : str, times, samples):
+    '''
+    Returns:
+        bytes: A block message with the float64 host times and float32 samples of a stream.
+    '''
+    samples = np.ascontiguousarray(samples, dtype = np.float32)
+    width = samples.shape[1] if samples.ndim > 1 else 0
+    address, request = address.encode("utf-8"), request.encode("utf-8")
+    header = BLOCK_HEADER.pack(BLOCK, len(address), len(request), len(samples), width)
+    return header + address + request + np.ascontiguousarray(times, dtype = np.float64).tobytes() + samples.tobytes()
+
+
+def pack_message(message):
+    '''
+    Returns:
+        bytes: Any other message (a tuple starting with its name) pickled.
+    '''
+    return bytes([OBJECT]) + pickle.dumps(message, protocol = pickle.HIGHEST_PROTOCOL)
+
+
+def unpack_message(data):
+    '''
+    Returns:
+        tuple: ('block', address, request, times, samples) for a block, else the pickled message.
+    '''
+    if data[0] == OBJECT:
+        return pickle.loads(memoryview(data)[1:])
+    _, address_length, request_length, samples, width = BLOCK_HEADER.unpack_from(data)
+    position = BLOCK_HEADER.size
+    address = bytes(data[position:position + address_length]).decode("utf-8")
+    position += address_length
+    request = bytes(data[position:position + request_length]).decode("utf-8")
+    position += request_length
+    times = np.frombuffer(data, dtype = np.float64, count = samples, offset = position)
+    values = np.frombuffer(data, dtype = np.float32, count = samples * max(width, 1), offset = position + 8 * samples)
+    return ("block", address, request, times, values.reshape(samples, width) if width else values)
+
+
+def _picklable(error):
+    try:
+        pickle.dumps(error)
+        return error
+    except Exception:
+        return RuntimeError(repr(error))
+
+
+def _shard_main(connection, requests : dict, adapter, client_factory, options : dict):
+    '''
+    The entry point of a worker process.
+    '''
+    run(_run_shard(connection, requests, adapter, client_factory, options))
+
+
+async def _run_shard(connection, requests : dict, adapter, client_factory, options : dict):
+    send = lambda message: connection.send_bytes(pack_message(message))
+    factory = partial(client_factory, adapter = adapter) if adapter is not None else client_factory
+    fleet = MovesenseFleet(list(requests), options['max_connects'], options['ring_seconds'], options['overflow_policy'], factory)
+    started = await fleet.start(requests) if requests else []
+    send(("started", started, {address : _picklable(error) for address, error in fleet.errors.items()}))
+    loop = get_running_loop()
+    next_health = loop.time()
+    running = True
+    failed = []
+    while True:
+        for address, client in fleet.clients.items():
+            for request in list(client.streams):
+                times, samples = client.read_stream(request)
+                if len(times):
+                    connection.send_bytes(pack_block(address, request, times, samples))
+        if not running:
+            break
+        if loop.time() >= next_health:
+            send(("health", fleet.health(), fleet.throughput()))
+            next_health += options['health_interval']
+        while running and connection.poll():
+            message = unpack_message(connection.recv_bytes())
+            if message[0] == "stop":
+                running = False
+            elif message[0] == "call":
+                _, ident, address, method, args = message
+                try:
+                    if method not in SHARD_COMMANDS:
+                        raise ValueError(f"Command not allowed: {method}")
+                    result = getattr(fleet.clients[address], method)(*args)
+                    if isawaitable(result):
+                        result = await result
+                    send(("reply", ident, result, None))
+                except Exception as e:
+                    send(("reply", ident, None, _picklable(e)))
+        if running:
+            await sleep(options['interval'])
+        else:
+            failed = await fleet.stop()
+    send(("stopped", failed, fleet.health(), {address : _picklable(error) for address, error in fleet.errors.items()}))
+    connection.close()
+
+
+class ShardedFleet:
+    '''
+    A fleet spread over worker processes, planned by the expected data rate of each device.
+
+    Args:
+        requests:
+            Dictionary with the (request, hz) of each device address (or the request alone for hr and temp),
+            updated when a request is changed with :func:`call`.
+        shards:
+            The number of worker processes. One per CPU (at most one per device) if None.
+        adapters:
+            The Bluetooth adapters (e.g. ["hci0", "hci1"]) the shards are bound to in turn, None for the default one.
+        client_factory:
+            Creates the BLEClient of an address in the worker, called with adapter when one is set. Must be picklable.
+        max_connects, ring_seconds, overflow_policy:
+            Passed to the :class:`fleet.MovesenseFleet` of each worker.
+        interval:
+            The seconds between two sends of the new samples by a worker.
+        health_interval:
+            The seconds between two health reports of a worker.
+        plans, loads:
+            The devices and the expected bytes per second of each shard, see :func:`plan_shards`.
+        shard_of:
+            Dictionary with the shard index of each address.
+        streams:
+            Dictionary with the :class:`buffers.RingBuffer` of each (address, request), holding the samples with
+            their host times in seconds.
+        errors:
+            Dictionary with the exception of each device that failed to start or stop, or of each dead shard (by index).
+        blocks, block_bytes:
+            Number and bytes of the sample blocks received from the workers.
+
+    Example:
+        >>> fleet = ShardedFleet({address : ("imu9", 208) for address in addresses}, shards = 4, adapters = ["hci0", "hci1"])
+        >>> await fleet.start()
+        >>> times, samples = fleet.read_stream(addresses[0])
+        >>> await fleet.stop()
+    '''
+    def __init__(self, requests : dict, shards = None, adapters = None, client_factory = BLEClient, max_connects : int = 4,
+                 ring_seconds : float = 60, overflow_policy : str = "drop_oldest", interval : float = 0.05,
+                 health_interval : float = 1.0):
+        self.requests = {address : (spec, None) if isinstance(spec, str) else tuple(spec) for address, spec in requests.items()}
+        if shards is None:
+            shards = max(1, min(cpu_count() or 1, len(self.requests)))
+        self.plans, self.loads = plan_shards(self.requests, shards)
+        self.adapters = [adapters[index % len(adapters)] if adapters else None for index in range(shards)]
+        self.shard_of = {address : index for index, plan in enumerate(self.plans) for address in plan}
+        self.client_factory = client_factory
+        self.options = {'max_connects' : max_connects, 'ring_seconds' : ring_seconds, 'overflow_policy' : overflow_policy,
+                        'interval' : interval, 'health_interval' : health_interval}
+        self.streams = {(address, request) : stream_store(request, hz, ring_seconds, overflow_policy)
+                        for address, (request, hz) in self.requests.items()}
+        self.errors = {}
+        self.blocks = 0
+        self.block_bytes = 0
+        self.processes = []
+        self._connections = []
+        self._health = {}
+        self._throughput = {}
+        self._started = []
+        self._stopped = []
+        self._replies = {}
+        self._idents = count()
+        self._loop = None
+
+    def __len__(self):
+        return len(self.requests)
+
+    def _reader(self, index : int, connection):
+        '''
+        Receive the messages of a worker in a thread and hand them to the event loop.
+        '''
+        while True:
+            try:
+                data = connection.recv_bytes()
+            except (EOFError, OSError):
+                break
+            self._loop.call_soon_threadsafe(self._dispatch, index, unpack_message(data), len(data))
+        self._loop.call_soon_threadsafe(self._closed, index)
+
+    def _dispatch(self, index : int, message, size : int):
+        kind = message[0]
+        if kind == "block":
+            _, address, request, times, samples = message
+            store = self.streams.get((address, request))
+            if store is None:
+                store = self.streams[(address, request)] = stream_store(request, self.requests[address][1],
+                                                                        self.options['ring_seconds'], self.options['overflow_policy'])
+            store.write(times, samples)
+            self.blocks += 1
+            self.block_bytes += size
+        elif kind == "health":
+            self._health.update(message[1])
+            self._throughput.update(message[2])
+        elif kind == "reply":
+            _, future, change = self._replies.pop(message[1], (None, None, None))
+            if future is not None and not future.done():
+                if message[3] is not None:
+                    future.set_exception(message[3])
+                else:
+                    if change is not None and message[2]:
+                        # The blocks of the new request follow the reply, their ring buffer is sized by its rate
+                        self.requests[change[0]] = change[1]
+                    future.set_result(message[2])
+        elif kind == "started":
+            self.errors.update(message[2])
+            if not self._started[index].done():
+                self._started[index].set_result(message[1])
+        elif kind == "stopped":
+            self._health.update(message[2])
+            self.errors.update(message[3])
+            if not self._stopped[index].done():
+                self._stopped[index].set_result(message[1])
+
+    def _closed(self, index : int):
+        '''
+        The pipe of a worker closed: fail what still waits on it.
+        '''
+        error = ConnectionError(f"Shard {index} closed.")
+        if not self._started[index].done():
+            self.errors[index] = error
+            self._started[index].set_exception(error)
+        if not self._stopped[index].done():
+            self._stopped[index].set_result(list(self.plans[index]))
+        for ident, (shard, future, _) in list(self._replies.items()):
+            if shard == index and not future.done():
+                del self._replies[ident]
+                future.set_exception(error)
+
+    async def start(self, timeout = None):
+        '''
+        Spawn the workers, each connecting and subscribing the devices of its shard.
+
+        Args:
+            timeout: The seconds to wait for all the shards to start, None to wait without limit.
+
+        Returns:
+            list: The addresses of the devices that started. The failures are kept in errors.
+        '''
+        if self.processes:
+            raise RuntimeError("The fleet is already started.")
+        self._loop = get_running_loop()
+        context = get_context("spawn")
+        for index, plan in enumerate(self.plans):
+            parent, child = context.Pipe()
+            process = context.Process(target = _shard_main, name = f"movesense-shard-{index}", daemon = True,
+                                      args = (child, plan, self.adapters[index], self.client_factory, self.options))
+            self._started.append(self._loop.create_future())
+            self._stopped.append(self._loop.create_future())
+            process.start()
+            child.close()
+            self.processes.append(process)
+            self._connections.append(parent)
+            Thread(target = self._reader, args = (index, parent), daemon = True).start()
+        started = []
+        for future in self._started:
+            try:
+                started.extend(await wait_for(future, timeout) if timeout is not None else await future)
+            except (ConnectionError, AsyncTimeoutError):
+                pass
+        return started
+
+    async def stop(self, timeout : float = 10.0):
+        '''
+        Stop and disconnect the devices of every worker, receive their last samples and end the processes.
+
+        Returns:
+            list: The addresses of the devices that failed to stop, or whose shard did not stop in time.
+        '''
+        for index, connection in enumerate(self._connections):
+            if not self._stopped[index].done():
+                try:
+                    connection.send_bytes(pack_message(("stop",)))
+                except OSError:
+                    pass
+        failed = []
+        for index, future in enumerate(self._stopped):
+            try:
+                failed.extend(await wait_for(future, timeout))
+            except AsyncTimeoutError:
+                failed.extend(self.plans[index])
+        for process in self.processes:
+            await self._loop.run_in_executor(None, process.join, timeout)
+            if process.is_alive():
+                process.terminate()
+        for connection in self._connections:
+            connection.close()
+        return failed
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+
+    async def call(self, address : str, method : str, *args, timeout = None):
+        '''
+        Call a method of the BLEClient of a device in its worker, e.g. to change its request. A successful
+        write_characteristic becomes the request of the device in requests.
+
+        Args:
+            address: The address of the device.
+            method: One of SHARD_COMMANDS.
+            args: The arguments of the method, picklable.
+            timeout: The seconds to wait for the reply.
+
+        Returns:
+            The result of the method.
+
+        Example:
+            >>> await fleet.call(address, "write_characteristic", "acc", 52)
+            True
+        '''
+        if method not in SHARD_COMMANDS:
+            raise ValueError(f"Command not allowed: {method}")
+        index = self.shard_of[address]
+        ident = next(self._idents)
+        future = self._loop.create_future()
+        change = None
+        if method == "write_characteristic":
+            change = (address, (args[0].lower(), args[1] if len(args) > 1 else None))
+        self._replies[ident] = (index, future, change)
+        try:
+            self._connections[index].send_bytes(pack_message(("call", ident, address, method, args)))
+        except OSError:
+            raise ConnectionError(f"Shard {index} closed.")
+        try:
+            return await wait_for(future, timeout)
+        finally:
+            self._replies.pop(ident, None)
+
+    def get_stream(self, address : str, request = None):
+        '''
+        Returns:
+            The ring buffer of a device's request type (the planned one if None), with host times.
+        '''
+        return self.streams.get((address, request if request is not None else self.requests[address][0]))
+
+    def read_stream(self, address : str, request = None, count = None):
+        '''
+        Pop samples of a device's stream with their host times in seconds, as :func:`movesense_class.BLEClient.read_stream`.
+
+        Raises:
+            ValueError: No stream for the request.
+        '''
+        store = self.get_stream(address, request)
+        if store is None:
+            raise ValueError(f"No stream for {address} {request}.")
+        return store.read(count)
+
+    def health(self):
+        '''
+        Returns:
+            dict: The health of each address, as last reported by its worker.
+        '''
+        return dict(self._health)
+
+    def throughput(self):
+        '''
+        Returns:
+            dict: The throughput of each address, as last reported by its worker (see :func:`fleet.MovesenseFleet.throughput`).
+        '''
+        return dict(self._throughput)
+
+    def shard_status(self):
+        '''
+        Returns:
+            list: For each shard its process id, whether it is alive, its adapter, devices and expected bytes per second.
+        '''
+        return [{'pid' : process.pid, 'alive' : process.is_alive(), 'adapter' : self.adapters[index],
+                 'devices' : list(self.plans[index]), 'load' : self.loads[index]}
+                for index, process in enumerate(self.processes)]
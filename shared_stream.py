@@ -0,0 +1,265 @@
+"""
+Module Name: shared_stream.py
+Description: Live streams published to named shared memory ring buffers for other local processes.
+
+One writer (the process holding the BLE connection) and any number of readers attached by name.
+The segment holds a header, the float64 times and the samples. Stream positions count every sample ever
+written and are used as sequence numbers: before writing, the writer publishes the position it writes up to
+('reserved'), and after writing the position readers may read up to ('committed'). A reader takes views of
+committed samples without locking or copying, and the samples it read are valid as long as the writer has not
+reserved past them by more than the capacity, which the reader checks after using them.
+The header counters are aligned int64 values, so each of their stores and loads is a single machine access.
+
+Only x86 / x86-64 machines are supported. The header is published with plain stores and Python has no memory
+barriers, so the protocol relies on the total store order (TSO) of x86: the samples are visible to the readers
+before 'committed', and 'reserved' before the samples. On weakly ordered machines (ARM, POWER) a reader may see
+a new 'committed' before the samples it covers, so the writer and the readers warn there.
+"""
+
+import platform
+import warnings
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+
+SHARED_STREAM_MAGIC = 0x4D565353
+HEADER_DTYPE = np.dtype([('magic', '<i8'), ('capacity', '<i8'), ('width', '<i8'), ('hz', '<f8'),
+                         ('reserved', '<i8'), ('committed', '<i8'), ('writes', '<i8'),
+                         ('dtype', 'S16'), ('request', 'S16')])
+HEADER_SIZE = 128
+# The machines (platform.machine()) whose total store order the header protocol relies on
+TSO_MACHINES = {"x86_64", "amd64", "x86", "i386", "i486", "i586", "i686"}
+
+# Segments created by the writers of this process, which stay tracked when read here too
+_created = set()
+
+
+def shared_stream_name(address : str, request : str):
+    '''
+    Returns:
+        str: The default shared memory name of a device stream, e.g. movesense_0C8CDC2C8E2A_ecg.
+    '''
+    return f"movesense_{address.replace(':', '').upper()}_{request.lower()}"
+
+
+def _check_memory_order():
+    if platform.machine().lower() not in TSO_MACHINES:
+        warnings.warn(f"Shared streams rely on x86 store ordering, readers on {platform.machine()} may read samples "
+                      "before they are written.", RuntimeWarning, stacklevel = 3)
+
+
+def _attach(name : str):
+    '''
+    Attach to an existing segment without tracking it, else the resource tracker of this process would
+    remove the segment of the writer when this process exits.
+    '''
+    if name in _created:
+        return shared_memory.SharedMemory(name = name)
+    try:
+        return shared_memory.SharedMemory(name = name, track = False)
+    except TypeError:
+        memory = shared_memory.SharedMemory(name = name)
+        resource_tracker.unregister(memory._name, "shared_memory")
+        return memory
+
+
+def _layout(buffer, header):
+    capacity, width = int(header['capacity']), int(header['width'])
+    dtype = np.dtype(header['dtype'][()].decode())
+    times = np.ndarray((capacity,), dtype = np.float64, buffer = buffer, offset = HEADER_SIZE)
+    shape = (capacity,) if width == 0 else (capacity, width)
+    samples = np.ndarray(shape, dtype = dtype, buffer = buffer, offset = HEADER_SIZE + 8 * capacity)
+    return times, samples
+
+
+class SharedStreamWriter:
+    '''
+    The single writer of a shared memory stream. Supported on x86 / x86-64 only, see the module description.
+
+    Args:
+        name:
+            The shared memory name readers attach to.
+        capacity:
+            Number of samples kept.
+        dtype:
+            The NumPy dtype of the samples.
+        width:
+            None for one value per sample, else the number of values of each sample.
+        request, hz:
+            The request type and sample rate of the stream, stored in the header for the readers.
+    '''
+    def __init__(self, name : str, capacity : int, dtype = np.float32, width = None, request : str = "", hz = None):
+        if capacity <= 0:
+            raise ValueError("Capacity must be positive.")
+        _check_memory_order()
+        dtype = np.dtype(dtype)
+        size = HEADER_SIZE + capacity * (8 + dtype.itemsize * (width or 1))
+        self.name = name
+        self.memory = shared_memory.SharedMemory(name = name, create = True, size = size)
+        _created.add(name)
+        self.header = np.ndarray((), dtype = HEADER_DTYPE, buffer = self.memory.buf)
+        self.header['capacity'] = capacity
+        self.header['width'] = width or 0
+        self.header['hz'] = hz or 0.0
+        self.header['dtype'] = dtype.str.encode()
+        self.header['request'] = request.encode()
+        self.header['reserved'] = self.header['committed'] = self.header['writes'] = 0
+        self.times, self.samples = _layout(self.memory.buf, self.header)
+        self.capacity = capacity
+        # Readers check the magic last, so it marks a complete header
+        self.header['magic'] = SHARED_STREAM_MAGIC
+
+    @property
+    def position(self):
+        return int(self.header['committed'])
+
+    def write(self, times, samples):
+        '''
+        Append samples with their times, overwriting the oldest ones. Never blocks on readers.
+
+        Args:
+            times: The time of each sample (or one time for all of them).
+            samples: The samples, shape (n,) or (n, width).
+        '''
+        samples = np.asarray(samples)
+        count = len(samples)
+        if count == 0:
+            return
+        times = np.broadcast_to(np.asarray(times, dtype = np.float64), (count,))
+        if count > self.capacity:
+            skipped = count - self.capacity
+            times, samples = times[skipped:], samples[skipped:]
+            self.header['reserved'] = self.header['committed'] = self.header['committed'] + skipped
+            count = self.capacity
+        position = int(self.header['committed'])
+        self.header['reserved'] = position + count
+        start = position % self.capacity
+        first = min(count, self.capacity - start)
+        self.times[start:start + first] = times[:first]
+        self.samples[start:start + first] = samples[:first]
+        if first < count:
+            self.times[:count - first] = times[first:]
+            self.samples[:count - first] = samples[first:]
+        self.header['committed'] = position + count
+        self.header['writes'] += 1
+
+    def close(self, unlink : bool = True):
+        '''
+        Detach the writer and by default remove the segment. Attached readers keep their mapping.
+        '''
+        self.times = self.samples = self.header = None
+        self.memory.close()
+        if unlink:
+            self.memory.unlink()
+            _created.discard(self.name)
+
+
+class SharedStreamReader:
+    '''
+    A reader of a shared memory stream, attached by name from any local process. Supported on x86 / x86-64 only,
+    see the module description.
+
+    Args:
+        name:
+            The shared memory name of the stream.
+        request, hz, capacity:
+            The stream parameters read from the header.
+        read_position:
+            The stream position this reader reads from next.
+        overruns:
+            Number of samples the writer overwrote before this reader read them.
+
+    Example:
+        >>> reader = SharedStreamReader(shared_stream_name("0C:8C:DC:2C:8E:2A", "ecg"))
+        >>> times, samples = reader.latest(512)
+    '''
+    def __init__(self, name : str):
+        _check_memory_order()
+        self.name = name
+        self.memory = _attach(name)
+        self.header = np.ndarray((), dtype = HEADER_DTYPE, buffer = self.memory.buf)
+        if int(self.header['magic']) != SHARED_STREAM_MAGIC:
+            self.header = None
+            self.memory.close()
+            raise ValueError(f"{name} is not a shared stream.")
+        self.request = self.header['request'][()].decode()
+        self.hz = float(self.header['hz']) or None
+        self.capacity = int(self.header['capacity'])
+        self.times, self.samples = _layout(self.memory.buf, self.header)
+        self.read_position = int(self.header['committed'])
+        self.overruns = 0
+
+    @property
+    def position(self):
+        '''
+        The committed stream position (number of samples written so far).
+        '''
+        return int(self.header['committed'])
+
+    def valid(self, position : int):
+        '''
+        Returns:
+            bool: True if the samples from the given stream position were not overwritten yet.
+        '''
+        return position >= int(self.header['reserved']) - self.capacity
+
+    def _window(self, position : int, count : int):
+        start = position % self.capacity
+        end = start + count
+        if end <= self.capacity:
+            return self.times[start:end], self.samples[start:end]
+        wrapped = end - self.capacity
+        return (np.concatenate((self.times[start:], self.times[:wrapped])),
+                np.concatenate((self.samples[start:], self.samples[:wrapped])))
+
+    def latest(self, count : int, copy : bool = True):
+        '''
+        The newest samples.
+
+        Args:
+            count: The number of samples, fewer if not written yet.
+            copy: If False the arrays are views of the shared memory when they do not wrap around,
+                  and must be checked with :func:`valid` on the returned position after use.
+
+        Returns:
+            tuple: times, samples and the stream position of the first sample.
+        '''
+        while True:
+            end = self.position
+            count = min(count, end, self.capacity)
+            start = end - count
+            times, samples = self._window(start, count)
+            if copy:
+                times, samples = np.array(times), np.array(samples)
+            if not copy or self.valid(start):
+                return times, samples, start
+
+    def read(self, count = None, copy : bool = True):
+        '''
+        The samples written since the last read, skipping (and counting in overruns) the ones already overwritten.
+
+        Args:
+            count: Maximum number of samples to read, None for all.
+            copy: See :func:`latest`.
+
+        Returns:
+            tuple: times, samples and the stream position of the first sample.
+        '''
+        while True:
+            end = self.position
+            oldest = int(self.header['reserved']) - self.capacity
+            if self.read_position < oldest:
+                self.overruns += oldest - self.read_position
+                self.read_position = oldest
+            start = self.read_position
+            available = end - start
+            available = available if count is None else min(count, available)
+            times, samples = self._window(start, available)
+            if copy:
+                times, samples = np.array(times), np.array(samples)
+            if not copy or self.valid(start):
+                self.read_position = start + available
+                return times, samples, start
+
+    def close(self):
+        self.times = self.samples = self.header = None
+        self.memory.close()
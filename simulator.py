@@ -0,0 +1,344 @@
+"""
+Module Name: simulator.py
+Description: A simulated BleakClient and packet generator to run BLEClient without hardware.
+
+The simulated client answers the same calls BLEClient makes to a BleakClient and produces correctly framed
+ECG, MAGI, HR and temperature notifications for each subscription written to it, either in real time,
+at a multiple of real time or by replaying a recording of :class:`recorder.RecordingReader`.
+"""
+
+import struct
+from asyncio import sleep, create_task, CancelledError
+from inspect import isawaitable
+from time import perf_counter
+import numpy as np
+from constants import (ECG_REQUEST_TYPE, HR_REQUEST_TYPE, TEMP_REQUEST_TYPE, MAGI_REQUEST_TYPES, MAGI_SENSOR_COUNT,
+                       PATH, WRITE_CHARACTERISTIC_UUID, BATTERY_LEVEL_UUID, DATA_PACKET_TYPE)
+from decoder import ECG_SAMPLES_PER_PACKET
+from movesense_class import BLEClient
+from bleak.backends.device import BLEDevice
+from bleak.backends.scanner import AdvertisementData
+
+# Largest notification payload with the default 247 bytes MTU
+MAX_PACKET_SIZE = 244
+# Counts of a 1 mV R-peak (VOLTS_PER_LSB ~= 3.81e-7 V)
+ECG_PEAK_COUNTS = 2621
+
+
+def magi_samples_per_packet(request : str, hz : int):
+    '''
+    The number of samples a MAGI packet carries at a rate: one more per 13 Hz step, as a power of two
+    that fits the packet size.
+
+    Example:
+        >>> magi_samples_per_packet("imu9", 208)
+        4
+    '''
+    fits = (MAX_PACKET_SIZE - 6) // (12 * MAGI_SENSOR_COUNT[request])
+    samples = max(1, min(hz // 13, fits))
+    return 1 << (samples.bit_length() - 1)
+
+
+class PacketGenerator:
+    '''
+    Builds the notifications of one subscription with synthetic signals.
+
+    Args:
+        request:
+            The request type (ecg, hr, temp or one of the MAGI types).
+        hz:
+            The sample rate of the request (ignored for hr and temp).
+        reference:
+            The reference ID written to byte 1 of each packet.
+        interval:
+            The seconds between two packets in real time.
+        timestamp:
+            The sensor timestamp in milliseconds of the next packet.
+    '''
+    def __init__(self, request : str, hz = None, reference : int = 99, seed = None, start_timestamp : int = 0):
+        self.request = request.lower()
+        self.hz = hz
+        self.reference = reference
+        self.timestamp = start_timestamp
+        self._time = start_timestamp / 1000
+        self._rng = np.random.default_rng(seed)
+        if self.request == ECG_REQUEST_TYPE:
+            self.samples_per_packet = ECG_SAMPLES_PER_PACKET
+            self.interval = ECG_SAMPLES_PER_PACKET / hz
+        elif self.request in MAGI_REQUEST_TYPES:
+            self.samples_per_packet = magi_samples_per_packet(self.request, hz)
+            self.interval = self.samples_per_packet / hz
+        elif self.request == HR_REQUEST_TYPE:
+            self.samples_per_packet = 1
+            self.interval = 0.8
+        elif self.request == TEMP_REQUEST_TYPE:
+            self.samples_per_packet = 1
+            self.interval = 1.0
+        else:
+            raise NameError("Wrong request.")
+        self._header = bytes([DATA_PACKET_TYPE, reference])
+
+    def _sample_times(self):
+        return self._time + np.arange(self.samples_per_packet) / self.hz
+
+    def next_packet(self):
+        '''
+        Returns:
+            bytearray: The next notification of the subscription.
+        '''
+        if self.request == ECG_REQUEST_TYPE:
+            # A spike train at 72 bpm over some noise
+            phase = (self._sample_times() * 1.2) % 1.0
+            signal = ECG_PEAK_COUNTS * np.exp(-((phase - 0.5) ** 2) / 2e-4) + self._rng.normal(0, 40, self.samples_per_packet)
+            payload = struct.pack('<I', self.timestamp) + signal.astype('<i4').tobytes()
+        elif self.request in MAGI_REQUEST_TYPES:
+            # Sensor blocks one after the other, each with its xyz samples: gravity on z plus noise
+            values = self._rng.normal(0, 0.05, (MAGI_SENSOR_COUNT[self.request], self.samples_per_packet, 3))
+            values[0, :, 2] += 9.81
+            payload = struct.pack('<I', self.timestamp) + values.astype('<f4').tobytes()
+        elif self.request == HR_REQUEST_TYPE:
+            RR_interval = int(self._rng.normal(800, 30))
+            self.interval = RR_interval / 1000
+            payload = struct.pack('<fH', 60000 / RR_interval, RR_interval)
+        else:
+            payload = struct.pack('<fI', 306.0 + self._rng.normal(0, 0.05), self.timestamp)
+        self._time += self.interval
+        self.timestamp = int(round(self._time * 1000)) & 0xFFFFFFFF
+        return bytearray(self._header + payload)
+
+    def packets(self, count : int):
+        '''
+        Returns:
+            list: The next count notifications.
+        '''
+        return [self.next_packet() for _ in range(count)]
+
+
+def parse_request(data : bytearray):
+    '''
+    Read a subscribe command [1, reference, "/meas/<request>/<hz>"].
+
+    Returns:
+        tuple: The reference, request type and rate (None if not given).
+    '''
+    parts = bytes(data[2:]).decode("utf-8")[len(PATH):].split("/")
+    return data[1], parts[0].lower(), int(parts[1]) if len(parts) > 1 and parts[1] else None
+
+
+class SimulatedBleakClient:
+    '''
+    A drop-in for the BleakClient calls BLEClient makes, producing notifications without hardware.
+
+    Args:
+        address:
+            The address of the simulated device.
+        speed:
+            The multiple of real time the packets are produced at. 0 produces them as fast as possible.
+        replay:
+            A :class:`recorder.RecordingReader`. If given, each subscription replays the recorded packets of
+            its request type and rate (of its reference ID in recordings without stream headers), relabelled with
+            the live reference ID, with the recorded spacing divided by speed, instead of synthetic packets.
+        connect_delay:
+            Seconds a connect takes.
+        battery_level:
+            The value returned for the battery level characteristic.
+        fail_connects:
+            Number of the next connects that fail, to simulate a device out of range.
+        lag:
+            The most seconds any packet was delivered after its due time. Grows when the process can not keep up.
+        packets_sent:
+            Number of notifications delivered.
+    '''
+    def __init__(self, address : str = "00:00:00:00:00:00", speed : float = 1.0, replay = None, connect_delay : float = 0.0,
+                 battery_level : int = 100, seed = None, disconnected_callback = None):
+        if speed < 0:
+            raise ValueError("Speed cannot be negative.")
+        self.address = address
+        self.speed = speed
+        self.replay = replay
+        self.connect_delay = connect_delay
+        self.battery_level = battery_level
+        self.seed = seed
+        self.disconnected_callback = disconnected_callback
+        self.fail_connects = 0
+        self.is_connected = False
+        self.services = []
+        self.lag = 0.0
+        self.packets_sent = 0
+        self._callback = None
+        self._tasks = {}
+
+    @property
+    def _backend(self):
+        # BLEClient.connect() goes through the backend of a BleakClient
+        return self
+
+    async def connect(self, **kwargs):
+        if self.connect_delay:
+            await sleep(self.connect_delay)
+        if self.fail_connects > 0:
+            self.fail_connects -= 1
+            raise TimeoutError(f"Device {self.address} not found.")
+        self.is_connected = True
+        return True
+
+    def drop_connection(self, fail_connects : int = 0):
+        '''
+        Simulate a lost link: the subscriptions of the device end and the disconnected callback is called.
+
+        Args:
+            fail_connects: Number of the next connects that fail.
+        '''
+        for reference in list(self._tasks):
+            self._stop(reference)
+        self._callback = None
+        self.fail_connects = fail_connects
+        if self.is_connected:
+            self.is_connected = False
+            if self.disconnected_callback is not None:
+                self.disconnected_callback(self)
+
+    async def disconnect(self):
+        for reference in list(self._tasks):
+            self._stop(reference)
+        self._callback = None
+        was_connected, self.is_connected = self.is_connected, False
+        if was_connected and self.disconnected_callback is not None:
+            self.disconnected_callback(self)
+        return True
+
+    async def read_gatt_char(self, char_specifier, **kwargs):
+        if not self.is_connected:
+            raise ValueError("Not connected.")
+        if str(char_specifier).lower() == BATTERY_LEVEL_UUID:
+            return bytearray([self.battery_level])
+        return bytearray()
+
+    async def write_gatt_char(self, char_specifier, data, response = False):
+        if not self.is_connected:
+            raise ValueError("Not connected.")
+        if str(char_specifier).lower() != WRITE_CHARACTERISTIC_UUID:
+            return None
+        if data[0] == 1:
+            reference, request, hz = parse_request(data)
+            self._stop(reference)
+            self._tasks[reference] = create_task(self._produce(reference, request, hz))
+        elif data[0] == 2:
+            self._stop(data[1])
+        return None
+
+    async def start_notify(self, char_specifier, callback, **kwargs):
+        if not self.is_connected:
+            raise ValueError("Not connected.")
+        self._callback = callback
+
+    async def stop_notify(self, char_specifier):
+        self._callback = None
+
+    def _stop(self, reference : int):
+        task = self._tasks.pop(reference, None)
+        if task is not None:
+            task.cancel()
+
+    def _packet_source(self, reference : int, request : str, hz):
+        '''
+        Yields (seconds after the start in real time, packet) pairs of a subscription.
+        '''
+        if self.replay is not None:
+            # The recorded packets of the request and rate, whatever reference ID they had when recorded
+            stream = request if self.replay.references(request, hz) else reference
+            entries, packets = self.replay.read_range(reference = stream, hz = hz)
+            if len(entries):
+                offsets = (entries['host_time'] - entries['host_time'][0]) / 1e9
+                for offset, packet in zip(offsets.tolist(), packets):
+                    packet = bytearray(packet)
+                    packet[1] = reference
+                    yield offset, packet
+            return
+        generator = PacketGenerator(request, hz, reference, self.seed)
+        due = 0.0
+        while True:
+            yield due, generator.next_packet()
+            due += generator.interval
+
+    async def _produce(self, reference : int, request : str, hz):
+        start = perf_counter()
+        try:
+            for due, packet in self._packet_source(reference, request, hz):
+                if self.speed:
+                    delay = start + due / self.speed - perf_counter()
+                    if delay > 0:
+                        await sleep(delay)
+                    else:
+                        self.lag = max(self.lag, -delay)
+                else:
+                    await sleep(0)
+                if self._callback is None:
+                    continue
+                self.packets_sent += 1
+                result = self._callback(self, packet)
+                if isawaitable(result):
+                    await result
+        except CancelledError:
+            pass
+
+
+def simulated_ble_client(address : str, speed : float = 1.0, replay = None, connect_delay : float = 0.0, seed = None, **kwargs):
+    '''
+    Create a BLEClient on a :class:`SimulatedBleakClient`. With functools.partial it can be the client_factory of a fleet.
+
+    Args:
+        address: The address of the simulated device.
+        speed: The multiple of real time the packets are produced at (0 for as fast as possible).
+        replay: A :class:`recorder.RecordingReader` to replay instead of synthetic packets.
+        connect_delay: Seconds a connect takes.
+        kwargs: Passed to BLEClient (ring_seconds, overflow_policy).
+
+    Example:
+        >>> fleet = MovesenseFleet(addresses, client_factory = partial(simulated_ble_client, speed = 10))
+    '''
+    client = SimulatedBleakClient(address, speed, replay, connect_delay, seed = seed)
+    return BLEClient(address, client = client, **kwargs)
+
+
+class SimulatedBleakScanner:
+    '''
+    A drop-in for the BleakScanner calls of :class:`scanner.MovesenseScanner`, advertising simulated devices.
+
+    Args:
+        detection_callback:
+            Called with (BLEDevice, AdvertisementData) for every advertisement.
+        addresses:
+            The addresses of the advertising devices, named "Movesense <serial>".
+        interval:
+            Seconds between the advertisements of a device.
+        rssi:
+            The signal strength of the advertisements.
+    '''
+    def __init__(self, detection_callback = None, addresses = (), interval : float = 0.1, rssi : int = -60, **kwargs):
+        self.detection_callback = detection_callback
+        self.interval = interval
+        self.devices = []
+        for number, address in enumerate(addresses):
+            name = f"Movesense {223430000000 + number}"
+            self.devices.append((BLEDevice(address, name, None, rssi),
+                                 AdvertisementData(name, {}, {}, [], None, rssi, ())))
+        self._task = None
+
+    async def _advertise(self):
+        try:
+            while True:
+                for device, advertisement in self.devices:
+                    if self.detection_callback is not None:
+                        self.detection_callback(device, advertisement)
+                await sleep(self.interval)
+        except CancelledError:
+            pass
+
+    async def start(self):
+        self._task = create_task(self._advertise())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
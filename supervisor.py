@@ -0,0 +1,180 @@
+"""
+Module Name: supervisor.py
+Description: Supervised connection mode that reconnects a dropped device and restores its streams.
+
+The supervisor listens to the disconnect callback of a BLEClient. When the link drops it reconnects with a
+bounded exponential backoff, using the BLEDevice of a scanner cache when one is given, writes the active
+subscriptions again with their reference IDs, restarts the notifications and marks the gap, with its duration,
+in every stream.
+"""
+
+from asyncio import Event, create_task, sleep, wait_for, CancelledError
+from random import random
+from time import time
+
+
+class ConnectionSupervisor:
+    '''
+    Keeps one :class:`movesense_class.BLEClient` connected and streaming.
+
+    Args:
+        client:
+            The client to supervise.
+        scanner:
+            A running :class:`scanner.MovesenseScanner`. Reconnects use its cached BLEDevice of the address.
+        min_backoff, max_backoff:
+            The first and the largest wait in seconds between reconnect attempts.
+        factor:
+            The growth of the wait after each failed attempt.
+        jitter:
+            The fraction of the wait randomly taken off, so that many devices do not retry in step.
+        max_attempts:
+            The failed attempts after which the supervisor gives up (state 'failed'), None to retry forever.
+        state:
+            'idle', 'connected', 'reconnecting', 'failed' or 'stopped'.
+        reconnects:
+            Number of successful reconnects.
+        failed_attempts:
+            Number of failed reconnect attempts.
+        downtime_s:
+            The total seconds the streams were broken off.
+        last_error:
+            The exception of the last failed attempt.
+
+    Example:
+        >>> supervisor = ConnectionSupervisor(mv_client, max_backoff = 30)
+        >>> await supervisor.start()
+        >>> ...    # the client reconnects and resubscribes on its own
+        >>> await supervisor.stop()
+    '''
+    def __init__(self, client, scanner = None, min_backoff : float = 0.5, max_backoff : float = 30.0, factor : float = 2.0,
+                 jitter : float = 0.1, max_attempts = None):
+        if min_backoff <= 0 or max_backoff < min_backoff:
+            raise ValueError("Backoff must be positive and max_backoff at least min_backoff.")
+        if factor < 1:
+            raise ValueError("Backoff factor must be at least 1.")
+        self.client = client
+        self.scanner = scanner
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.factor = factor
+        self.jitter = jitter
+        self.max_attempts = max_attempts
+        self.state = "idle"
+        self.reconnects = 0
+        self.failed_attempts = 0
+        self.downtime_s = 0.0
+        self.last_error = None
+        self._lost = Event()
+        self._connected = Event()
+        self._task = None
+
+    def backoff(self, attempt : int):
+        '''
+        Returns:
+            float: The seconds to wait after the given number of failed attempts.
+        '''
+        delay = min(self.max_backoff, self.min_backoff * self.factor ** max(0, attempt - 1))
+        return delay * (1.0 - self.jitter * random())
+
+    def _on_disconnect(self, client):
+        self._connected.clear()
+        self._lost.set()
+
+    async def start(self):
+        '''
+        Start supervising. A client that is not connected yet is connected (with the same backoff).
+        '''
+        if self._task is not None:
+            return
+        self.client.disconnect_callbacks.append(self._on_disconnect)
+        if self.client.is_connected:
+            self.state = "connected"
+            self._connected.set()
+        else:
+            self._lost.set()
+        self._task = create_task(self._supervise())
+
+    async def stop(self):
+        '''
+        Stop supervising. The client stays as it is, disconnect it afterwards if needed.
+        '''
+        if self._on_disconnect in self.client.disconnect_callbacks:
+            self.client.disconnect_callbacks.remove(self._on_disconnect)
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except CancelledError:
+                pass
+            self._task = None
+        self.state = "stopped"
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+
+    async def wait_connected(self, timeout = None):
+        '''
+        Wait until the client is connected and its streams restored.
+
+        Raises:
+            TimeoutError: Not connected within the timeout.
+        '''
+        await wait_for(self._connected.wait(), timeout)
+
+    async def _supervise(self):
+        while True:
+            await self._lost.wait()
+            self._lost.clear()
+            if not await self._reconnect():
+                return
+
+    async def _restore(self):
+        client = self.client
+        if self.scanner is not None and client.device_address is not None:
+            device = self.scanner.get_device(client.device_address)
+            if device is not None:
+                client.set_device(device)
+        await client.connect()
+        references = await client.resubscribe()
+        if references:
+            await client.start_notify()
+            if not client.is_notifying:
+                raise ConnectionError("Failed to restart notifying.")
+
+    async def _reconnect(self):
+        '''
+        Reconnect until it succeeds or max_attempts fail, then mark the gap in the streams.
+
+        Returns:
+            bool: True if reconnected.
+        '''
+        self.state = "reconnecting"
+        start = self.client.disconnected_at if self.client.disconnected_at is not None else time()
+        attempt = 0
+        while True:
+            try:
+                await self._restore()
+                break
+            except CancelledError:
+                raise
+            except Exception as e:
+                self.last_error = e
+                self.failed_attempts += 1
+                attempt += 1
+                if self.max_attempts is not None and attempt >= self.max_attempts:
+                    self.state = "failed"
+                    return False
+                await sleep(self.backoff(attempt))
+        end = time()
+        if self.client.disconnected_at is not None:
+            await self.client.mark_gap(start, end)
+            self.downtime_s += end - start
+            self.reconnects += 1
+        self.state = "connected"
+        self._connected.set()
+        return True
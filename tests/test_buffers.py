@@ -0,0 +1,36 @@
+import asyncio
+import numpy as np
+import pytest
+from buffers import RingBuffer
+from movesense_class import BLEClient
+
+
+def test_concurrent_waiters():
+    async def run():
+        buffer = RingBuffer(100)
+        small = asyncio.ensure_future(buffer.wait(5))
+        large = asyncio.ensure_future(buffer.wait(20))
+        timed_out = asyncio.ensure_future(buffer.wait(50, timeout = 0.05))
+        await asyncio.sleep(0)
+        buffer.write(np.zeros(10), np.zeros(10))
+        await asyncio.sleep(0)
+        assert small.done() and not large.done()
+        buffer.write(np.zeros(10), np.zeros(10))
+        assert await asyncio.wait_for(large, 1)
+        assert not await timed_out
+        assert not buffer._waiters
+
+    asyncio.run(run())
+
+
+def test_gaps_are_bounded():
+    buffer = RingBuffer(10, max_gaps = 3)
+    for position in range(5):
+        buffer.write([position], [position])
+        buffer.mark_gap(position)
+    assert buffer.gaps_between(0, 10) == [2, 3, 4]
+
+
+def test_client_rejects_block_policy():
+    with pytest.raises(ValueError):
+        BLEClient("00:00:00:00:00:01", ring_seconds = 10, overflow_policy = "block")
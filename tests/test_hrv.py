@@ -0,0 +1,34 @@
+import numpy as np
+from hrv import HRVWindow
+
+
+def _offline(beats, seconds):
+    '''
+    The metrics of the beats in the window ending at the last one, computed from scratch.
+    '''
+    end = beats[-1][0]
+    window = [(rr, diff) for time, rr, diff in beats if time > end - seconds]
+    rr = np.array([rr for rr, _ in window])
+    # No difference to the beat before the window, nor across an artifact
+    diffs = np.array([diff for _, diff in window[1:] if diff is not None])
+    return {'count' : len(rr), 'mean_rr' : rr.mean(), 'sdnn' : rr.std(ddof = 1),
+            'rmssd' : np.sqrt(np.mean(diffs ** 2)), 'pnn50' : 100.0 * np.mean(np.abs(diffs) > 50.0)}
+
+
+def test_window_matches_offline():
+    rng = np.random.default_rng(0)
+    window = HRVWindow(30)
+    beats, time, previous = [], 0.0, None
+    for index in range(2000):
+        rr = 800.0 + rng.normal(0, 40)
+        time += rr / 1000.0
+        # An artifact every 97 beats breaks the successive differences
+        diff = None if previous is None or index % 97 == 0 else rr - previous
+        previous = rr
+        beats.append((time, rr, diff))
+        window.append(time, rr, diff)
+        if index > 100 and index % 50 == 0:
+            metrics, expected = window.metrics(), _offline(beats, 30)
+            assert metrics['count'] == expected['count']
+            for key in ('mean_rr', 'sdnn', 'rmssd', 'pnn50'):
+                assert np.isclose(metrics[key], expected[key]), key
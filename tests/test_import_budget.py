@@ -0,0 +1,13 @@
+import sys
+from os.path import dirname, abspath, join
+import pytest
+
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), "benchmarks"))
+from bench_import import BUDGETS, import_time  # noqa: E402
+
+
+@pytest.mark.parametrize("module", list(BUDGETS))
+def test_import_forbidden_modules(module):
+    # The milliseconds budget depends on the machine, benchmarks/bench_import.py checks it
+    _, forbidden = BUDGETS[module]
+    assert not set(forbidden) & import_time(module)[1]
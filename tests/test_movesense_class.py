@@ -0,0 +1,21 @@
+import asyncio
+from simulator import PacketGenerator, simulated_ble_client
+
+
+def test_responses_are_not_decoded():
+    async def run():
+        client = simulated_ble_client("00:00:00:00:00:01", speed = 0, ring_seconds = 10)
+        await client.connect()
+        await client.write_characteristic("ecg", 512)
+        reference = client.get_reference("ecg")
+        packet = PacketGenerator("ecg", 512, reference, seed = 0).packets(1)[0]
+        # A command response carrying the reference of the subscription
+        await client._notification_handler(None, bytearray([1, reference, 200, 0]))
+        await client._notification_handler(None, packet)
+        await client.disconnect()
+        return client
+
+    client = asyncio.run(run())
+    assert client.response_packets == 1
+    assert client.get_health()['packets'] == 1
+    assert len(client.get_stream("ecg")) == 16
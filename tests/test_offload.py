@@ -0,0 +1,74 @@
+import asyncio
+import time
+import numpy as np
+import pytest
+from decoder import decode_samples
+from offload import ProcessOffload
+from simulator import PacketGenerator, simulated_ble_client
+
+
+def _copy(times, samples):
+    # The arguments are views of shared memory, valid only during the call
+    return np.array(times), np.array(samples)
+
+
+@pytest.mark.parametrize("request_type, hz", [("ecg", 512), ("acc", 104), ("imu9", 208)])
+def test_submit_packets_round_trip(request_type, hz):
+    packets = PacketGenerator(request_type, hz, seed = 0).packets(50)
+    packet_times = np.arange(len(packets), dtype = np.float64)
+
+    async def run():
+        with ProcessOffload(_copy, workers = 1, slots = 2) as offload:
+            await offload.submit_packets(request_type, packets, packet_times, hz)
+            return await offload.next_result()
+
+    times, samples = asyncio.run(run())
+    expected = decode_samples(request_type, packets)[1]
+    np.testing.assert_array_equal(samples, expected)
+    assert len(times) == len(expected)
+
+
+@pytest.mark.parametrize("request_type, hz", [("ecg", 512), ("imu9", 208)])
+def test_client_offload(request_type, hz):
+    async def run():
+        client = simulated_ble_client("00:00:00:00:00:01", speed = 0)
+        with ProcessOffload(_copy, workers = 1) as offload:
+            client.set_offload(offload, batch_packets = 8)
+            await client.connect()
+            await client.write_characteristic(request_type, hz)
+            packets = PacketGenerator(request_type, hz, client.get_reference(request_type), seed = 0).packets(20)
+            for packet in packets:
+                await client._notification_handler(None, packet)
+            await client.flush_offload()
+            results = [result async for result in offload.results()]
+            await client.disconnect()
+        return packets, results
+
+    packets, results = asyncio.run(run())
+    samples = np.concatenate([result[1] for result in results])
+    np.testing.assert_array_equal(samples, decode_samples(request_type, packets)[1])
+
+
+def _slow(times, samples):
+    time.sleep(0.5)
+    return len(samples)
+
+
+def test_handler_drops_batches_without_free_slot():
+    async def run():
+        client = simulated_ble_client("00:00:00:00:00:01", speed = 0)
+        with ProcessOffload(_slow, workers = 1, slots = 1) as offload:
+            client.set_offload(offload, batch_packets = 4)
+            await client.connect()
+            await client.write_characteristic("ecg", 512)
+            reference = client.get_reference("ecg")
+            # The first batch holds the only slot, the handler does not wait for it
+            for packet in PacketGenerator("ecg", 512, reference, seed = 0).packets(12):
+                await client._notification_handler(None, packet)
+            results = [result async for result in offload.results()]
+            await client.disconnect()
+        return client.subscriptions[reference]['health'], results
+
+    health, results = asyncio.run(run())
+    assert len(results) == 1
+    assert (health.dropped_batches, health.dropped_packets) == (2, 8)
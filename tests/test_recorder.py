@@ -0,0 +1,100 @@
+import asyncio
+import numpy as np
+import pytest
+from decoder import decode_samples
+from recorder import PacketRecorder, BackgroundRecorder, RecordingReader
+from simulator import PacketGenerator, simulated_ble_client
+
+
+def test_client_writes_stream_headers(tmp_path):
+    async def run():
+        client = simulated_ble_client("00:00:00:00:00:01", speed = 0)
+        recorder = BackgroundRecorder(PacketRecorder(str(tmp_path), "chest", segment_size = 4096), batch_packets = 16)
+        client.set_recorder(recorder, decode = False)
+        await client.connect()
+        await client.write_characteristic("imu9", 208)
+        reference = client.get_reference("imu9")
+        packets = PacketGenerator("imu9", 208, reference, seed = 0).packets(100)
+        for packet in packets:
+            await client._notification_handler(None, packet)
+        await client.disconnect()
+        recorder.close()
+        return reference, packets
+
+    reference, packets = asyncio.run(run())
+    reader = RecordingReader(str(tmp_path), "chest")
+    assert len(reader.segments) > 1
+    assert reader.streams == {reference : ("imu9", 208)}
+    entries, timestamps, samples = reader.decode_sensor_range("imu9", 0, 1 << 40)
+    assert len(entries) == len(packets)
+    np.testing.assert_array_equal(samples, decode_samples("imu9", packets)[1])
+
+
+def test_sensor_range_rollover_and_reset(tmp_path):
+    recorder = PacketRecorder(str(tmp_path))
+    recorder.set_streams({99 : ("ecg", 512)})
+    # Rolls over past 2 ** 32, then the device resets to 0
+    timestamps = [(1 << 32) - 250, (1 << 32) - 125, 0, 125, 250, 0, 125]
+    for host_time, timestamp in enumerate(timestamps):
+        packet = PacketGenerator("ecg", 512, 99, start_timestamp = timestamp).packets(1)[0]
+        recorder.write(packet, sensor_timestamp = timestamp % (1 << 32), host_time = host_time)
+    recorder.close()
+    reader = RecordingReader(str(tmp_path))
+    entries, _ = reader.read_sensor_range(99, (1 << 32) - 125, (1 << 32) + 125)
+    assert entries['host_time'].tolist() == [1, 2, 3]
+    entries, _ = reader.read_sensor_range("ecg", 0, 125)
+    assert entries['host_time'].tolist() == [5, 6]
+
+
+def test_reused_reference_decodes_per_segment(tmp_path):
+    recorder = PacketRecorder(str(tmp_path))
+    ecg = PacketGenerator("ecg", 125, 5, seed = 0).packets(3)
+    imu = PacketGenerator("imu6", 52, 5, seed = 0, start_timestamp = 1000).packets(2)
+    fast = PacketGenerator("ecg", 250, 6, seed = 0, start_timestamp = 2000).packets(2)
+    recorder.set_streams({5 : ("ecg", 125)})
+    for host_time, packet in enumerate(ecg):
+        recorder.write(packet, sensor_timestamp = int.from_bytes(packet[2:6], "little"), host_time = host_time)
+    # Reference 5 is reused for another request, and the ECG moves to reference 6 at another rate
+    recorder.set_streams({5 : ("imu6", 52), 6 : ("ecg", 250)})
+    for host_time, packet in enumerate(imu + fast, 10):
+        recorder.write(packet, sensor_timestamp = int.from_bytes(packet[2:6], "little"), host_time = host_time)
+    recorder.close()
+    reader = RecordingReader(str(tmp_path))
+    assert reader.segment_streams == [{5 : ("ecg", 125)}, {5 : ("imu6", 52), 6 : ("ecg", 250)}]
+    entries, _, samples = reader.decode_sensor_range("ecg", 0, 1 << 40)
+    assert len(entries) == len(ecg) + len(fast)
+    np.testing.assert_array_equal(samples, np.concatenate([decode_samples("ecg", ecg)[1], decode_samples("ecg", fast)[1]]))
+    entries, _, samples = reader.decode_sensor_range("ecg", 0, 1 << 40, hz = 250)
+    np.testing.assert_array_equal(samples, decode_samples("ecg", fast)[1])
+    _, _, samples = reader.decode_sensor_range("imu6", 0, 1 << 40)
+    np.testing.assert_array_equal(samples, decode_samples("imu6", imu)[1])
+    with pytest.raises(ValueError):
+        reader.decode_sensor_range(5, 0, 1 << 40)
+
+
+def test_replay_resolves_recorded_reference(tmp_path):
+    recorder = PacketRecorder(str(tmp_path / "source"))
+    recorder.set_streams({7 : ("ecg", 125)})
+    packets = PacketGenerator("ecg", 125, 7, seed = 0).packets(5)
+    for host_time, packet in enumerate(packets):
+        recorder.write(packet, host_time = host_time)
+    recorder.close()
+
+    async def run():
+        client = simulated_ble_client("00:00:00:00:00:01", speed = 0, replay = RecordingReader(str(tmp_path / "source")))
+        replayed = PacketRecorder(str(tmp_path / "replay"))
+        client.set_recorder(replayed, decode = False)
+        await client.connect()
+        await client.start_notify()
+        await client.write_characteristic("ecg", 125)
+        for _ in range(100):
+            await asyncio.sleep(0)
+        reference = client.get_reference("ecg")
+        await client.disconnect()
+        replayed.close()
+        return reference
+
+    reference = asyncio.run(run())
+    _, replayed = RecordingReader(str(tmp_path / "replay")).read_range()
+    assert reference != 7
+    assert [bytes(packet) for packet in replayed] == [bytes(packet[:1]) + bytes([reference]) + bytes(packet[2:]) for packet in packets]
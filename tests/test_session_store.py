@@ -0,0 +1,24 @@
+import threading
+import numpy as np
+import session_store
+from session_store import SessionWriter, SessionReader
+
+
+def test_chunks_are_compressed_by_the_writer_thread(tmp_path, monkeypatch):
+    threads = set()
+    compress = session_store.compress_column
+
+    def compress_column(values, level = 6):
+        threads.add(threading.current_thread().name)
+        return compress(values, level)
+
+    monkeypatch.setattr(session_store, "compress_column", compress_column)
+    times = np.arange(1000, dtype = np.float64)
+    samples = np.random.default_rng(0).normal(size = (1000, 3)).astype(np.float32)
+    with SessionWriter(str(tmp_path), chunk_size = 128) as session:
+        for start in range(0, 1000, 50):
+            session.write("00:00:00:00:00:01", "acc", 99, times[start:start + 50], samples[start:start + 50], hz = 104)
+    assert threads == {"session-writer"}
+    read_times, read_samples = SessionReader(str(tmp_path)).read("00:00:00:00:00:01", "acc")
+    np.testing.assert_array_equal(read_times, times)
+    np.testing.assert_array_equal(read_samples, samples)
@@ -0,0 +1,212 @@
+"""
+Module Name: timestamps.py
+Description: Per-sample timestamp reconstruction and sensor to host clock alignment.
+
+A packet carries one sensor timestamp (uint32 milliseconds) for all its samples. The sample times are
+rebuilt from the sample rate, and an online linear fit between the sensor clock and the host receive time
+maps them to host time, following the drift of the sensor clock.
+"""
+
+import numpy as np
+
+TIMESTAMP_WRAP = 1 << 32
+
+
+class TimestampUnwrapper:
+    '''
+    Turns the wrapping uint32 millisecond sensor timestamps to increasing int64 ones.
+
+    Args:
+        last:
+            The last unwrapped timestamp, None before the first one.
+    '''
+    def __init__(self):
+        self.last = None
+
+    def unwrap(self, timestamps):
+        '''
+        Args:
+            timestamps: An int or an array of sensor timestamps in order.
+
+        Returns:
+            The unwrapped timestamps (int or int64 array).
+        '''
+        if np.isscalar(timestamps):
+            timestamp = int(timestamps)
+            if self.last is not None:
+                timestamp += (self.last // TIMESTAMP_WRAP) * TIMESTAMP_WRAP
+                if timestamp < self.last - TIMESTAMP_WRAP // 2:
+                    timestamp += TIMESTAMP_WRAP
+                elif timestamp > self.last + TIMESTAMP_WRAP // 2:
+                    timestamp -= TIMESTAMP_WRAP
+            self.last = timestamp
+            return timestamp
+        timestamps = np.asarray(timestamps, dtype = np.int64)
+        if len(timestamps) == 0:
+            return timestamps
+        first = self.unwrap(int(timestamps[0]))
+        steps = np.diff(timestamps)
+        steps[steps < -TIMESTAMP_WRAP // 2] += TIMESTAMP_WRAP
+        steps[steps > TIMESTAMP_WRAP // 2] -= TIMESTAMP_WRAP
+        unwrapped = np.concatenate(([first], first + np.cumsum(steps)))
+        self.last = int(unwrapped[-1])
+        return unwrapped
+
+
+def expand_timestamps(packet_timestamps, samples_per_packet : int, hz):
+    '''
+    Expand the timestamps of packets to the time of each of their samples, the first sample of a packet
+    being at the packet timestamp.
+
+    Args:
+        packet_timestamps: The (unwrapped) timestamps of the packets in milliseconds, shape (n,).
+        samples_per_packet: The number of samples of each packet.
+        hz: The sample rate.
+
+    Returns:
+        np.ndarray: float64 sample times in milliseconds, shape (n * samples_per_packet,).
+
+    Example:
+        >>> expand_timestamps([0, 125], 16, 128)
+        [0, 7.8125, ..., 117.1875, 125, ..., 242.1875]
+    '''
+    steps = np.arange(samples_per_packet, dtype = np.float64) * (1000.0 / hz)
+    return (np.asarray(packet_timestamps, dtype = np.float64)[:, None] + steps).ravel()
+
+
+class ClockSync:
+    '''
+    Online weighted least squares fit of host time = slope * sensor time + offset.
+    Older points are forgotten exponentially so the fit follows the drift of the sensor clock.
+    Times are kept relative to the first point for precision.
+
+    Args:
+        window:
+            The effective number of recent points of the fit. Each update weights the older points by 1 - 1 / window.
+        count:
+            Number of points added.
+    '''
+    def __init__(self, window : int = 1000):
+        if window < 2:
+            raise ValueError("Window must be at least 2.")
+        self.window = window
+        self._forget = 1.0 - 1.0 / window
+        self.count = 0
+        self._origin = None
+        self._sw = self._sx = self._sy = self._sxx = self._sxy = 0.0
+
+    def update(self, sensor_ms, host_s):
+        '''
+        Add one point or arrays of points.
+
+        Args:
+            sensor_ms: The unwrapped sensor timestamps in milliseconds.
+            host_s: The host receive times in seconds.
+        '''
+        if np.isscalar(sensor_ms):
+            if self._origin is None:
+                self._origin = (sensor_ms / 1000.0, host_s)
+            x = sensor_ms / 1000.0 - self._origin[0]
+            y = host_s - self._origin[1]
+            f = self._forget
+            self._sw = f * self._sw + 1.0
+            self._sx = f * self._sx + x
+            self._sy = f * self._sy + y
+            self._sxx = f * self._sxx + x * x
+            self._sxy = f * self._sxy + x * y
+            self.count += 1
+            return
+        sensor_s = np.asarray(sensor_ms, dtype = np.float64) / 1000.0
+        host_s = np.asarray(host_s, dtype = np.float64)
+        if len(sensor_s) == 0:
+            return
+        if self._origin is None:
+            self._origin = (float(sensor_s[0]), float(host_s[0]))
+        x = sensor_s - self._origin[0]
+        y = host_s - self._origin[1]
+        n = len(x)
+        weights = self._forget ** np.arange(n - 1, -1, -1, dtype = np.float64)
+        decay = self._forget ** n
+        self._sw = decay * self._sw + weights.sum()
+        self._sx = decay * self._sx + weights @ x
+        self._sy = decay * self._sy + weights @ y
+        self._sxx = decay * self._sxx + weights @ (x * x)
+        self._sxy = decay * self._sxy + weights @ (x * y)
+        self.count += n
+
+    def _fit(self):
+        '''
+        Returns:
+            tuple: The slope and the offset relative to the origin. Slope 1 until two distinct points exist.
+        '''
+        if self._sw == 0.0:
+            return 1.0, 0.0
+        mean_x, mean_y = self._sx / self._sw, self._sy / self._sw
+        variance = self._sxx / self._sw - mean_x * mean_x
+        if self.count < 2 or variance <= 1e-12:
+            return 1.0, mean_y - mean_x
+        slope = (self._sxy / self._sw - mean_x * mean_y) / variance
+        return slope, mean_y - slope * mean_x
+
+    @property
+    def slope(self):
+        return self._fit()[0]
+
+    @property
+    def drift_ppm(self):
+        '''
+        Returns:
+            float: How many microseconds per second the host clock runs ahead of the sensor clock.
+        '''
+        return (self._fit()[0] - 1.0) * 1e6
+
+    def to_host(self, sensor_ms):
+        '''
+        Map sensor times to host times with the current fit.
+
+        Args:
+            sensor_ms: The unwrapped sensor times in milliseconds (number or array).
+
+        Returns:
+            The host times in seconds as float64.
+
+        Raises:
+            ValueError: if no point was added yet.
+        '''
+        if self._origin is None:
+            raise ValueError("No clock points yet.")
+        slope, offset = self._fit()
+        x = np.asarray(sensor_ms, dtype = np.float64) / 1000.0 - self._origin[0]
+        return self._origin[1] + offset + slope * x
+
+
+class StreamTimer:
+    '''
+    Rebuilds the sample times of one stream from its packet timestamps.
+
+    Args:
+        hz:
+            The sample rate of the stream.
+        unwrapper:
+            The :class:`TimestampUnwrapper` of the stream.
+    '''
+    def __init__(self, hz):
+        self.hz = hz
+        self.unwrapper = TimestampUnwrapper()
+
+    def sample_times(self, packet_timestamp : int, samples : int):
+        '''
+        Returns:
+            tuple: The unwrapped packet timestamp and the float64 millisecond times of its samples.
+        '''
+        timestamp = self.unwrapper.unwrap(packet_timestamp)
+        return timestamp, self.sample_times_from(timestamp, samples)
+
+    def sample_times_from(self, timestamp : int, samples : int):
+        '''
+        Returns:
+            np.ndarray: The float64 millisecond times of the samples of a packet with an already unwrapped timestamp.
+        '''
+        if samples == 1 or not self.hz:
+            return np.full(samples, timestamp, dtype = np.float64)
+        return timestamp + np.arange(samples, dtype = np.float64) * (1000.0 / self.hz)
@@ -1,13 +1,17 @@
-import numpy as np
-from bleak import BleakScanner
+from __future__ import annotations
 from re import match as re_match
-from asyncio import Queue
-from constants import * 
+from constants import DEVICENAME, MAGI_REQUEST_TYPES, MAGI_SAMPLE_RATES, ECG_REQUEST_TYPE, ECG_SAMPLE_RATES, HR_REQUEST_TYPE
+from health import StreamGap
+# numpy, bleak and the sample buffers are imported by the functions using them, so the address and request
+# checks load without them. The queue annotations are not evaluated, asyncio is not imported either.
 # import csv
 # from json import dumps
 # from os.path import exists 
 # import datetime
 
+__all__ = ["scan_movesense_address", "is_valid_mac_address", "is_valid_request", "magi_data_format", "ecg_data_format",
+           "hr_data_format", "temp_data_format", "ecg_from_queue", "magi_from_queue", "hr_from_queue", "temp_from_queue"]
+
 
 async def scan_movesense_address(timeout = 5.0):
     '''
@@ -23,6 +27,7 @@ async def scan_movesense_address(timeout = 5.0):
         >>> list = scan_movesense_address()
         [0C:8C:DC:41:DB:EB, Movesense 223430000019]
     '''
+    from bleak import BleakScanner
     if timeout <= 0:
         raise ValueError("Timeout cannot be negative.")
 
@@ -115,11 +120,12 @@ async def magi_data_format(queue : Queue()):
         >>> data = await magi_data_format(queue)
         [ time, data ]
     '''
+    import numpy as np
     dt = np.dtype([('timestamp', np.uint32), ('elements', np.ndarray)])
     # magi_data = np.array([], np.ndarray)
     
     data = await queue.get()
-    if data is None:
+    if data is None or isinstance(data, StreamGap):
         return None
     
     data_xyz = np.array(data[1:], dtype = np.float32)
@@ -147,12 +153,13 @@ async def ecg_data_format(queue : Queue()):
         >>> data = await ecg_data_format(queue, False)
         [ ecg1, ... , ecg16 ]
     '''
+    import numpy as np
     ecg_data = np.array([], dtype = np.float32)
     # start_time = store_time
 
     data = await queue.get()
     
-    if data is None:
+    if data is None or isinstance(data, StreamGap):
         return None
     
     start_time = data[0]
@@ -179,11 +186,12 @@ async def hr_data_format(queue : Queue()):
         >>> data = await hr_data_format(queue)
         [ 65.1,  923]
     '''
+    import numpy as np
     dt = np.dtype([ ('beat_rate', np.float32), ('RR_int', np.uint16)])
      
     data = await queue.get()
-    if data is None:
-        return data
+    if data is None or isinstance(data, StreamGap):
+        return None
     
     data = np.array([(data[0],data[1])], dtype=dt)
     
@@ -206,34 +214,126 @@ async def temp_data_format(queue : Queue):
     '''
     
     data = await queue.get()
+    if isinstance(data, StreamGap):
+        return None
     return data
     
+def _pop_all(queue : Queue):
+    '''
+    Pop all the elements currently in the queue without awaiting for each one.
+    The None elements, put to the queue when a request changes, and the :class:`health.StreamGap` markers are skipped.
+    '''
+    while not queue.empty():
+        data = queue.get_nowait()
+        if data is not None and not isinstance(data, StreamGap):
+            yield data
+
 async def ecg_from_queue(queue: Queue, save_timestamps: bool = False):
     '''
-    Helper function to pop and store all the ecg data from the current queue
+    Helper function to pop and store all the ecg data from the current queue.
+    Samples are written to growable buffers so draining is linear to the queue length.
     
     Args:
         queue: The asyncio fifo Queue that holds the stored data 
+        save_timestamps: Boolean to also return the timestamp of each packet
     
     Returns:
-       data: The np array that holding the data.
+       data: The np array holding the ecg samples, or a dict with timestamps and ecg_data.
     
     Example:
-        >>> data = await get_all_ecg_from_queue(queue)
-        [ ,  300]
+        >>> data = await ecg_from_queue(queue)
+        [ ecg1, ... , ecgn ]
+        >>> data = await ecg_from_queue(queue, True)
+        {'timestamps' : [ t1, ... ], 'ecg_data' : [ ecg1, ... , ecgn ]}
     '''
-    # set up data format
-    ecg_data = np.array([],dtype=np.float32)
-    timestamps = np.array([], dtype=np.uint32)
+    import numpy as np
+    from buffers import SampleBuffer
+    ecg_data = SampleBuffer(np.float32, capacity = 16 * max(queue.qsize(), 1))
+    timestamps = SampleBuffer(np.uint32, capacity = max(queue.qsize(), 1))
     
-    while queue.qsize() > 0:
-        temp_timestamp, temp_ecg_data = await ecg_data_format(queue)
-        ecg_data = np.append(ecg_data, np.array(temp_ecg_data, dtype=np.float32))
-        timestamps = np.append(timestamps, np.uint32(temp_timestamp))
-
+    for data in _pop_all(queue):
+        timestamps.append(data[0])
+        ecg_data.extend(data[1:])
         
     if save_timestamps == True:
-        return {'timestamps' : timestamps, 'ecg_data' : ecg_data}
+        return {'timestamps' : timestamps.view(), 'ecg_data' : ecg_data.view()}
     else:
-        return ecg_data
+        return ecg_data.view()
+
+async def magi_from_queue(queue: Queue):
+    '''
+    Helper function to pop and store all the magi data from the current queue.
+    All the packets in the queue must come from the same request and rate.
+    
+    Args:
+        queue: The asyncio fifo Queue that holds the stored data 
+    
+    Returns:
+       data: A dict with the timestamps (n,) and the magi_data (n, values per packet) np arrays.
+    
+    Example:
+        >>> data = await magi_from_queue(queue)
+        {'timestamps' : [ t1, ... ], 'magi_data' : [[x1, y1, z1, ...], ...]}
+    '''
+    import numpy as np
+    from buffers import SampleBuffer
+    timestamps = SampleBuffer(np.uint32, capacity = max(queue.qsize(), 1))
+    magi_data = None
+    
+    for data in _pop_all(queue):
+        if magi_data is None:
+            magi_data = SampleBuffer(np.float32, width = len(data) - 1, capacity = max(queue.qsize() + 1, 1))
+        timestamps.append(data[0])
+        magi_data.append(data[1:])
+    
+    if magi_data is None:
+        return {'timestamps' : timestamps.view(), 'magi_data' : np.empty((0, 0), dtype = np.float32)}
+    return {'timestamps' : timestamps.view(), 'magi_data' : magi_data.view()}
 
+async def hr_from_queue(queue: Queue):
+    '''
+    Helper function to pop and store all the heart rate data from the current queue.
+    
+    Args:
+        queue: The asyncio fifo Queue that holds the stored data 
+    
+    Returns:
+       data: A structured np array with the beat_rate and RR_int fields.
+    
+    Example:
+        >>> data = await hr_from_queue(queue)
+        [(65.1, 923), (65.3, 915), ...]
+    '''
+    import numpy as np
+    from buffers import SampleBuffer
+    dt = np.dtype([ ('beat_rate', np.float32), ('RR_int', np.uint16)])
+    hr_data = SampleBuffer(dt, capacity = max(queue.qsize(), 1))
+    
+    for data in _pop_all(queue):
+        hr_data.append((data[0], data[1]))
+    
+    return hr_data.view()
+
+async def temp_from_queue(queue: Queue):
+    '''
+    Helper function to pop and store all the temperature data from the current queue.
+    
+    Args:
+        queue: The asyncio fifo Queue that holds the stored data 
+    
+    Returns:
+       data: A structured np array with the timestamp and temp fields.
+    
+    Example:
+        >>> data = await temp_from_queue(queue)
+        [(12124, 300.1), (13124, 300.2), ...]
+    '''
+    import numpy as np
+    from buffers import SampleBuffer
+    dt = np.dtype([ ('timestamp', np.uint32), ('temp', np.float32)])
+    temp_data = SampleBuffer(dt, capacity = max(queue.qsize(), 1))
+    
+    for data in _pop_all(queue):
+        temp_data.append((data[0], data[1]))
+    
+    return temp_data.view()